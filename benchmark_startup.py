@@ -0,0 +1,94 @@
+# Copyright (C) 2013  Hannes Bretschneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+""" Measures how long it takes to import Hebel and to initialize it in
+a fresh interpreter, and checks that neither loads the CUDA driver,
+cuBLAS or PyCUDA before they are needed.
+
+Usage::
+
+    python benchmark_startup.py [--repeat N] [--backend cpu|gpu]
+
+"""
+
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+
+MODULES = ['hebel', 'hebel.models', 'hebel.layers', 'hebel.optimizers',
+           'hebel.monitors', 'hebel.data_providers', 'hebel.utils.serial']
+
+# Run in a fresh interpreter, so nothing is cached in sys.modules
+_SCRIPT = """
+import sys, time, json
+t = time.time()
+import numpy
+t_numpy = time.time() - t
+
+t = time.time()
+for module in %(modules)r:
+    __import__(module)
+t_import = time.time() - t
+cuda_modules = sorted(m for m in sys.modules
+                      if m.startswith('pycuda') or
+                      m in ('hebel.pycuda_ops.cublas', 'hebel.pycuda_ops.cuda'))
+
+t = time.time()
+import hebel
+if %(backend)r is not None:
+    hebel.init(backend=%(backend)r)
+t_init = time.time() - t
+
+print json.dumps({'numpy': t_numpy, 'import': t_import, 'init': t_init,
+                  'cuda_modules': cuda_modules})
+"""
+
+
+def measure(modules=MODULES, backend=None):
+    """ Imports ``modules`` and optionally initializes Hebel in a new
+    interpreter and returns the timings in seconds and the CUDA modules
+    that were loaded by the imports.
+    """
+
+    output = subprocess.check_output(
+        [sys.executable, '-c',
+         _SCRIPT % {'modules': modules, 'backend': backend}])
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--backend', choices=('cpu', 'gpu'), default='cpu')
+    args = parser.parse_args()
+
+    results = [measure(backend=args.backend) for _ in range(args.repeat)]
+    for key in ('numpy', 'import', 'init'):
+        times = 1e3 * np.array([r[key] for r in results])
+        print '%-8s median %7.1f ms, min %7.1f ms' % \
+            (key, np.median(times), times.min())
+
+    cuda_modules = results[0]['cuda_modules']
+    if cuda_modules:
+        print 'Importing Hebel loaded CUDA modules: %s' % \
+            ', '.join(cuda_modules)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
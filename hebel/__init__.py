@@ -20,15 +20,13 @@
 """
 
 import numpy as np
-import pycuda.driver as cuda
-cuda.init()
-from pycuda.tools import make_default_context, DeviceMemoryPool
 
 import os as _os
 neural_nets_root = _os.path.split(
     _os.path.abspath(_os.path.dirname(__file__)))[0]
 
 is_initialized = False
+backend = None
 
 class _Sampler(object):
     _sampler = None
@@ -38,7 +36,11 @@ class _Sampler(object):
             return object.__getattribute__(self, name)
     
         sampler = object.__getattribute__(self, '_sampler')
-        if sampler is None:
+        if sampler is None and backend == 'cpu':
+            from .pycuda_ops.cpuarray import HostRandomNumberGenerator
+            sampler = HostRandomNumberGenerator(self.seed)
+            self._sampler = sampler
+        elif sampler is None:
             from pycuda import curandom, gpuarray
             seed_func = curandom.seed_getter_uniform if self.seed is None \
               else lambda N: gpuarray.to_gpu(
@@ -57,6 +59,10 @@ class _Context(object):
     _context = None
 
     def init_context(self, device_id=None):
+        import pycuda.driver as cuda
+        from pycuda.tools import make_default_context
+        cuda.init()
+
         if device_id is None:
             context = make_default_context()
             self._context = context
@@ -80,7 +86,12 @@ class _MemoryPool(object):
     _memory_pool = None
 
     def init(self):
-        self._memory_pool = DeviceMemoryPool()
+        if backend == 'cpu':
+            from .pycuda_ops.cpuarray import HostMemoryPool
+            self._memory_pool = HostMemoryPool()
+        else:
+            from pycuda.tools import DeviceMemoryPool
+            self._memory_pool = DeviceMemoryPool()
 
     def __getattribute__(self, name):
         if name == 'init':
@@ -93,11 +104,14 @@ class _MemoryPool(object):
 memory_pool = _MemoryPool()
         
 
-def init(device_id=None, random_seed=None):
+def init(device_id=None, random_seed=None, backend=None):
     """Initialize Hebel.
 
-    This function creates a CUDA context, CUBLAS context and
-    initializes and seeds the pseudo-random number generator.
+    This function creates a CUDA context and seeds the
+    pseudo-random number generator. cuBLAS and the CUDA kernels are
+    set up when they are first used, so importing and initializing
+    Hebel stays cheap. When using the CPU backend, no CUDA context is
+    created and all computations are performed with NumPy instead.
 
     **Parameters:**
     
@@ -113,22 +127,33 @@ def init(device_id=None, random_seed=None):
         this is omitted, the seed is taken from the environment
         variable ``RANDOM_SEED`` and if that is not defined, a random
         integer is used as a seed.
+
+    backend : {``gpu``, ``cpu``}, optional
+        Whether to run on a CUDA device using PyCUDA (``gpu``) or on
+        the host using NumPy (``cpu``). The CPU backend doesn't
+        require PyCUDA or a CUDA driver. If this is omitted, the
+        backend is taken from the environment variable
+        ``HEBEL_BACKEND`` and if that is not defined, ``gpu`` is used.
     """
 
-    if device_id is None:
-        random_seed = _os.environ.get('CUDA_DEVICE')
-    
     if random_seed is None:
         random_seed = _os.environ.get('RANDOM_SEED')
 
+    if backend is None:
+        backend = _os.environ.get('HEBEL_BACKEND', 'gpu')
+
+    if backend not in ('gpu', 'cpu'):
+        raise ValueError('Unknown backend "%s", must be "gpu" or "cpu"'
+                         % backend)
+
     global is_initialized
     if not is_initialized:
         is_initialized = True
+        _set_backend(backend)
 
-        global context
-        context.init_context(device_id)
-
-        from pycuda import gpuarray, driver, curandom
+        if backend == 'gpu':
+            global context
+            context.init_context(device_id)
 
         # Initialize memory pool
         global memory_pool
@@ -140,12 +165,19 @@ def init(device_id=None, random_seed=None):
 
         # Initialize pycuda_ops
         from hebel import pycuda_ops
-        pycuda_ops.init()
+        pycuda_ops.init(backend)
+
+
+def _set_backend(name):
+    global backend
+    backend = name
 
 
 def _finish_up():
     global is_initialized
-    if is_initialized:
+    if is_initialized and backend == 'cpu':
+        is_initialized = False
+    elif is_initialized:
         global context
         context.pop()
         context = None
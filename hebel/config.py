@@ -37,9 +37,30 @@ from itertools import izip
 is_initialized = False
 root = os.path.curdir
 
-def run_from_config(yaml_src):
-    config = load(yaml_src)
+def run_from_config(yaml_src, overrides=None, stop_condition=None):
+    """
+    Loads a YAML configuration, trains the model and evaluates it on
+    the test set if the configuration has a ``test_dataset``.
+
+    Parameters
+    ----------
+    yaml_src : str
+        The YAML configuration.
+    overrides : dict, optional
+        Overrides to apply, see `load`.
+    stop_condition : callable, optional
+        Passed on to the optimizer, see `hebel.optimizers.SGD`.
+
+    Returns
+    -------
+    config : dict
+        The instantiated configuration.
+    """
+
+    config = load(yaml_src, overrides=overrides)
     optimizer = config['optimizer']
+    if stop_condition is not None:
+        optimizer.stop_condition = stop_condition
     run_conf = config['run_conf']
     run_conf['yaml_config'] = yaml_src
     run_conf['task_id'] = str(uuid.uuid4())
@@ -53,6 +74,8 @@ def run_from_config(yaml_src):
         test_error = model.test_error(test_data, average=True)
         progress_monitor.test_error = test_error
 
+    return config
+
 def load(stream, overrides=None, **kwargs):
     """
     Loads a YAML configuration from a string or file-like object.
@@ -148,17 +171,19 @@ def handle_overrides(graph, overrides):
         to the desired parameter, e.g. "model.corruptor.corruption_level".
     """
     for key in overrides:
-        levels = key.split('.')
+        # Integer levels index into lists, e.g. "model.layers.0.dropout"
+        levels = [int(lvl) if lvl.isdigit() else lvl
+                  for lvl in key.split('.')]
         part = graph
         for lvl in levels[:-1]:
             try:
                 part = part[lvl]
-            except KeyError:
-                raise KeyError("'%s' override failed at '%s'", (key, lvl))
+            except (KeyError, IndexError, TypeError):
+                raise KeyError("'%s' override failed at '%s'" % (key, lvl))
         try:
             part[levels[-1]] = overrides[key]
-        except KeyError:
-            raise KeyError("'%s' override failed at '%s'", (key, levels[-1]))
+        except (KeyError, IndexError, TypeError):
+            raise KeyError("'%s' override failed at '%s'" % (key, levels[-1]))
 
 
 def instantiate_all(graph):
@@ -1,9 +1,29 @@
 from .utils.math import ceil_div
 import numpy as np
 import os
+import multiprocessing
+import hebel
 from hebel.optimizers import SGD
 from hebel import memory_pool
 
+# The CrossValidation object whose folds are run by the worker
+# processes. The workers are forked, so they share its data with the
+# parent process instead of receiving a pickled copy.
+_cross_validation = None
+
+def _init_worker(device_ids):
+    if device_ids is not None:
+        hebel.init(device_id=device_ids.get(), backend='gpu')
+    elif not hebel.is_initialized:
+        hebel.init(backend='cpu')
+
+def _run_fold_in_worker(k):
+    memory_pool.free_held()
+    model, progress_monitor, stats, predictions = \
+        _cross_validation.train_fold(k, _cross_validation.fold_idx[k])
+    return (stats, predictions, progress_monitor.train_error,
+            progress_monitor.validation_error)
+
 class CrossValidation(object):
     def __init__(self, config, data):
 
@@ -32,8 +52,7 @@ class CrossValidation(object):
 
         np.random.seed(config.get('numpy_seed'))
 
-    def run_fold(self, k):
-        memory_pool.free_held()
+    def make_fold_idx(self, k):
         fold_range = (k*self.fold_size, min((k+1)*self.fold_size, self.n_data))
         test_idx = np.arange(fold_range[0], fold_range[1], dtype=np.int32)
 
@@ -43,25 +62,29 @@ class CrossValidation(object):
         train_idx = train_validate_idx[:self.N_train]
         validate_idx = train_validate_idx[self.N_train:]
 
-        self.fold_idx.append({
+        return {
             'test_idx': test_idx,
             'train_idx': train_idx,
             'validate_idx': validate_idx
-        })
+        }
 
-        dp_train = self.make_data_provider(train_idx,
+    def train_fold(self, k, fold_idx):
+        """ Trains the model of fold ``k`` on the indices in ``fold_idx``
+        and returns the model, the progress monitor, the statistics
+        and the predictions on the test set.
+        """
+
+        dp_train = self.make_data_provider(fold_idx['train_idx'],
                                            self.config.get('batch_size_train'))
-        dp_validate = self.make_data_provider(validate_idx,
+        dp_validate = self.make_data_provider(fold_idx['validate_idx'],
                                               self.config.get('batch_size_validate'))
-        dp_test = self.make_data_provider(test_idx,
+        dp_test = self.make_data_provider(fold_idx['test_idx'],
                                           self.config.get('batch_size_test'))
 
         model = self.make_model()
         model.calibrate_learning_rate(dp_train)
-        self.models_cv.append(model)
 
         progress_monitor = self.make_progress_monitor(k)
-        self.progress_monitors_cv.append(progress_monitor)
 
         learning_rate_schedule = self.config['learning_rate_fct'](**self.config['learning_rate_params'])
 
@@ -79,23 +102,87 @@ class CrossValidation(object):
                       yaml_config=self.config['yaml_config'])
 
         stats = self.get_stats(dp_train, dp_test, model)
-        self.fold_stats.append(stats)
-
-        predictions_fold = model.feed_forward(dp_test.data).get()
-        self.predictions = np.r_[self.predictions, predictions_fold] \
-                           if self.predictions is not None else predictions_fold
+        predictions = model.predict(dp_test)
 
         self.make_figures(model, progress_monitor, k)
-        
-        self.train_error['training_error'].append(progress_monitor.train_error)
-        self.train_error['validation_error'].append(progress_monitor.validation_error)
-
 
         del optimizer, dp_train, dp_validate, dp_test
+        return model, progress_monitor, stats, predictions
+
+    def add_fold_results(self, stats, predictions, training_error,
+                         validation_error):
+        self.fold_stats.append(stats)
+        self.predictions = np.r_[self.predictions, predictions] \
+                           if self.predictions is not None else predictions
+        self.train_error['training_error'].append(training_error)
+        self.train_error['validation_error'].append(validation_error)
+
+    def run_fold(self, k):
+        memory_pool.free_held()
+        fold_idx = self.make_fold_idx(k)
+        self.fold_idx.append(fold_idx)
+
+        model, progress_monitor, stats, predictions = \
+            self.train_fold(k, fold_idx)
+        self.models_cv.append(model)
+        self.progress_monitors_cv.append(progress_monitor)
 
-    def run(self):
-        for k in range(self.n_folds):
-            self.run_fold(k)
+        self.add_fold_results(stats, predictions,
+                              progress_monitor.train_error,
+                              progress_monitor.validation_error)
+
+    def run(self, n_workers=None, devices=None):
+        """ Runs all folds.
+
+        By default, the folds are run one after another in this
+        process. If ``devices`` is given, the folds are run in
+        parallel by one worker process per GPU. If only ``n_workers``
+        is given, ``n_workers`` processes train on the CPU backend.
+
+        The workers are forked from this process, so they see
+        ``data`` without it being pickled; large arrays are shared
+        copy-on-write, or can be passed as memory maps. Only the fold
+        number is sent to a worker and only the statistics,
+        predictions and errors are sent back. The results are added
+        in fold order, but ``models_cv`` and ``progress_monitors_cv``
+        stay empty. To use GPUs, Hebel must not be initialized in this
+        process before the workers are started.
+        """
+
+        if n_workers is None and devices is None:
+            for k in range(self.n_folds):
+                self.run_fold(k)
+            return
+
+        if devices is not None:
+            if hebel.is_initialized:
+                raise RuntimeError("Hebel can't be initialized before "
+                                   "starting GPU worker processes")
+            device_ids = multiprocessing.Queue()
+            for device_id in devices:
+                device_ids.put(device_id)
+            n_workers = len(devices)
+        else:
+            if hebel.is_initialized and hebel.backend != 'cpu':
+                raise RuntimeError("Parallel folds without devices run on "
+                                   "the CPU backend")
+            device_ids = None
+
+        # Draw all splits up front, so they don't depend on the order
+        # in which the workers run the folds
+        self.fold_idx = [self.make_fold_idx(k) for k in range(self.n_folds)]
+
+        global _cross_validation
+        _cross_validation = self
+        pool = multiprocessing.Pool(n_workers, _init_worker, (device_ids,))
+        try:
+            for result in pool.imap(_run_fold_in_worker, range(self.n_folds)):
+                self.add_fold_results(*result)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            _cross_validation = None
 
     def make_data_provider(self, idx, batch_size):
         raise NotImplementedError
@@ -30,9 +30,30 @@ A ``DataProvider`` is defined by subclassing the
 a minimum the special methods ``__iter__`` and ``next``.
 """
 
+import sys
+import threading
+import traceback
+import multiprocessing
 import numpy as np
+from Queue import Queue, Empty
+from multiprocessing.sharedctypes import RawArray
 from . import memory_pool
-from pycuda import gpuarray
+from .pycuda_ops import gpuarray
+from .pycuda_ops.elementwise import dequantize
+from .profiler import section
+
+
+def _int32_labels(targets):
+    """ Converts integer class labels in host memory to ``int32``,
+    which is the type of class labels on the GPU.
+    """
+
+    if isinstance(targets, np.ndarray) and \
+       not isinstance(targets, np.memmap) and \
+       targets.dtype.kind in 'iu' and targets.dtype != np.int32:
+        targets = targets.astype(np.int32)
+    return targets
+
 
 class DataProvider(object):
     """ This is the abstract base class for ``DataProvider``
@@ -42,7 +63,7 @@ class DataProvider(object):
     
     def __init__(self, data, targets, batch_size):
         self.data = data
-        self.targets = targets
+        self.targets = _int32_labels(targets)
         if len(self.targets.shape) == 1:
             self.targets = self.targets[:, None] # box targets
 
@@ -98,22 +119,98 @@ class MiniBatchDataProvider(DataProvider):
     then every minibatch is automatically converted to to a
     ``pycuda.GPUArray`` and transferred to the GPU.
 
+    For classification with a :class:`hebel.layers.SoftmaxLayer`,
+    the targets may be a vector of integer class labels instead of a
+    one-hot encoded matrix. Labels are converted to ``int32``.
+
+    If ``shuffle`` is set, the mini-batches are drawn from a new
+    random permutation of the data in every epoch. The permutation
+    only shuffles indices and each mini-batch is gathered into a
+    reusable buffer, so the data set is never copied. Shuffling
+    requires the data to be in host memory.
+
+    The data may be stored in a compact type, either ``float16`` or
+    one of ``uint8``, ``int8``, ``uint16`` and ``int16`` (see
+    :func:`hebel.data_providers.quantize`). It stays compact in
+    memory and during the transfer to the GPU, and only the current
+    mini-batch is expanded to ``float32`` as ``data * scale +
+    offset``.
+
     :param data: Input data.
     :param targets: Target data.
     :param batch_size: The size of mini-batches.
+    :param shuffle: Whether to shuffle the data in every epoch.
+    :param random_seed: Seed for the random number generator used
+        for shuffling.
+    :param scale: Scale of data in a compact type.
+    :param offset: Offset of data in a compact type.
     """
-    
+
+    shuffle = False
+    dtype = np.dtype(np.float32)
+    scale = 1.
+    offset = 0.
+    _data_buffer = None
+    _targets_buffer = None
+
+    def __init__(self, data, targets, batch_size,
+                 shuffle=False, random_seed=None, scale=None, offset=None):
+        if shuffle:
+            if not isinstance(data, np.ndarray) or \
+               not isinstance(targets, np.ndarray):
+                raise ValueError("Shuffling requires data and targets as "
+                                 "numpy arrays in host memory")
+            self.random_state = np.random.RandomState(random_seed)
+        self.shuffle = shuffle
+        self._set_scale(data.dtype, scale, offset)
+        super(MiniBatchDataProvider, self).__init__(data, targets, batch_size)
+
+    def _set_scale(self, data_dtype, scale, offset):
+        if scale is None and offset is None:
+            return
+        if not _is_compact(data_dtype):
+            raise ValueError("scale and offset require data in a compact "
+                             "type, such as uint8 or float16, not %s" %
+                             np.dtype(data_dtype))
+        if scale is not None:
+            self.scale = scale
+        if offset is not None:
+            self.offset = offset
+
     def __getitem__(self, batch_idx):
         # return self.data[batch_idx*self.batch_size:(batch_idx+1)*self.batch_size]
         return self.data_batches[batch_idx], self.targets_batches[batch_idx]
 
+    def _gather_batch(self):
+        if self.i == 0:
+            self._permutation = _shuffled_indices(self.random_state,
+                                                  self.N, self.batch_size)
+            if self._data_buffer is None or \
+               self._data_buffer.shape[0] != self.batch_size:
+                self._data_buffer = np.empty(
+                    (self.batch_size,) + self.data.shape[1:], self.data.dtype)
+                self._targets_buffer = np.empty(
+                    (self.batch_size,) + self.targets.shape[1:],
+                    self.targets.dtype)
+
+        idx = self._permutation[self.i*self.batch_size:
+                                (self.i+1)*self.batch_size]
+        minibatch_data = self._data_buffer[:idx.shape[0]]
+        minibatch_targets = self._targets_buffer[:idx.shape[0]]
+        _take_rows(self.data, idx, minibatch_data)
+        _take_rows(self.targets, idx, minibatch_targets)
+        return minibatch_data, minibatch_targets
+
     def next(self):
         if self.i >= self.n_batches:
             self.i = 0
             raise StopIteration
 
-        minibatch_data  = self.data_batches[self.i]
-        minibatch_targets = self.targets_batches[self.i]
+        if self.shuffle:
+            minibatch_data, minibatch_targets = self._gather_batch()
+        else:
+            minibatch_data  = self.data_batches[self.i]
+            minibatch_targets = self.targets_batches[self.i]
 
         self.i += 1
 
@@ -127,6 +224,1011 @@ class MiniBatchDataProvider(DataProvider):
                 minibatch_targets = minibatch_targets.copy()
             minibatch_targets = gpuarray.to_gpu(minibatch_targets, allocator=memory_pool.allocate)
 
+        if _is_compact(minibatch_data.dtype):
+            minibatch_data = dequantize(minibatch_data, self.scale,
+                                        self.offset, self.dtype)
+
+        return minibatch_data, minibatch_targets
+
+
+# The types that :func:`hebel.pycuda_ops.elementwise.dequantize` can
+# expand. Data in any other integer type, e.g. ``int64`` counts, is
+# converted to the compute type up front.
+COMPACT_DTYPES = tuple(np.dtype(t) for t in
+                       (np.uint8, np.int8, np.uint16, np.int16, np.float16))
+
+
+def _is_compact(dtype):
+    """ Whether data of ``dtype`` is stored compactly and expanded to
+    the compute type one mini-batch at a time.
+    """
+
+    return np.dtype(dtype) in COMPACT_DTYPES
+
+
+def quantize(data, dtype=np.uint8):
+    """ Converts ``data`` to the compact type ``dtype`` to save
+    memory, e.g. for use with
+    :class:`hebel.data_providers.MiniBatchDataProvider`. Integer types
+    linearly map the range of ``data`` onto the range of ``dtype``.
+
+    :param data: The data as a ``numpy.array``.
+    :param dtype: ``uint8``, ``int8``, ``uint16``, ``int16`` or
+        ``float16``.
+    :returns: The tuple ``(data, scale, offset)``, such that
+        ``data * scale + offset`` approximates the original data.
+    """
+
+    dtype = np.dtype(dtype)
+    if not _is_compact(dtype):
+        raise ValueError("Can't quantize to %s, the compact types are %s" %
+                         (dtype, ', '.join(t.name for t in COMPACT_DTYPES)))
+    if dtype == np.float16:
+        return data.astype(np.float16), 1., 0.
+
+    info = np.iinfo(dtype)
+    lo, hi = float(data.min()), float(data.max())
+    scale = (hi - lo) / (float(info.max) - info.min) if hi > lo else 1.
+    offset = lo - info.min * scale
+    compact = np.rint((data - offset) / scale)
+    return np.clip(compact, info.min, info.max).astype(dtype), scale, offset
+
+
+def _shuffled_indices(random_state, N, batch_size):
+    """ Draws a random permutation of ``range(N)``. The indices within
+    each mini-batch are sorted, which doesn't change the batches but
+    makes gathering them more cache (and disk) friendly.
+    """
+
+    permutation = random_state.permutation(N)
+    for i in range(0, N, batch_size):
+        permutation[i:i+batch_size].sort()
+    return permutation
+
+
+def _data_dtype(data_dtype, dtype):
+    """ The staging dtype of data with ``data_dtype``. Data in a
+    compact type is staged as is and only expanded to ``dtype`` on the
+    device.
+    """
+
+    if _is_compact(data_dtype):
+        return np.dtype(data_dtype)
+    return np.dtype(dtype)
+
+
+def _targets_dtype(targets_dtype, dtype):
+    """ The staging dtype of targets with ``targets_dtype``. Integer
+    targets are class labels and are staged as ``int32`` instead of
+    ``dtype``.
+    """
+
+    if np.dtype(targets_dtype).kind in 'iu':
+        return np.dtype(np.int32)
+    return np.dtype(dtype)
+
+
+def _take_rows(array, idx, out):
+    """ Gathers the rows ``idx`` of ``array`` into ``out`` """
+
+    if out.dtype == array.dtype:
+        np.take(array, idx, axis=0, out=out)
+    else:
+        out[...] = np.take(array, idx, axis=0)
+
+
+# Queue item that marks the end of an epoch in PrefetchingDataProvider
+_END_OF_EPOCH = None
+
+
+def _prefetch_batches(data, targets, batch_size, random_state,
+                      host_buffers, free_slots, ready, stop_event):
+    """ Worker thread of :class:`PrefetchingDataProvider`. Copies
+    mini-batches into free staging buffers, cycling through the
+    epochs until ``stop_event`` is set.
+    """
+
+    N = data.shape[0]
+    try:
+        while True:
+            if random_state is not None:
+                permutation = _shuffled_indices(random_state, N, batch_size)
+
+            for i in range(0, N, batch_size):
+                slot = free_slots.get()
+                if slot is None or stop_event.is_set():
+                    return
+
+                # Copying into the staging buffers makes the batch
+                # contiguous and converts it to the staging dtype
+                host_data, host_targets = host_buffers[slot]
+                n = min(batch_size, N - i)
+                with section('prefetch', 'data'):
+                    if random_state is None:
+                        host_data[:n] = data[i:i+n]
+                        host_targets[:n] = targets[i:i+n]
+                    else:
+                        idx = permutation[i:i+n]
+                        _take_rows(data, idx, host_data[:n])
+                        _take_rows(targets, idx, host_targets[:n])
+                ready.put((slot, n))
+            ready.put(_END_OF_EPOCH)
+    except Exception:
+        ready.put(sys.exc_info())
+
+
+class PrefetchingDataProvider(MiniBatchDataProvider):
+    """ A ``MiniBatchDataProvider`` that prepares mini-batches in a
+    background thread while the model trains on the current one.
+
+    A worker thread slices the next ``n_prefetch`` mini-batches out of
+    ``data`` and ``targets``, makes them contiguous, converts them to
+    ``dtype`` and copies them into a ring of reusable staging
+    buffers. On the GPU, the staging buffers are page-locked and each
+    batch is uploaded into a preallocated device buffer, so ``next``
+    only performs a single fast transfer and no allocations. The
+    worker keeps going across epoch boundaries, so the first batches
+    of the next epoch are ready while the model is being validated.
+
+    ``data`` and ``targets`` must be ``numpy.array`` objects in host
+    memory. If your data fits on the GPU, use
+    :class:`hebel.data_providers.MiniBatchDataProvider` with
+    ``GPUArray`` objects instead. With ``shuffle``, the worker thread
+    also gathers the shuffled mini-batches.
+
+    The arrays returned by ``next`` are backed by reused buffers and
+    are only valid until the following call to ``next``.
+
+    Integer targets are class labels and are converted to ``int32``
+    instead of ``dtype``. Data in a compact type (e.g. ``uint8`` or
+    ``float16``) is staged and transferred as is and only expanded to
+    ``dtype`` on the device, as ``data * scale + offset``.
+
+    :param data: Input data.
+    :param targets: Target data.
+    :param batch_size: The size of mini-batches.
+    :param n_prefetch: The number of mini-batches to prepare ahead of
+        time.
+    :param dtype: The data type that data and targets are converted to.
+    :param shuffle: Whether to shuffle the data in every epoch.
+    :param random_seed: Seed for the random number generator used
+        for shuffling.
+    :param scale: Scale of data in a compact type.
+    :param offset: Offset of data in a compact type.
+    """
+
+    _worker = None
+
+    def __init__(self, data, targets, batch_size,
+                 n_prefetch=2, dtype=np.float32,
+                 shuffle=False, random_seed=None, scale=None, offset=None):
+        if not isinstance(data, np.ndarray) or \
+           not isinstance(targets, np.ndarray):
+            raise ValueError("PrefetchingDataProvider requires data and "
+                             "targets as numpy arrays in host memory")
+        if n_prefetch < 1:
+            raise ValueError("n_prefetch must be at least one")
+
+        self.n_prefetch = n_prefetch
+        self.dtype = np.dtype(dtype)
+        super(PrefetchingDataProvider, self).__init__(
+            data, targets, batch_size, shuffle, random_seed, scale, offset)
+
+    def _make_batches(self):
+        super(PrefetchingDataProvider, self)._make_batches()
+        self._start_worker()
+
+    def _row_shapes(self):
+        return self.data.shape[1:], self.targets.shape[1:]
+
+    def _staging_dtypes(self):
+        return _data_dtype(self.data.dtype, self.dtype), \
+            _targets_dtype(self.targets.dtype, self.dtype)
+
+    def _worker_task(self):
+        """ Returns the function that the worker thread runs and its
+        arguments, apart from the buffers, queues and stop event.
+        """
+        return _prefetch_batches, (
+            self.data, self.targets, self.batch_size,
+            self.random_state if self.shuffle else None)
+
+    def _allocate_buffers(self):
+        from . import backend
+        data_row_shape, targets_row_shape = self._row_shapes()
+        data_shape = (self.batch_size,) + data_row_shape
+        targets_shape = (self.batch_size,) + targets_row_shape
+        data_dtype, targets_dtype = self._staging_dtypes()
+
+        if backend == 'cpu':
+            # The staging buffers are handed out directly
+            host_empty = gpuarray.empty
+            self._device_buffers = None
+        else:
+            from pycuda.driver import pagelocked_empty
+            host_empty = pagelocked_empty
+            self._device_buffers = (
+                gpuarray.empty(data_shape, data_dtype,
+                               allocator=memory_pool.allocate),
+                gpuarray.empty(targets_shape, targets_dtype,
+                               allocator=memory_pool.allocate))
+
+        self._host_buffers = [(host_empty(data_shape, data_dtype),
+                               host_empty(targets_shape, targets_dtype))
+                              for _ in range(self.n_prefetch)]
+
+        # Compact data is expanded into this buffer
+        self._dequantized_buffer = \
+            gpuarray.empty(data_shape, self.dtype,
+                           allocator=memory_pool.allocate) \
+            if _is_compact(data_dtype) else None
+
+    def _start_worker(self):
+        self.stop()
+        self._allocate_buffers()
+
+        self._free_slots = Queue()
+        for slot in range(self.n_prefetch):
+            self._free_slots.put(slot)
+        self._ready = Queue()
+        self._slot_in_use = None
+        self._stop_event = threading.Event()
+
+        target, args = self._worker_task()
+        self._worker = threading.Thread(
+            target=target,
+            args=args + (self._host_buffers, self._free_slots,
+                         self._ready, self._stop_event))
+        self._worker.daemon = True
+        self._worker.start()
+
+    def stop(self):
+        """ Stops the worker thread. Changing ``batch_size`` starts a
+        new one.
+        """
+
+        if self._worker is not None:
+            self._stop_event.set()
+            self._free_slots.put(None)     # Wake up the worker
+            self._worker.join()
+            self._worker = None
+
+    def __del__(self):
+        self.stop()
+
+    def _release_slot(self):
+        if self._slot_in_use is not None:
+            self._free_slots.put(self._slot_in_use)
+            self._slot_in_use = None
+
+    def _get_ready(self):
+        if self._worker is None:
+            raise ValueError("The worker thread has been stopped")
+        item = self._ready.get()
+        if isinstance(item, tuple) and len(item) == 3:
+            raise item[0], item[1], item[2]
+        return item
+
+    def __iter__(self):
+        # Skip the rest of an epoch that was not iterated to the end
+        if self.i:
+            self._release_slot()
+            item = self._get_ready()
+            while item is not _END_OF_EPOCH:
+                self._free_slots.put(item[0])
+                item = self._get_ready()
+        self.i = 0
+        return self
+
+    def next(self):
+        self._release_slot()
+        item = self._get_ready()
+        if item is _END_OF_EPOCH:
+            self.i = 0
+            raise StopIteration
+
+        slot, n = item
+        self.i += 1
+        host_data, host_targets = self._host_buffers[slot]
+
+        if self._device_buffers is None:
+            self._slot_in_use = slot
+            minibatch_data, minibatch_targets = host_data, host_targets
+        else:
+            minibatch_data, minibatch_targets = self._device_buffers
+            minibatch_data.set(host_data)
+            minibatch_targets.set(host_targets)
+            self._free_slots.put(slot)
+
+        if n < self.batch_size:
+            minibatch_data = minibatch_data[:n]
+            minibatch_targets = minibatch_targets[:n]
+
+        if self._dequantized_buffer is not None:
+            minibatch_data = dequantize(
+                minibatch_data, self.scale, self.offset, self.dtype,
+                target=self._dequantized_buffer[:n])
+
+        return minibatch_data, minibatch_targets
+
+
+class MemmapDataProvider(PrefetchingDataProvider):
+    """ ``DataProvider`` for data sets that are stored on disk and
+    don't need to fit in host memory.
+
+    ``data`` and ``targets`` are opened as ``numpy.memmap`` objects
+    and never read into memory as a whole. Mini-batches are read
+    lazily and in order by the worker thread of
+    :class:`hebel.data_providers.PrefetchingDataProvider`, which
+    reads ``n_prefetch`` batches ahead of training. Data that is
+    stored in a compact type (e.g. ``uint8`` or ``float16``) on disk
+    stays compact until it is on the device, where it is expanded to
+    ``dtype`` as ``data * scale + offset``.
+
+    :param data: Input data, either as a path or as an array (e.g. a
+        ``numpy.memmap``). Paths are opened with
+        :func:`hebel.utils.serial.open_memmap`, which understands
+        ``.npy`` files and lush binary matrices. Use ``open_memmap``
+        directly to open raw binary files.
+    :param targets: Target data, either as a path or as an array.
+    :param batch_size: The size of mini-batches.
+    :param n_prefetch: The number of mini-batches to read ahead.
+    :param dtype: The data type that data and targets are converted to.
+    :param shuffle: Whether to shuffle the data in every epoch. Note
+        that this reads from random positions in the file.
+    :param random_seed: Seed for the random number generator used
+        for shuffling.
+    :param scale: Scale of data in a compact type.
+    :param offset: Offset of data in a compact type.
+    """
+
+    def __init__(self, data, targets, batch_size,
+                 n_prefetch=2, dtype=np.float32,
+                 shuffle=False, random_seed=None, scale=None, offset=None):
+        from .utils.serial import open_memmap
+
+        if isinstance(data, basestring):
+            data = open_memmap(data)
+        if isinstance(targets, basestring):
+            targets = open_memmap(targets)
+
+        if data.shape[0] != targets.shape[0]:
+            raise ValueError("data and targets must have the same "
+                             "number of rows")
+
+        super(MemmapDataProvider, self).__init__(
+            data, targets, batch_size, n_prefetch, dtype,
+            shuffle, random_seed, scale, offset)
+
+
+def _open_shard(shard, data_key, targets_key):
+    """ Opens the data and targets of a shard without reading them """
+    from .utils.serial import open_memmap, open_npz_memmap
+
+    if isinstance(shard, basestring):
+        data = open_npz_memmap(shard, data_key)
+        targets = open_npz_memmap(shard, targets_key)
+    else:
+        data, targets = map(open_memmap, shard)
+
+    if len(targets.shape) == 1:
+        targets = targets[:, None]
+    return data, targets
+
+
+def _read_shard_headers(shard, data_key, targets_key):
+    """ Reads the shapes and dtypes of the data and targets of a shard
+    from the file headers.
+    """
+    from .utils.serial import read_array_header
+
+    if isinstance(shard, basestring):
+        data_shape, data_dtype = read_array_header(shard, data_key)
+        targets_shape, targets_dtype = read_array_header(shard, targets_key)
+    else:
+        data_shape, data_dtype = read_array_header(shard[0])
+        targets_shape, targets_dtype = read_array_header(shard[1])
+
+    if len(targets_shape) == 1:
+        targets_shape += (1,)
+    return data_shape, targets_shape, data_dtype, targets_dtype
+
+
+def _remove_rows(buffers, count, idx):
+    """ Removes the rows ``idx`` from the first ``count`` rows of each
+    of ``buffers``, by moving the last rows into the gaps.
+    """
+
+    n = idx.shape[0]
+    gaps = idx[idx < count - n]
+    tail = np.setdiff1d(np.arange(count - n, count), idx)
+    for buf in buffers:
+        buf[gaps] = buf[tail]
+
+
+def _stream_shards(shards, data_key, targets_key, batch_size,
+                   random_state, buffer_size,
+                   host_buffers, free_slots, ready, stop_event):
+    """ Worker thread of :class:`ShardedDataProvider`. Reads the shards
+    in order, or with ``random_state``, in random order through a
+    shuffle buffer of ``buffer_size`` rows, and copies the mini-batches
+    into free staging buffers until ``stop_event`` is set.
+    """
+
+    def get_slot():
+        slot = free_slots.get()
+        if slot is None or stop_event.is_set():
+            return None
+        return slot
+
+    try:
+        if random_state is not None:
+            data_shape, targets_shape, _, _ = \
+                _read_shard_headers(shards[0], data_key, targets_key)
+            buffer_size = max(buffer_size, batch_size)
+            capacity = buffer_size + batch_size
+            buffers = (np.empty((capacity,) + data_shape[1:],
+                                host_buffers[0][0].dtype),
+                       np.empty((capacity,) + targets_shape[1:],
+                                host_buffers[0][1].dtype))
+
+        while True:
+            if random_state is None:
+                # Fill the staging buffers in order, across shards
+                slot = get_slot()
+                if slot is None:
+                    return
+                n = 0
+                for shard in shards:
+                    data, targets = _open_shard(shard, data_key, targets_key)
+                    i = 0
+                    while i < data.shape[0]:
+                        k = min(batch_size - n, data.shape[0] - i)
+                        host_data, host_targets = host_buffers[slot]
+                        with section('prefetch', 'data'):
+                            host_data[n:n+k] = data[i:i+k]
+                            host_targets[n:n+k] = targets[i:i+k]
+                        i += k
+                        n += k
+                        if n == batch_size:
+                            ready.put((slot, n))
+                            slot = get_slot()
+                            if slot is None:
+                                return
+                            n = 0
+                if n:
+                    ready.put((slot, n))
+                else:
+                    free_slots.put(slot)
+                ready.put(_END_OF_EPOCH)
+                continue
+
+            # Read the shards in random order into the shuffle buffer
+            # and draw random rows from it once it is full
+            count = 0
+            for shard_idx in random_state.permutation(len(shards)):
+                data, targets = _open_shard(shards[shard_idx],
+                                            data_key, targets_key)
+                for i in range(0, data.shape[0], batch_size):
+                    k = min(batch_size, data.shape[0] - i)
+                    with section('prefetch', 'data'):
+                        buffers[0][count:count+k] = data[i:i+k]
+                        buffers[1][count:count+k] = targets[i:i+k]
+                    count += k
+
+                    while count >= buffer_size:
+                        slot = get_slot()
+                        if slot is None:
+                            return
+                        idx = random_state.choice(count, batch_size,
+                                                  replace=False)
+                        host_data, host_targets = host_buffers[slot]
+                        _take_rows(buffers[0], idx, host_data)
+                        _take_rows(buffers[1], idx, host_targets)
+                        _remove_rows(buffers, count, idx)
+                        count -= batch_size
+                        ready.put((slot, batch_size))
+
+            # Drain the shuffle buffer
+            permutation = random_state.permutation(count)
+            for i in range(0, count, batch_size):
+                slot = get_slot()
+                if slot is None:
+                    return
+                idx = permutation[i:i+batch_size]
+                host_data, host_targets = host_buffers[slot]
+                n = idx.shape[0]
+                _take_rows(buffers[0], idx, host_data[:n])
+                _take_rows(buffers[1], idx, host_targets[:n])
+                ready.put((slot, n))
+            ready.put(_END_OF_EPOCH)
+    except Exception:
+        ready.put(sys.exc_info())
+
+
+class ShardedDataProvider(PrefetchingDataProvider):
+    """ ``DataProvider`` for data sets that are split into many files
+    (shards) and don't need to fit in host memory.
+
+    Each shard is either an ``.npz`` file that contains the arrays
+    ``data_key`` and ``targets_key``, or a ``(data, targets)`` tuple
+    of paths that :func:`hebel.utils.serial.open_memmap` can open,
+    e.g. ``.npy`` files. The number of examples is read from the file
+    headers, without reading any data. A worker thread, as in
+    :class:`hebel.data_providers.PrefetchingDataProvider`, reads the
+    shards lazily as memory maps (arrays in compressed ``.npz`` files
+    are read one shard at a time) and converts the rows to ``dtype``,
+    or integer targets to ``int32`` class labels. Data in a compact
+    type stays compact until it is expanded on the device, as
+    ``data * scale + offset``.
+
+    With ``shuffle``, the order of the shards is shuffled in every
+    epoch and the rows pass through a shuffle buffer of
+    ``shuffle_buffer`` rows, from which the mini-batches are drawn at
+    random. Every shard is still read sequentially and only the
+    shuffle buffer is held in memory, so the larger the buffer, the
+    better the shuffle. Without ``shuffle``, the mini-batches are read
+    in order and may span several shards.
+
+    :param shards: A list of shards or a glob pattern that matches the
+        ``.npz`` shards, which are used in sorted order.
+    :param batch_size: The size of mini-batches.
+    :param n_prefetch: The number of mini-batches to read ahead.
+    :param dtype: The data type that data and targets are converted to.
+    :param shuffle: Whether to shuffle the data in every epoch.
+    :param shuffle_buffer: The number of rows in the shuffle buffer,
+        defaults to ten mini-batches.
+    :param random_seed: Seed for the random number generator used
+        for shuffling.
+    :param data_key: The name of the input data in ``.npz`` shards.
+    :param targets_key: The name of the targets in ``.npz`` shards.
+    :param scale: Scale of data in a compact type.
+    :param offset: Offset of data in a compact type.
+    """
+
+    def __init__(self, shards, batch_size,
+                 n_prefetch=2, dtype=np.float32,
+                 shuffle=False, shuffle_buffer=None, random_seed=None,
+                 data_key='data', targets_key='targets',
+                 scale=None, offset=None):
+        if isinstance(shards, basestring):
+            from glob import glob
+            from .utils.string_utils import preprocess
+            pattern = shards
+            shards = sorted(glob(preprocess(pattern)))
+            if not shards:
+                raise ValueError('No shards match "%s"' % pattern)
+        shards = list(shards)
+        if not shards:
+            raise ValueError("No shards given")
+        if n_prefetch < 1:
+            raise ValueError("n_prefetch must be at least one")
+
+        self.data_key = data_key
+        self.targets_key = targets_key
+
+        self.shard_sizes = []
+        for shard in shards:
+            data_shape, targets_shape, data_dtype, targets_dtype = \
+                _read_shard_headers(shard, data_key, targets_key)
+            if data_shape[0] != targets_shape[0]:
+                raise ValueError("data and targets of shard %r must have "
+                                 "the same number of rows" % (shard,))
+            if not self.shard_sizes:
+                self._data_row_shape = data_shape[1:]
+                self._targets_row_shape = targets_shape[1:]
+                self._data_dtype = data_dtype
+                self._targets_dtype = targets_dtype
+            elif data_shape[1:] != self._data_row_shape or \
+                 targets_shape[1:] != self._targets_row_shape:
+                raise ValueError("The rows of shard %r have a different "
+                                 "shape than the first shard" % (shard,))
+            elif _is_compact(self._data_dtype) and \
+                 data_dtype != self._data_dtype:
+                # Compact data is staged in the type of the first shard
+                raise ValueError("The data of shard %r has a different "
+                                 "type than the first shard" % (shard,))
+            self.shard_sizes.append(data_shape[0])
+
+        self.shards = shards
+        self.N = sum(self.shard_sizes)
+        self.n_prefetch = n_prefetch
+        self.dtype = np.dtype(dtype)
+        self._set_scale(self._data_dtype, scale, offset)
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        if shuffle:
+            self.random_state = np.random.RandomState(random_seed)
+        self.i = 0
+        self.batch_size = batch_size
+
+    @property
+    def shape(self):
+        return (self.N,) + self._data_row_shape
+
+    def _make_batches(self):
+        self.n_batches = -(-self.N // self.batch_size)
+        self._start_worker()
+
+    def __getitem__(self, batch_idx):
+        raise NotImplementedError(
+            "ShardedDataProvider only supports sequential access")
+
+    def _row_shapes(self):
+        return self._data_row_shape, self._targets_row_shape
+
+    def _staging_dtypes(self):
+        return _data_dtype(self._data_dtype, self.dtype), \
+            _targets_dtype(self._targets_dtype, self.dtype)
+
+    def _worker_task(self):
+        buffer_size = self.shuffle_buffer \
+            if self.shuffle_buffer is not None else 10 * self.batch_size
+        return _stream_shards, (
+            self.shards, self.data_key, self.targets_key, self.batch_size,
+            self.random_state if self.shuffle else None, buffer_size)
+
+
+def _shared_empty(shape, dtype):
+    """ Allocates an array in shared memory that forked worker
+    processes can write to.
+    """
+
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    buf = RawArray('b', max(size * dtype.itemsize, 1))
+    return np.frombuffer(buf, dtype, size).reshape(shape)
+
+
+def _load_batches(data_provider, host_buffers, tasks, results):
+    """ Worker process of :class:`ParallelDataProvider`. Prepares the
+    mini-batches it is asked for and writes them into slots of the
+    shared ring buffer, until it receives ``None``.
+    """
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+
+        seq, slot, batch_idx = task
+        try:
+            batch_data, batch_targets = data_provider[batch_idx]
+            host_data, host_targets = host_buffers[slot]
+            n = batch_data.shape[0]
+            host_data[:n] = batch_data
+            host_targets[:n] = batch_targets
+            results.put((seq, slot, n))
+        except Exception:
+            # Tracebacks can't be pickled, so send the formatted one
+            results.put((seq, slot, traceback.format_exc()))
+
+
+class ParallelDataProvider(DataProvider):
+    """ Runs the batch preparation of another ``DataProvider`` in a
+    pool of worker processes, so that expensive pre-processing (e.g.
+    decoding, tokenization or augmentation) is not limited to a single
+    core by the GIL.
+
+    Each worker calls ``data_provider[batch_idx]`` for the batches it
+    is assigned and writes the result into a free slot of a ring of
+    ``n_slots`` buffers in shared memory, so batches are never pickled
+    and the buffers are never reallocated. ``next`` returns the
+    batches in order, or, if ``ordered`` is false, in the order in
+    which they are finished, which avoids waiting on a single slow
+    batch. On the GPU, each batch is uploaded into a preallocated
+    device buffer. Like :class:`PrefetchingDataProvider`, the workers
+    keep going across epoch boundaries and the arrays returned by
+    ``next`` are only valid until the following call to ``next``.
+
+    The wrapped provider must implement ``__getitem__`` and return
+    ``numpy.array`` objects in host memory whose shapes, apart from
+    the number of rows, are the same for every batch. The workers are
+    forked and get a copy of ``data_provider``, so it must not use the
+    GPU.
+
+    :param data_provider: The ``DataProvider`` whose batches are
+        prepared in parallel.
+    :param n_workers: The number of worker processes.
+    :param n_slots: The number of batches that may be in flight,
+        defaults to twice the number of workers.
+    :param ordered: Whether to return the batches in order.
+    :param dtype: The data type that data and targets are converted
+        to. Integer targets are converted to ``int32`` class labels.
+        Data in a compact type (e.g. ``uint8``) is expanded on the
+        device, with the ``scale`` and ``offset`` of
+        ``data_provider``.
+    :param shuffle: Whether to shuffle the order of the batches in
+        every epoch.
+    :param random_seed: Seed for the random number generator used
+        for shuffling.
+    """
+
+    _workers = None
+
+    def __init__(self, data_provider, n_workers=2, n_slots=None,
+                 ordered=True, dtype=np.float32,
+                 shuffle=False, random_seed=None):
+        if n_workers < 1:
+            raise ValueError("n_workers must be at least one")
+        if n_slots is None:
+            n_slots = 2 * n_workers
+        if n_slots < 1:
+            raise ValueError("n_slots must be at least one")
+
+        self.data_provider = data_provider
+        self.n_workers = n_workers
+        self.n_slots = n_slots
+        self.ordered = ordered
+        self.dtype = np.dtype(dtype)
+        self.shuffle = shuffle
+        if shuffle:
+            self.random_state = np.random.RandomState(random_seed)
+
+        self.scale = getattr(data_provider, 'scale', 1.)
+        self.offset = getattr(data_provider, 'offset', 0.)
+
+        self.data = data_provider.data
+        self.targets = data_provider.targets
+        self.N = data_provider.N
+        self.i = 0
+        self.batch_size = data_provider.batch_size
+
+    def _make_batches(self):
+        if self.data_provider.batch_size != self.batch_size:
+            self.data_provider.batch_size = self.batch_size
+        self.n_batches = self.data_provider.n_batches
+        self._start_workers()
+
+    def _allocate_buffers(self):
+        from . import backend
+
+        # The shapes of the slots are taken from the first batch
+        sample_data, sample_targets = self.data_provider[0]
+        if not isinstance(sample_data, np.ndarray) or \
+           not isinstance(sample_targets, np.ndarray):
+            raise ValueError("ParallelDataProvider requires batches as "
+                             "numpy arrays in host memory")
+        data_shape = (self.batch_size,) + sample_data.shape[1:]
+        targets_shape = (self.batch_size,) + sample_targets.shape[1:]
+        data_dtype = _data_dtype(sample_data.dtype, self.dtype)
+        targets_dtype = _targets_dtype(sample_targets.dtype, self.dtype)
+
+        self._host_buffers = [(_shared_empty(data_shape, data_dtype),
+                               _shared_empty(targets_shape, targets_dtype))
+                              for _ in range(self.n_slots)]
+
+        if backend == 'cpu':
+            # The slots are handed out directly
+            self._device_buffers = None
+        else:
+            self._device_buffers = (
+                gpuarray.empty(data_shape, data_dtype,
+                               allocator=memory_pool.allocate),
+                gpuarray.empty(targets_shape, targets_dtype,
+                               allocator=memory_pool.allocate))
+
+        # Compact data is expanded into this buffer
+        self._dequantized_buffer = \
+            gpuarray.empty(data_shape, self.dtype,
+                           allocator=memory_pool.allocate) \
+            if _is_compact(data_dtype) else None
+
+    def _start_workers(self):
+        self.stop()
+        self._allocate_buffers()
+
+        self._tasks = multiprocessing.Queue()
+        self._results = multiprocessing.Queue()
+        self._workers = [multiprocessing.Process(
+            target=_load_batches,
+            args=(self.data_provider, self._host_buffers,
+                  self._tasks, self._results))
+                         for _ in range(self.n_workers)]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+        # Batches are numbered consecutively across epochs
+        self._next_seq = 0
+        self._epoch_start = 0
+        self._batch_orders = {}
+        self._finished = {}
+        self._slot_in_use = None
+        for slot in range(self.n_slots):
+            self._submit(slot)
+
+    def stop(self):
+        """ Stops the worker processes. Changing ``batch_size`` starts
+        new ones.
+        """
+
+        if self._workers is not None:
+            for _ in self._workers:
+                self._tasks.put(None)
+            for worker in self._workers:
+                worker.join(1.)
+                if worker.is_alive():
+                    worker.terminate()
+            self._workers = None
+
+    def __del__(self):
+        self.stop()
+
+    def _submit(self, slot):
+        seq = self._next_seq
+        self._next_seq += 1
+
+        epoch, i = divmod(seq, self.n_batches)
+        if self.shuffle:
+            if epoch not in self._batch_orders:
+                self._batch_orders[epoch] = \
+                    self.random_state.permutation(self.n_batches)
+            batch_idx = self._batch_orders[epoch][i]
+        else:
+            batch_idx = i
+        self._tasks.put((seq, slot, batch_idx))
+
+    def _receive(self):
+        while True:
+            try:
+                seq, slot, n = self._results.get(timeout=1.)
+                break
+            except Empty:
+                if not all(worker.is_alive() for worker in self._workers):
+                    raise RuntimeError("A data loading worker died")
+
+        if isinstance(n, basestring):
+            raise RuntimeError("Error in data loading worker:\n" + n)
+        self._finished[seq] = (slot, n)
+
+    def _take(self):
+        """ Waits for the next batch of the current epoch and returns
+        its slot and number of rows.
+        """
+
+        if self._workers is None:
+            raise ValueError("The worker processes have been stopped")
+
+        if self.ordered:
+            seq = self._epoch_start + self.i
+            while seq not in self._finished:
+                self._receive()
+        else:
+            epoch_end = self._epoch_start + self.n_batches
+            while not any(s < epoch_end for s in self._finished):
+                self._receive()
+            seq = min(self._finished)
+
+        self.i += 1
+        return self._finished.pop(seq)
+
+    def _release_slot(self):
+        if self._slot_in_use is not None:
+            self._submit(self._slot_in_use)
+            self._slot_in_use = None
+
+    def _end_epoch(self):
+        self._batch_orders.pop(self._epoch_start // self.n_batches, None)
+        self._epoch_start += self.n_batches
+        self.i = 0
+
+    def __iter__(self):
+        # Skip the rest of an epoch that was not iterated to the end
+        if self.i:
+            self._release_slot()
+            while self.i < self.n_batches:
+                slot, n = self._take()
+                self._submit(slot)
+            self._end_epoch()
+        return self
+
+    def next(self):
+        self._release_slot()
+        if self.i >= self.n_batches:
+            self._end_epoch()
+            raise StopIteration
+
+        slot, n = self._take()
+        host_data, host_targets = self._host_buffers[slot]
+
+        if self._device_buffers is None:
+            self._slot_in_use = slot
+            minibatch_data = gpuarray.to_cpuarray(host_data)
+            minibatch_targets = gpuarray.to_cpuarray(host_targets)
+        else:
+            minibatch_data, minibatch_targets = self._device_buffers
+            minibatch_data.set(host_data)
+            minibatch_targets.set(host_targets)
+            self._submit(slot)
+
+        if n < self.batch_size:
+            minibatch_data = minibatch_data[:n]
+            minibatch_targets = minibatch_targets[:n]
+
+        if self._dequantized_buffer is not None:
+            minibatch_data = dequantize(
+                minibatch_data, self.scale, self.offset, self.dtype,
+                target=self._dequantized_buffer[:n])
+
+        return minibatch_data, minibatch_targets
+
+
+class SparseDataProvider(MiniBatchDataProvider):
+    """ ``DataProvider`` for sparse input data, e.g. bag-of-words or
+    one-hot encoded features.
+
+    The data is kept as a sparse
+    :class:`hebel.pycuda_ops.sparse.CSRMatrix` in host memory and
+    every mini-batch is transferred to the GPU in the same format,
+    without ever being converted to a dense matrix. The first layer
+    of the model must be a :class:`hebel.layers.HiddenLayer`, which
+    computes sparse-dense products for sparse input.
+
+    :param data: Input data as a ``CSRMatrix``, a
+        ``scipy.sparse.csr_matrix``, or the path of a file in the
+        LibSVM format, which is read with
+        :func:`hebel.utils.serial.read_libsvm`.
+    :param targets: Target data. May be ``None`` if ``data`` is a
+        LibSVM file, in which case its labels are used.
+    :param batch_size: The size of mini-batches.
+    :param shuffle: Whether to shuffle the data in every epoch.
+    :param random_seed: Seed for the random number generator used
+        for shuffling.
+    :param n_features: The number of features of a LibSVM file,
+        defaults to the largest feature index in the file.
+    """
+
+    def __init__(self, data, targets, batch_size,
+                 shuffle=False, random_seed=None, n_features=None):
+        from .pycuda_ops.sparse import CSRMatrix
+
+        if isinstance(data, basestring):
+            from .utils.serial import read_libsvm
+            data, labels = read_libsvm(data, n_features)
+            if targets is None:
+                targets = labels
+        elif not isinstance(data, CSRMatrix):
+            data = CSRMatrix.from_csr(data)
+
+        if targets is None:
+            raise ValueError("targets are required unless data is "
+                             "a LibSVM file")
+        if not isinstance(targets, np.ndarray):
+            raise ValueError("SparseDataProvider requires targets as a "
+                             "numpy array in host memory")
+        if data.shape[0] != targets.shape[0]:
+            raise ValueError("data and targets must have the same "
+                             "number of rows")
+
+        if shuffle:
+            self.random_state = np.random.RandomState(random_seed)
+        self.shuffle = shuffle
+        DataProvider.__init__(self, data, targets, batch_size)
+
+    def next(self):
+        if self.i >= self.n_batches:
+            self.i = 0
+            raise StopIteration
+
+        if self.shuffle:
+            if self.i == 0:
+                self._permutation = _shuffled_indices(
+                    self.random_state, self.N, self.batch_size)
+            idx = self._permutation[self.i*self.batch_size:
+                                    (self.i+1)*self.batch_size]
+            minibatch_data = self.data.take_rows(idx)
+            minibatch_targets = self.targets[idx]
+        else:
+            minibatch_data = self.data_batches[self.i]
+            minibatch_targets = self.targets_batches[self.i]
+
+        self.i += 1
+
+        minibatch_data = minibatch_data.to_gpu(allocator=memory_pool.allocate)
+        minibatch_targets = gpuarray.to_gpu(
+            np.ascontiguousarray(minibatch_targets),
+            allocator=memory_pool.allocate)
         return minibatch_data, minibatch_targets
 
 
@@ -225,8 +1327,10 @@ class BatchDataProvider(MiniBatchDataProvider):
     """
     def __init__(self, data, targets):
         self.data = data
-        self.targets = targets
-        if len(self.targets.shape) == 1:
+        self.targets = _int32_labels(targets)
+        if len(self.targets.shape) == 1 and \
+           self.targets.dtype.kind not in 'iu':
+            # Class labels stay a vector
             self.targets = self.targets[:, None] # box targets
         self.N = data.shape[0]
         self.i = 0
@@ -265,14 +1369,20 @@ class MNISTDataProvider(MiniBatchDataProvider):
     `MNIST <http://yann.lecun.com/exdb/mnist/>`_ data set of
     hand-written digits.
 
+    The images are kept on the GPU as ``uint8`` and every mini-batch
+    is scaled to ``float32`` values between zero and one as it is
+    used.
+
     Depends on the `skdata <http://jaberg.github.io/skdata/>`_ package.
 
     :param array: {'train', 'val', 'test'}
         Whether to use the official training, validation, or test data split of MNIST.
     :param batch_size: The size of mini-batches.
+    :param class_labels: Whether to provide the targets as a vector of
+        ``int32`` class labels instead of a one-hot encoded matrix.
     """
 
-    def __init__(self, array, batch_size=None):
+    def __init__(self, array, batch_size=None, class_labels=False):
         try:
             from skdata.mnist.view import OfficialVectorClassification
         except ImportError:
@@ -289,35 +1399,27 @@ class MNISTDataProvider(MiniBatchDataProvider):
         self.D = self.mnist.all_vectors.shape[1]
 
         if array == 'train':
-            self.data = gpuarray.to_gpu(self.mnist.all_vectors[self.train_idx]
-                                   .astype(np.float32) / 255.,
-                                        allocator=memory_pool.allocate)
-            targets = self.mnist.all_labels[self.train_idx]
-            labels_soft = np.zeros((self.N_train, 10), dtype=np.float32)
-            labels_soft[range(self.N_train), targets] = 1.
-            self.targets = gpuarray.to_gpu(labels_soft, allocator=memory_pool.allocate)
-            self.N = self.N_train
+            idx = self.train_idx
         elif array == 'val':
-            self.data = gpuarray.to_gpu(self.mnist.all_vectors[self.val_idx]
-                                   .astype(np.float32) / 255.,
-                                        allocator=memory_pool.allocate)
-            self.N = self.N_val
-            targets = self.mnist.all_labels[self.val_idx]
-            labels_soft = np.zeros((self.N_train, 10), dtype=np.float32)
-            labels_soft[range(self.N_val), targets] = 1.
-            self.targets = gpuarray.to_gpu(labels_soft, allocator=memory_pool.allocate)
+            idx = self.val_idx
         elif array == 'test':
-            self.data = gpuarray.to_gpu(self.mnist.all_vectors[self.test_idx]
-                                   .astype(np.float32) / 255.,
-                                        allocator=memory_pool.allocate)
-            targets = self.mnist.all_labels[self.test_idx]
-            labels_soft = np.zeros((self.N_test, 10), dtype=np.float32)
-            labels_soft[range(self.N_test), targets] = 1.
-            self.targets = gpuarray.to_gpu(labels_soft, allocator=memory_pool.allocate)
-            self.N = self.N_test
+            idx = self.test_idx
         else:
             raise ValueError('Unknown partition "%s"' % array)
 
+        self.N = idx.shape[0]
+        self.data = gpuarray.to_gpu(
+            np.ascontiguousarray(self.mnist.all_vectors[idx], np.uint8),
+            allocator=memory_pool.allocate)
+        self.scale = 1. / 255.
+        labels = self.mnist.all_labels[idx]
+        if class_labels:
+            targets = labels.astype(np.int32)[:, None]
+        else:
+            targets = np.zeros((self.N, 10), dtype=np.float32)
+            targets[range(self.N), labels] = 1.
+        self.targets = gpuarray.to_gpu(targets, allocator=memory_pool.allocate)
+
         self.batch_size = batch_size if batch_size is not None else self.N
         self.i = 0
         self._make_batches()
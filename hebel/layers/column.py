@@ -14,12 +14,16 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import copy
 from . import HiddenLayer
+from ..profiler import profiled
 from itertools import chain
 
 class Column(object):
     l1_penalty_weight = True
     l2_penalty_weight = True
+    _gradient_targets = None
+    _workspace = None
 
     def __init__(self, hidden_layers):
         assert all([isinstance(hl, HiddenLayer) for hl in hidden_layers])
@@ -54,6 +58,28 @@ class Column(object):
             hl.update_parameters(values[:hl.n_parameters])
             values = values[hl.n_parameters:]
 
+    @property
+    def gradient_targets(self):
+        return self._gradient_targets
+
+    @gradient_targets.setter
+    def gradient_targets(self, value):
+        self._gradient_targets = value
+        for hl in self.hidden_layers:
+            hl.gradient_targets = value[:hl.n_parameters] \
+                                  if value is not None else None
+            if value is not None: value = value[hl.n_parameters:]
+
+    @property
+    def workspace(self):
+        return self._workspace
+
+    @workspace.setter
+    def workspace(self, value):
+        self._workspace = value
+        for hl in self.hidden_layers:
+            hl.workspace = value
+
     @property
     def l1_penalty(self):
         return sum(hl.l1_penalty for hl in self.hidden_layers)
@@ -74,6 +100,7 @@ class Column(object):
             hl.lr_multiplier = value[i:i+hl.n_parameters]
             i += hl.n_parameters
 
+    @profiled
     def feed_forward(self, input_data, prediction=False):
         cache = []
         activations = [input_data]
@@ -87,6 +114,18 @@ class Column(object):
         del activations[-1]
         return a, (activations, cache)
 
+    def inference_layer(self, input_scale=1., fold_output=True):
+        column = copy.copy(self)
+        column.hidden_layers = []
+        scale = input_scale
+        for i, hl in enumerate(self.hidden_layers):
+            last_layer = i == len(self.hidden_layers) - 1
+            hl, scale = hl.inference_layer(scale, fold_output or not last_layer)
+            if hl is not None:
+                column.hidden_layers.append(hl)
+        return column, scale
+
+    @profiled
     def backprop(self, input_data, df_output, cache=None):
         if cache is None:
             _, (activations, cache) = self.feed_forward(input_data, False)
@@ -15,6 +15,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 from .hidden_layer import HiddenLayer
+from ..profiler import profiled
 
 
 class DummyLayer(HiddenLayer):
@@ -23,6 +24,7 @@ class DummyLayer(HiddenLayer):
     """
 
     lr_multiplier = []
+    weight_decay = []
     n_parameters = 0
     l1_penalty_weight = 0.
     l2_penalty_weight = 0.
@@ -51,6 +53,7 @@ class DummyLayer(HiddenLayer):
     def l2_penalty(self):
         return 0.
 
+    @profiled
     def feed_forward(self, input_data, prediction=False):
         if input_data.shape[1] != self.n_in:
             raise ValueError('Number of outputs from previous layer (%d) '
@@ -58,5 +61,14 @@ class DummyLayer(HiddenLayer):
                              (input_data.shape[1], self.n_in))
         return (input_data,)
 
+    def inference_layer(self, input_scale=1., fold_output=True):
+        if not fold_output:
+            if input_scale != 1.:
+                raise ValueError("Can't fold the input scale into a "
+                                 "layer without weights")
+            return self, 1.
+        return None, input_scale
+
+    @profiled
     def backprop(self, input_data, df_output, cache=None):
         return tuple(), df_output
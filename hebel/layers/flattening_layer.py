@@ -16,10 +16,12 @@
 
 import numpy as np
 from . import HiddenLayer
+from ..profiler import profiled
 
 class FlatteningLayer(HiddenLayer):
     n_parameters = 0
     lr_multiplier = []
+    weight_decay = []
 
     def __init__(self, n_in, n_filters,
                  l1_penalty_weight=0., l2_penalty_weight=0.):
@@ -30,10 +32,20 @@ class FlatteningLayer(HiddenLayer):
         self.l1_penalty_weight = 0.
         self.l2_penalty_weight = 0.
 
+    @profiled
     def feed_forward(self, input_data, prediction=False):
         N = input_data.shape[0]
         return input_data.reshape((N, self.n_units)), None
 
+    def inference_layer(self, input_scale=1., fold_output=True):
+        if not fold_output:
+            if input_scale != 1.:
+                raise ValueError("Can't fold the input scale into a "
+                                 "layer without weights")
+            return self, 1.
+        return self, input_scale
+
+    @profiled
     def backprop(self, input_data, df_output, cache=None):
         N = input_data.shape[0]
         return tuple(), df_output.reshape((N, self.n_in, self.n_filters))
@@ -16,16 +16,19 @@
 
 import numpy as np
 import cPickle
+import copy
 from itertools import izip
-from pycuda import gpuarray
-from pycuda.gpuarray import GPUArray
+from ..pycuda_ops import gpuarray
 from math import sqrt
 from .. import sampler, memory_pool
+from ..profiler import profiled
 from ..pycuda_ops import eps
 from ..pycuda_ops import linalg
+from ..pycuda_ops.sparse import CSRMatrix, csr_dot
 from ..pycuda_ops.elementwise import sigmoid, df_sigmoid, \
      tanh, df_tanh, relu, df_relu, linear, df_linear, \
-     sample_dropout_mask, apply_dropout_mask, sign, mult_matrix
+     sample_dropout_mask, apply_dropout_mask, mult_matrix, \
+     add_weight_decay
 from ..pycuda_ops.matrix import add_vec_to_mat
 from ..pycuda_ops.reductions import matrix_sum_out_axis
 
@@ -79,6 +82,19 @@ class HiddenLayer(object):
         layer is scaled by :math:`2 / \sqrt{\mathtt{n\_in}}`. You may
         specify a different factor here.
 
+    compute_input_gradients : bool, optional
+        Whether ``backprop`` computes the gradients with respect to
+        the input. This is only necessary if there is a layer below
+        this one, so :class:`hebel.models.NeuralNet` turns it off for
+        its first layer.
+
+    The input may also be a sparse
+    :class:`hebel.pycuda_ops.sparse.CSRMatrix` (e.g. from
+    :class:`hebel.data_providers.SparseDataProvider`), in which case
+    the products with the weights are sparse-dense products and the
+    input is never converted to a dense matrix. Gradients with
+    respect to sparse input are not computed.
+
     **Examples**::
 
         # Use the simple initializer and initialize with random weights
@@ -104,6 +120,22 @@ class HiddenLayer(object):
     W = None
     b = None
 
+    # Optional buffers ``(df_weights, df_biases)`` that ``backprop``
+    # writes the gradients into, see
+    # :meth:`hebel.models.NeuralNet.flatten_parameters`
+    gradient_targets = None
+
+    # Optional :class:`hebel.workspace.Workspace` that provides
+    # reusable buffers for training passes
+    workspace = None
+
+    compute_input_gradients = True
+
+    # Whether ``backprop`` leaves the gradients of the L1 and L2
+    # penalties out, because the parameter updater applies them
+    # (see :attr:`weight_decay`)
+    defer_weight_decay = False
+
     def __init__(self, n_in, n_units,
                  activation_function='sigmoid',
                  dropout=0.,
@@ -111,7 +143,8 @@ class HiddenLayer(object):
                  weights_scale=None,
                  l1_penalty_weight=0.,
                  l2_penalty_weight=0.,
-                 lr_multiplier=None):
+                 lr_multiplier=None,
+                 compute_input_gradients=True):
 
         self._set_activation_fct(activation_function)
 
@@ -152,6 +185,8 @@ class HiddenLayer(object):
         self.dropout = float(dropout)
         assert 0 <= self.dropout < 1
 
+        self.compute_input_gradients = compute_input_gradients
+
     @property
     def parameters(self):
         """Return a tuple ``(weights, biases)``"""
@@ -161,9 +196,9 @@ class HiddenLayer(object):
     def parameters(self, value):
         """Update the parameters. ``value`` must have the shape
         ``(weights, biases)``"""
-        self.W = value[0] if isinstance(value[0], GPUArray) else \
+        self.W = value[0] if isinstance(value[0], gpuarray.GPUArray) else \
           gpuarray.to_gpu(value[0])
-        self.b = value[1] if isinstance(value[0], GPUArray) else \
+        self.b = value[1] if isinstance(value[0], gpuarray.GPUArray) else \
           gpuarray.to_gpu(value[1])
 
     def update_parameters(self, values, stream=None):
@@ -215,6 +250,63 @@ class HiddenLayer(object):
         else:
             raise ValueError
 
+    def _buffer(self, name, shape, dtype=np.float32):
+        """ Returns a buffer from the workspace, or ``None`` to let the
+        operation allocate its result if there is no workspace.
+        """
+        if self.workspace is None:
+            return None
+        return self.workspace.get(self, name, shape, dtype)
+
+    def inference_layer(self, input_scale=1., fold_output=True):
+        """ Returns a copy of the layer for prediction.
+
+        The weights of the copy are multiplied by ``input_scale``, so
+        scaling the input (e.g. by ``1 - dropout`` of the layer below)
+        is folded into the weights instead of being applied to the
+        activations of every batch. The original layer is not changed.
+
+        **Parameters:**
+
+        input_scale : float, optional
+            Factor to fold into the weights.
+
+        fold_output : bool, optional
+            If true, the copy doesn't scale its activations by
+            ``1 - dropout`` and the scale is returned instead, to be
+            folded into the next layer.
+
+        **Returns:**
+
+        layer : ``HiddenLayer``
+            The copy of the layer, or ``None`` if the layer can be
+            skipped in prediction.
+
+        output_scale : float
+            Factor that the next layer has to fold into its weights.
+        """
+
+        layer = copy.copy(self)
+        if input_scale != 1.:
+            layer.W = input_scale * self.W
+
+        if not fold_output:
+            return layer, 1.
+        layer.dropout = 0.
+        return layer, 1. - self.dropout
+
+    @property
+    def weight_decay(self):
+        """ The L1 and L2 penalty weights that the parameter updater
+        has to apply to each parameter, which are zero unless
+        ``defer_weight_decay`` is set.
+        """
+
+        if not self.defer_weight_decay:
+            return self.n_parameters * [(0., 0.)]
+        return [(self.l1_penalty_weight, self.l2_penalty_weight)] + \
+            (self.n_parameters - 1) * [(0., 0.)]
+
     @property
     def l1_penalty(self):
         return self.l1_penalty_weight * gpuarray.sum(abs(self.W)).get()
@@ -223,12 +315,13 @@ class HiddenLayer(object):
     def l2_penalty(self):
         return self.l2_penalty_weight * .5 * gpuarray.sum(self.W ** 2.).get()
 
+    @profiled
     def feed_forward(self, input_data, prediction=False):
         """Propagate forward through the layer
 
         **Parameters:**
 
-        input_data : ``GPUArray``
+        input_data : ``GPUArray`` or ``CSRMatrix``
             Input data to compute activations for.
 
         prediction : bool, optional
@@ -247,7 +340,15 @@ class HiddenLayer(object):
                             'does not match number of inputs to this layer (%d)' %
                              (input_data.shape[1], self.W.shape[0]))
 
-        activations = linalg.dot(input_data, self.W)
+        # Results returned in prediction mode are owned by the caller,
+        # so only training passes use the workspace
+        shape = (input_data.shape[0], self.n_units)
+        target = self._buffer('activations', shape) \
+            if not prediction else None
+        if isinstance(input_data, CSRMatrix):
+            activations = csr_dot(input_data, self.W, target=target)
+        else:
+            activations = linalg.dot(input_data, self.W, target=target)
         activations = add_vec_to_mat(activations, self.b, inplace=True)
 
         self.f(activations)
@@ -256,17 +357,21 @@ class HiddenLayer(object):
             if prediction:
                 activations *= 1 - self.dropout
             else:
-                dropout_mask = sample_dropout_mask(activations, self.dropout)
+                dropout_mask = sample_dropout_mask(
+                    activations, self.dropout,
+                    dropout_mask=self._buffer('dropout_mask', shape, np.int8),
+                    dropout_prob_array=self._buffer('dropout_prob', shape))
                 return activations, dropout_mask
 
         return (activations,)
 
+    @profiled
     def backprop(self, input_data, df_output, cache=None):
         """ Backpropagate through the hidden layer
 
         **Parameters:**
 
-        input_data : ``GPUArray``
+        input_data : ``GPUArray`` or ``CSRMatrix``
             Input data to compute activations for.
 
         df_output : ``GPUArray``
@@ -284,7 +389,8 @@ class HiddenLayer(object):
             form ``(df_weights, df_biases)``.
 
         df_input : ``GPUArray``
-            Gradients with respect to the input.
+            Gradients with respect to the input, or ``None`` if the
+            layer doesn't compute them.
         """
 
         # Get cache if it wasn't provided
@@ -302,22 +408,35 @@ class HiddenLayer(object):
             apply_dropout_mask(df_output, dropout_mask)
 
         # Get gradient wrt activation function
-        df_activations = self.df(activations)
-        delta = mult_matrix(df_activations, df_output)
-
+        df_activations = self.df(
+            activations, target=self._buffer('df_activations',
+                                             activations.shape))
+        delta = mult_matrix(df_activations, df_output,
+                            target=self._buffer('delta', activations.shape))
+
+        df_W_target, df_b_target = self.gradient_targets or \
+          (self._buffer('df_W', self.W.shape), self._buffer('df_b', self.b.shape))
+        sparse_input = isinstance(input_data, CSRMatrix)
         # Gradient wrt weights
-        df_W = linalg.dot(input_data, delta, transa='T')
+        if sparse_input:
+            df_W = csr_dot(input_data, delta, transa='T', target=df_W_target)
+        else:
+            df_W = linalg.dot(input_data, delta, transa='T',
+                              target=df_W_target)
         # Gradient wrt bias
-        df_b = matrix_sum_out_axis(delta, 0)
+        df_b = matrix_sum_out_axis(delta, 0, target=df_b_target)
         # Gradient wrt inputs
-        df_input = linalg.dot(delta, self.W, transb='T')
-
-        # L1 weight decay
-        if self.l1_penalty_weight:
-            df_W += self.l1_penalty_weight * sign(self.W)
+        if self.compute_input_gradients and not sparse_input:
+            df_input = linalg.dot(delta, self.W, transb='T',
+                                  target=self._buffer('df_input',
+                                                      input_data.shape))
+        else:
+            df_input = None
 
-        # L2 weight decay
-        if self.l2_penalty_weight:
-            df_W += self.l2_penalty_weight * self.W
+        # L1 and L2 weight decay
+        if not self.defer_weight_decay and \
+           (self.l1_penalty_weight or self.l2_penalty_weight):
+            add_weight_decay(df_W, self.W, self.l1_penalty_weight,
+                             self.l2_penalty_weight)
 
         return (df_W, df_b), df_input
@@ -16,9 +16,10 @@
 
 import numpy as np
 import cPickle
-from pycuda import gpuarray
+from ..pycuda_ops import gpuarray
 from .dummy_layer import DummyLayer
 from .. import memory_pool
+from ..profiler import profiled
 from ..pycuda_ops.elementwise import sample_dropout_mask, \
     apply_dropout_mask
 from ..pycuda_ops.matrix import add_vec_to_mat
@@ -56,6 +57,7 @@ class InputDropout(DummyLayer):
         self.dropout_probability = dropout_probability
         self.compute_input_gradients = compute_input_gradients
 
+    @profiled
     def feed_forward(self, input_data, prediction=False):
         """Propagate forward through the layer
 
@@ -80,14 +82,31 @@ class InputDropout(DummyLayer):
                              (input_data.shape[1], self.n_in))
 
         if not prediction:
-            dropout_input = gpuarray.empty_like(input_data)
-            dropout_mask = sample_dropout_mask(input_data,
-                                               self.dropout_probability, target=dropout_input
-                                           )
+            dropout_input = self._buffer('dropout_input', input_data.shape)
+            if dropout_input is None:
+                dropout_input = gpuarray.empty_like(input_data)
+            dropout_mask = sample_dropout_mask(
+                input_data, self.dropout_probability, target=dropout_input,
+                dropout_mask=self._buffer('dropout_mask', input_data.shape, np.int8),
+                dropout_prob_array=self._buffer('dropout_prob', input_data.shape))
             return dropout_input, dropout_mask
         else:
             return (input_data * (1 - self.dropout_probability),)
 
+    def inference_layer(self, input_scale=1., fold_output=True):
+        """ The layer is skipped in prediction and the
+        ``1 - dropout_probability`` scaling of the input is folded
+        into the weights of the next layer instead, see
+        :meth:`hebel.layers.HiddenLayer.inference_layer`.
+        """
+
+        layer, output_scale = super(InputDropout, self).inference_layer(
+            input_scale, fold_output)
+        if layer is None:
+            output_scale *= 1 - self.dropout_probability
+        return layer, output_scale
+
+    @profiled
     def backprop(self, input_data, df_output, cache=None):
         """ Backpropagate through the hidden layer
 
@@ -15,9 +15,10 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import numpy as np
-from pycuda import gpuarray, cumath
+from ..pycuda_ops import gpuarray, cumath
 from math import sqrt
 from .. import sampler, memory_pool
+from ..profiler import profiled
 from .softmax_layer import SoftmaxLayer
 from ..pycuda_ops.elementwise import sign, nan_to_zeros
 from ..pycuda_ops.reductions import matrix_sum_out_axis
@@ -110,6 +111,7 @@ class LinearRegressionLayer(SoftmaxLayer):
         self.lr_multiplier = 2 * [1. / np.sqrt(n_in, dtype=np.float32)] \
           if lr_multiplier is None else lr_multiplier
 
+    @profiled
     def feed_forward(self, input_data, prediction=False):
         """Propagate forward through the layer.
 
@@ -134,13 +136,16 @@ class LinearRegressionLayer(SoftmaxLayer):
                              'does not match number of inputs to this layer (%d)' %
                              (input_data.shape[1], self.W.shape[0]))
 
-        activations = linalg.dot(input_data, self.W)
+        # Only training passes use the workspace
+        activations = linalg.dot(input_data, self.W,
+            target=self._buffer('activations', (input_data.shape[0], self.n_out))
+            if not prediction else None)
         activations = add_vec_to_mat(activations, self.b, inplace=True)
 
         return activations
 
     def test_error(self, input_data, targets, average=True,
-                   cache=None, prediction=True):
+                   cache=None, prediction=True, synchronize=True):
         """Compute the test error function given some data and targets.
 
         Uses the error function defined in
@@ -170,15 +175,20 @@ class LinearRegressionLayer(SoftmaxLayer):
             dropout. If true, then weights are multiplied by
             1 - dropout if the layer uses dropout.
 
+        synchronize : bool, optional
+            If false, the error is returned as a scalar ``GPUArray``
+            without copying it to the host, so that errors can be
+            accumulated on the device.
+
         **Returns:**
         test_error : float
         """
 
         return self.squared_loss(input_data, targets, average,
-                                 cache, prediction)
+                                 cache, prediction, synchronize)
 
     def squared_loss(self, input_data, targets, average=True,
-                     cache=None, prediction=False):
+                     cache=None, prediction=False, synchronize=True):
         if cache is not None:
             activations = cache
         else:
@@ -189,5 +199,5 @@ class LinearRegressionLayer(SoftmaxLayer):
             matrix_sum_out_axis((targets - activations) ** 2, 1))
 
         if average: loss = loss.mean()
-        return loss.get()
+        return loss.get() if synchronize else loss
     train_error = squared_loss
@@ -16,14 +16,16 @@
 
 import numpy as np
 import cPickle
-from pycuda import gpuarray
-from pycuda import cumath
+from ..pycuda_ops import gpuarray
+from ..pycuda_ops import cumath
 from math import sqrt
 from .. import sampler, memory_pool
+from ..profiler import profiled
 from .top_layer import TopLayer
 from ..pycuda_ops import eps, linalg
-from ..pycuda_ops.elementwise import sign, nan_to_zeros, substract_matrix, sigmoid
-from ..pycuda_ops.reductions import matrix_sum_out_axis
+from ..pycuda_ops.elementwise import nan_to_zeros, substract_matrix, sigmoid, \
+     add_weight_decay
+from ..pycuda_ops.reductions import matrix_sum_out_axis, binary_mismatch
 from ..pycuda_ops.matrix import add_vec_to_mat
 from ..pycuda_ops.softmax import cross_entropy_logistic
 
@@ -136,6 +138,7 @@ class LogisticLayer(TopLayer):
                 'n_in': self.n_in,
                 'n_out': 1}
 
+    @profiled
     def feed_forward(self, input_data, prediction=False):
         """Propagate forward through the layer.
 
@@ -160,13 +163,17 @@ class LogisticLayer(TopLayer):
                             'does not match number of inputs to this layer (%d)' %
                              (input_data.shape[1], self.W.shape[0]))
 
-        activations = linalg.dot(input_data, self.W)
+        # Only training passes use the workspace
+        activations = linalg.dot(input_data, self.W,
+            target=self._buffer('activations', (input_data.shape[0], self.n_out))
+            if not prediction else None)
         activations = add_vec_to_mat(activations, self.b, inplace=True)
 
         sigmoid(activations)
 
         return activations
 
+    @profiled
     def backprop(self, input_data, targets,
                  cache=None):
         """ Backpropagate through the logistic layer.
@@ -202,29 +209,31 @@ class LogisticLayer(TopLayer):
             raise ValueError('Activations (shape = %s) and targets (shape = %s) are different sizes' %
                              (activations.shape, targets.shape))
 
-        delta = substract_matrix(activations, targets)
+        delta = substract_matrix(activations, targets,
+                                 target=self._buffer('delta', activations.shape))
         nan_to_zeros(delta, delta)
 
+        df_W_target, df_b_target = self.gradient_targets or \
+          (self._buffer('df_W', self.W.shape), self._buffer('df_b', self.b.shape))
         # Gradient wrt weights
-        df_W = linalg.dot(input_data, delta, transa='T')
+        df_W = linalg.dot(input_data, delta, transa='T', target=df_W_target)
         # Gradient wrt bias
-        df_b = matrix_sum_out_axis(delta, 0)
+        df_b = matrix_sum_out_axis(delta, 0, target=df_b_target)
 
         # Gradient wrt input
-        df_input = linalg.dot(delta, self.W, transb='T')
+        df_input = linalg.dot(delta, self.W, transb='T',
+                              target=self._buffer('df_input', input_data.shape))
 
-        # L1 penalty
-        if self.l1_penalty_weight:
-            df_W += self.l1_penalty_weight * sign(self.W)
-
-        # L2 penalty
-        if self.l2_penalty_weight:
-            df_W += self.l2_penalty_weight * self.W
+        # L1 and L2 penalty
+        if not self.defer_weight_decay and \
+           (self.l1_penalty_weight or self.l2_penalty_weight):
+            add_weight_decay(df_W, self.W, self.l1_penalty_weight,
+                             self.l2_penalty_weight)
 
         return (df_W, df_b), df_input
 
     def test_error(self, input_data, targets, average=True,
-                   cache=None, prediction=True):
+                   cache=None, prediction=True, synchronize=True):
         """Compute the test error function given some data and targets.
 
         Uses the error function defined in
@@ -254,6 +263,11 @@ class LogisticLayer(TopLayer):
             dropout. If true, then weights are multiplied by
             1 - dropout if the layer uses dropout.
 
+        synchronize : bool, optional
+            If false, the error is returned as a scalar ``GPUArray``
+            without copying it to the host, so that errors can be
+            accumulated on the device.
+
         **Returns:**
         test_error : float
         """    
@@ -266,10 +280,10 @@ class LogisticLayer(TopLayer):
                              % self.test_error_fct)
 
         return test_error(input_data, targets, average,
-                          cache, prediction)
+                          cache, prediction, synchronize)
 
     def cross_entropy_error(self, input_data, targets, average=True,
-                            cache=None, prediction=False):
+                            cache=None, prediction=False, synchronize=True):
         """ Return the cross entropy error
         """
 
@@ -283,12 +297,12 @@ class LogisticLayer(TopLayer):
 
         if average: loss /= targets.shape[0]
         # assert np.isfinite(loss)
-        return loss.get()
+        return loss.get() if synchronize else loss
         
     train_error = cross_entropy_error
 
     def class_error(self, input_data, targets, average=True,
-                    cache=None, prediction=False):
+                    cache=None, prediction=False, synchronize=True):
         """ Return the classification error rate
         """
 
@@ -298,9 +312,8 @@ class LogisticLayer(TopLayer):
             activations = \
               self.feed_forward(input_data, prediction=prediction)
 
-        targets = targets.get()
-        class_error = np.sum((activations.get() >= .5) != (targets >= .5))
+        class_error = binary_mismatch(activations, targets)
 
-        if average: class_error = float(class_error) / targets.shape[0]
+        if average: class_error /= targets.shape[0]
 
-        return class_error
+        return class_error.get() if synchronize else class_error
@@ -14,9 +14,11 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import copy
 from .. import memory_pool
+from ..profiler import profiled
 from . import HiddenLayer, Column
-from pycuda import gpuarray
+from ..pycuda_ops import gpuarray
 import numpy as np
 from ..pycuda_ops.matrix import insert_columns, extract_columns
 from itertools import chain
@@ -24,6 +26,8 @@ from itertools import chain
 class MultiColumnLayer(HiddenLayer):
     l1_penalty_weight = True
     l2_penalty_weight = True
+    _gradient_targets = None
+    _workspace = None
 
     def __init__(self, columns, input_as_list=False):
         assert all([isinstance(c, (Column, HiddenLayer)) for c in columns])
@@ -90,6 +94,30 @@ class MultiColumnLayer(HiddenLayer):
             c.update_parameters(values[i:i+c.n_parameters])
             i += c.n_parameters
 
+    @property
+    def gradient_targets(self):
+        return self._gradient_targets
+
+    @gradient_targets.setter
+    def gradient_targets(self, value):
+        self._gradient_targets = value
+
+        i = 0
+        for c in self.columns:
+            c.gradient_targets = value[i:i+c.n_parameters] \
+                                 if value is not None else None
+            i += c.n_parameters
+
+    @property
+    def workspace(self):
+        return self._workspace
+
+    @workspace.setter
+    def workspace(self, value):
+        self._workspace = value
+        for c in self.columns:
+            c.workspace = value
+
     @property
     def l1_penalty(self):
         return sum(c.l1_penalty for c in self.columns if c.l1_penalty_weight)
@@ -113,6 +141,21 @@ class MultiColumnLayer(HiddenLayer):
             column.lr_multiplier = value[i:i+column.n_parameters]
             i += column.n_parameters
 
+    @property
+    def weight_decay(self):
+        # The columns add their weight decay to the gradients
+        # themselves, since the gradients of shared weights are summed
+        return self.n_parameters * [(0., 0.)]
+
+    def inference_layer(self, input_scale=1., fold_output=True):
+        # The columns have their own dropout rates, so they keep
+        # scaling their outputs
+        layer = copy.copy(self)
+        layer.columns = [column.inference_layer(input_scale, False)[0]
+                         for column in self.columns]
+        return layer, 1.
+
+    @profiled
     def feed_forward(self, input_data, prediction=False):
         if self.input_as_list:
             return self._feed_forward_list(input_data, prediction)
@@ -148,6 +191,7 @@ class MultiColumnLayer(HiddenLayer):
 
         return output, cache
 
+    @profiled
     def backprop(self, input_data, df_output, cache=None):
         if cache is None:
             _, cache = self.feed_forward(input_data, False)
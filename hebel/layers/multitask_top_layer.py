@@ -15,8 +15,10 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import numpy as np
+import copy
 from itertools import izip
-from pycuda import gpuarray
+from ..pycuda_ops import gpuarray
+from ..profiler import profiled
 from .top_layer import TopLayer
 from .softmax_layer import SoftmaxLayer
 
@@ -120,6 +122,10 @@ class MultitaskTopLayer(TopLayer):
                                             task_weights=task_weights)
     """
 
+    _gradient_targets = None
+    _workspace = None
+    _defer_weight_decay = False
+
     def __init__(self, n_in=None, n_out=None,
                  test_error_fct='class_error',
                  l1_penalty_weight=0., l2_penalty_weight=0.,
@@ -205,6 +211,43 @@ class MultitaskTopLayer(TopLayer):
             task.update_parameters(value[i:i + task.n_parameters])
             i += task.n_parameters
 
+    @property
+    def gradient_targets(self):
+        return self._gradient_targets
+
+    @gradient_targets.setter
+    def gradient_targets(self, value):
+        self._gradient_targets = value
+        i = 0
+        for task in self.tasks:
+            task.gradient_targets = value[i:i + task.n_parameters] \
+                                    if value is not None else None
+            i += task.n_parameters
+
+    @property
+    def workspace(self):
+        return self._workspace
+
+    @workspace.setter
+    def workspace(self, value):
+        self._workspace = value
+        for task in self.tasks:
+            task.workspace = value
+
+    @property
+    def defer_weight_decay(self):
+        return self._defer_weight_decay
+
+    @defer_weight_decay.setter
+    def defer_weight_decay(self, value):
+        self._defer_weight_decay = value
+        for task in self.tasks:
+            task.defer_weight_decay = value
+
+    @property
+    def weight_decay(self):
+        return [decay for task in self.tasks for decay in task.weight_decay]
+
     @property
     def architecture(self):
         """Returns a dictionary describing the architecture of the layer."""
@@ -220,6 +263,13 @@ class MultitaskTopLayer(TopLayer):
         """Compute the L2 penalty for all tasks."""
         return sum([task.l2_penalty for task in self.tasks])
 
+    def inference_layer(self, input_scale=1., fold_output=True):
+        layer = copy.copy(self)
+        layer.tasks = [task.inference_layer(input_scale)[0]
+                       for task in self.tasks]
+        return layer, 1.
+
+    @profiled
     def feed_forward(self, input_data, prediction=False):
         """Call ``feed_forward`` for each task and combine the activations.
 
@@ -250,6 +300,7 @@ class MultitaskTopLayer(TopLayer):
 
         return activations
 
+    @profiled
     def backprop(self, input_data, targets, cache=None):
         """Compute gradients for each task and combine the results.
 
@@ -295,7 +346,7 @@ class MultitaskTopLayer(TopLayer):
 
     def test_error(self, input_data, targets, average=True,
                    cache=None, prediction=False,
-                   sum_errors=True):
+                   sum_errors=True, synchronize=True):
         """Compute the error function on a test data set.
 
         **Parameters:**
@@ -324,6 +375,10 @@ class MultitaskTopLayer(TopLayer):
             this option is chosen, the user must make sure that all
             tasks use the same test error function.
 
+        synchronize : bool, optional
+            If false, the errors are returned as scalar ``GPUArray``
+            objects without copying them to the host.
+
         **Returns:**
         
         test_error : float or list
@@ -338,16 +393,18 @@ class MultitaskTopLayer(TopLayer):
             izip(targets, cache, self.tasks):
             test_error.append(task.test_error(input_data, targets_task,
                                               average, cache_task,
-                                              prediction))
+                                              prediction, synchronize))
 
         if sum_errors:
             return sum(test_error)
-        else:
+        elif synchronize:
             return np.array(test_error)
+        else:
+            return test_error
 
     def cross_entropy_error(self, input_data, targets, average=True,
                             cache=None, prediction=False,
-                            sum_errors=True):
+                            sum_errors=True, synchronize=True):
         """ Computes the cross-entropy error for all tasks.
         """
 
@@ -360,7 +417,8 @@ class MultitaskTopLayer(TopLayer):
             loss.append(task.cross_entropy_error(
                 input_data, targets_task, average=average,
                 cache=cache_task,
-                prediction=prediction))
+                prediction=prediction,
+                synchronize=synchronize))
 
         if sum_errors:
             return sum(loss)
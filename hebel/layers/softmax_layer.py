@@ -16,16 +16,19 @@
 
 import numpy as np
 import cPickle
-from pycuda import gpuarray
-from pycuda import cumath
+from ..pycuda_ops import gpuarray
+from ..pycuda_ops import cumath
 from math import sqrt
 from .. import sampler, memory_pool
+from ..profiler import profiled
 from .top_layer import TopLayer
 from ..pycuda_ops import eps, linalg
-from ..pycuda_ops.elementwise import sign, nan_to_zeros, substract_matrix
-from ..pycuda_ops.reductions import matrix_sum_out_axis
+from ..pycuda_ops.elementwise import nan_to_zeros, substract_matrix, \
+     add_weight_decay, substract_labels
+from ..pycuda_ops.reductions import matrix_sum_out_axis, argmax_mismatch, \
+     argmax_mismatch_labels
 from ..pycuda_ops.matrix import add_vec_to_mat
-from ..pycuda_ops.softmax import softmax, cross_entropy
+from ..pycuda_ops.softmax import softmax, cross_entropy, cross_entropy_labels
 
 
 class SoftmaxLayer(TopLayer):
@@ -71,6 +74,14 @@ class SoftmaxLayer(TopLayer):
         ``kl_error``, the Kullback-Leibler divergence, or
         ``cross_entropy_error``.
 
+    Instead of one-hot encoded targets, the targets may also be given
+    as a vector of ``int32`` class labels (of shape ``(N,)`` or
+    ``(N, 1)``). The gradients and errors are then computed by
+    indexing the activations with the labels, which saves the memory
+    and the transfer of the one-hot matrix. Examples with a negative
+    label are ignored, like examples with ``NaN`` targets in the
+    one-hot encoding.
+
     **See also:**
 
     :class:`hebel.layers.LogisticLayer`,
@@ -133,12 +144,36 @@ class SoftmaxLayer(TopLayer):
         self.lr_multiplier = 2 * [1. / np.sqrt(n_in, dtype=np.float32)] \
           if lr_multiplier is None else lr_multiplier
 
+    @staticmethod
+    def _is_labels(targets):
+        """ Whether ``targets`` are integer class labels """
+        if targets.dtype.kind not in 'iu':
+            return False
+        if targets.dtype != np.int32:
+            raise ValueError('Class labels must be int32, not %s' %
+                             targets.dtype)
+        return True
+
+    def _check_targets(self, activations, targets):
+        if self._is_labels(targets):
+            if targets.size != activations.shape[0]:
+                raise ValueError('Expected one class label for each of the '
+                                 '%d examples, got targets of shape %s' %
+                                 (activations.shape[0], targets.shape))
+            return True
+
+        if activations.shape != targets.shape:
+            raise ValueError('Activations (shape = %s) and targets (shape = %s) are different sizes' %
+                             (activations.shape, targets.shape))
+        return False
+
     @property
     def architecture(self):
         return {'class': self.__class__,
                 'n_in': self.n_in,
                 'n_out': self.n_out}
 
+    @profiled
     def feed_forward(self, input_data, prediction=False):
         """Propagate forward through the layer.
 
@@ -163,12 +198,16 @@ class SoftmaxLayer(TopLayer):
                             'does not match number of inputs to this layer (%d)' %
                              (input_data.shape[1], self.W.shape[0]))
 
-        lin_activations = linalg.dot(input_data, self.W)
+        # Only training passes use the workspace
+        lin_activations = linalg.dot(input_data, self.W,
+            target=self._buffer('lin_activations', (input_data.shape[0], self.n_out))
+            if not prediction else None)
         lin_activations = add_vec_to_mat(lin_activations, self.b, inplace=True)
         activations = softmax(lin_activations)
 
         return activations
 
+    @profiled
     def backprop(self, input_data, targets,
                  cache=None):
         """ Backpropagate through the logistic layer.
@@ -179,7 +218,7 @@ class SoftmaxLayer(TopLayer):
             Inpute data to compute activations for.
 
         targets : ``GPUArray``
-            The target values of the units.
+            The target values of the units or the class labels.
 
         cache : list of ``GPUArray``
             Cache obtained from forward pass. If the cache is
@@ -200,33 +239,36 @@ class SoftmaxLayer(TopLayer):
         else:
             activations = self.feed_forward(input_data, prediction=False)
 
-        if activations.shape != targets.shape:
-            raise ValueError('Activations (shape = %s) and targets (shape = %s) are different sizes' %
-                             (activations.shape, targets.shape))
-
-        delta = substract_matrix(activations, targets)
-        nan_to_zeros(delta, delta)
+        delta_buffer = self._buffer('delta', activations.shape)
+        if self._check_targets(activations, targets):
+            delta = substract_labels(activations, targets,
+                                     target=delta_buffer)
+        else:
+            delta = substract_matrix(activations, targets,
+                                     target=delta_buffer)
+            nan_to_zeros(delta, delta)
 
+        df_W_target, df_b_target = self.gradient_targets or \
+          (self._buffer('df_W', self.W.shape), self._buffer('df_b', self.b.shape))
         # Gradient wrt weights
-        df_W = linalg.dot(input_data, delta, transa='T')
+        df_W = linalg.dot(input_data, delta, transa='T', target=df_W_target)
         # Gradient wrt bias
-        df_b = matrix_sum_out_axis(delta, 0)
+        df_b = matrix_sum_out_axis(delta, 0, target=df_b_target)
 
         # Gradient wrt input
-        df_input = linalg.dot(delta, self.W, transb='T')
-
-        # L1 penalty
-        if self.l1_penalty_weight:
-            df_W += self.l1_penalty_weight * sign(self.W)
+        df_input = linalg.dot(delta, self.W, transb='T',
+                              target=self._buffer('df_input', input_data.shape))
 
-        # L2 penalty
-        if self.l2_penalty_weight:
-            df_W += self.l2_penalty_weight * self.W
+        # L1 and L2 penalty
+        if not self.defer_weight_decay and \
+           (self.l1_penalty_weight or self.l2_penalty_weight):
+            add_weight_decay(df_W, self.W, self.l1_penalty_weight,
+                             self.l2_penalty_weight)
 
         return (df_W, df_b), df_input
 
     def test_error(self, input_data, targets, average=True,
-                   cache=None, prediction=True):
+                   cache=None, prediction=True, synchronize=True):
         """Compute the test error function given some data and targets.
 
         Uses the error function defined in
@@ -256,6 +298,11 @@ class SoftmaxLayer(TopLayer):
             dropout. If true, then weights are multiplied by
             1 - dropout if the layer uses dropout.
 
+        synchronize : bool, optional
+            If false, the error is returned as a scalar ``GPUArray``
+            without copying it to the host, so that errors can be
+            accumulated on the device.
+
         **Returns:**
         test_error : float
         """    
@@ -270,10 +317,10 @@ class SoftmaxLayer(TopLayer):
                              % self.test_error_fct)
 
         return test_error(input_data, targets, average,
-                          cache, prediction)
+                          cache, prediction, synchronize)
 
     def cross_entropy_error(self, input_data, targets, average=True,
-                            cache=None, prediction=False):
+                            cache=None, prediction=False, synchronize=True):
         """ Return the cross entropy error
         """
 
@@ -283,15 +330,18 @@ class SoftmaxLayer(TopLayer):
             activations = \
               self.feed_forward(input_data, prediction=prediction)
 
-        loss = cross_entropy(activations, targets)
+        if self._check_targets(activations, targets):
+            loss = cross_entropy_labels(activations, targets)
+        else:
+            loss = cross_entropy(activations, targets)
 
         if average: loss /= targets.shape[0]
-        return loss.get()
+        return loss.get() if synchronize else loss
         
     train_error = cross_entropy_error
 
     def class_error(self, input_data, targets, average=True,
-                    cache=None, prediction=False):
+                    cache=None, prediction=False, synchronize=True):
         """ Return the classification error rate
         """
 
@@ -301,17 +351,24 @@ class SoftmaxLayer(TopLayer):
             activations = \
               self.feed_forward(input_data, prediction=prediction)
 
-        targets = targets.get().argmax(1)
-        class_error = np.sum(activations.get().argmax(1) != targets)
+        if self._check_targets(activations, targets):
+            class_error = argmax_mismatch_labels(activations, targets)
+        else:
+            class_error = argmax_mismatch(activations, targets)
 
-        if average: class_error = float(class_error) / targets.shape[0]
-        return class_error
+        if average: class_error /= targets.shape[0]
+        return class_error.get() if synchronize else class_error
 
     def kl_error(self, input_data, targets, average=True,
-                 cache=None, prediction=True):
+                 cache=None, prediction=True, synchronize=True):
         """ The KL divergence error
         """
 
+        if self._is_labels(targets):
+            # The entropy of one-hot targets is zero
+            return self.cross_entropy_error(input_data, targets, average,
+                                            cache, prediction, synchronize)
+
         if cache is not None:
             activations = cache
         else:
@@ -325,4 +382,4 @@ class SoftmaxLayer(TopLayer):
                                  cumath.log(activations + eps)))
         if average:
             kl_error /= targets.shape[0]
-        return kl_error.get()
+        return kl_error.get() if synchronize else kl_error
@@ -21,3 +21,4 @@ class TopLayer(HiddenLayer):
     """Abstract base class for a top-level layer."""
     
     n_tasks = 1
+    dropout = 0.
@@ -2,6 +2,22 @@ class Model(object):
     """ Abstract base-class for a Hebel model
     """
 
+    # Contiguous parameter and gradient buffers, if the model
+    # supports them (see :meth:`hebel.models.NeuralNet.flatten_parameters`)
+    flat_parameters = None
+    flat_gradients = None
+    flat_lr_multiplier = None
+    flat_weight_decay = None
+
+    # Whether backpropagation leaves out the gradients of the L1 and
+    # L2 penalties, because the parameter updater applies them (see
+    # :attr:`hebel.models.NeuralNet.weight_decay`)
+    defer_weight_decay = False
+
+    # Reusable buffers for training passes, if the model supports
+    # them (see :meth:`hebel.models.NeuralNet.use_workspace`)
+    workspace = None
+
     def __init__(self):
         raise NotImplementedError
 
@@ -16,6 +32,21 @@ class Model(object):
     def update_parameters(self, value):
         raise NotImplementedError
 
+    @property
+    def weight_decay(self):
+        """ The L1 and L2 penalty weights that the parameter updater
+        has to apply to each parameter
+        """
+
+        return len(self.parameters) * [(0., 0.)]
+
+    def clear_inference_cache(self):
+        """ Discards the copies of the parameters that are kept for
+        prediction, if the model keeps any
+        """
+
+        pass
+
     def evaluate(self, input_data, targets,
                  return_cache=False, prediction=True):
         """ Evaluate the loss function without computing gradients
@@ -40,3 +71,9 @@ class Model(object):
         """
 
         raise NotImplementedError
+
+    def predict(self, data, batch_size=1000, out=None):
+        """ Compute predictions batch by batch
+        """
+
+        raise NotImplementedError
@@ -16,9 +16,15 @@
 
 import numpy as np
 from hashlib import md5
-from pycuda import gpuarray
+from itertools import izip
+from .. import memory_pool
+from ..pycuda_ops import gpuarray
+from ..workspace import Workspace
+from ..data_providers import DataProvider
+from ..pycuda_ops.matrix import copy_array
 from ..layers import HiddenLayer, TopLayer, SoftmaxLayer, LogisticLayer, InputDropout
 from .model import Model
+from ..profiler import section
 
 
 class NeuralNet(Model):
@@ -97,6 +103,10 @@ class NeuralNet(Model):
 
     TopLayerClass = SoftmaxLayer
 
+    # Layers for prediction, see inference_layers
+    _inference_cache = None
+    _defer_weight_decay = False
+
     def __init__(self, layers, top_layer=None, activation_function='sigmoid',
                  dropout=0., input_dropout=0., n_in=None, n_out=None,
                  l1_penalty_weight=0., l2_penalty_weight=0.,
@@ -150,13 +160,19 @@ class NeuralNet(Model):
                 self.hidden_layers.append(hidden_layer)
             elif isinstance(hidden_layer, int):
                 n_in_hidden = self.hidden_layers[-1].n_units if self.hidden_layers else n_in
+                # The gradients wrt the input data are never used
+                below = self.hidden_layers[-1] if self.hidden_layers else None
+                compute_input_gradients = below is not None and \
+                    (not isinstance(below, InputDropout) or
+                     below.compute_input_gradients)
                 self.hidden_layers.append(
                     HiddenLayer(
                         n_in_hidden, hidden_layer,
                         activation_function,
                         dropout=dropout[i],
                         l1_penalty_weight=self.l1_penalty_weight_hidden[i],
-                        l2_penalty_weight=self.l2_penalty_weight_hidden[i]))
+                        l2_penalty_weight=self.l2_penalty_weight_hidden[i],
+                        compute_input_gradients=compute_input_gradients))
 
         self.n_units_hidden = [hl.n_units for hl in self.hidden_layers]
 
@@ -206,6 +222,18 @@ class NeuralNet(Model):
                              "Model has %d parameters, but got %d" %
                              (self.n_parameters, len(value)))
 
+        self.clear_inference_cache()
+
+        if self.flat_parameters is not None:
+            # Keep the parameters in the flat buffer
+            for param, new_param in izip(self.parameters, value):
+                if not isinstance(new_param, gpuarray.GPUArray):
+                    new_param = gpuarray.to_gpu(
+                        np.asarray(new_param, param.dtype),
+                        allocator=memory_pool.allocate)
+                copy_array(new_param, param)
+            return
+
         i = 0
         for hl in self.hidden_layers:
             hl.parameters = value[i:i + hl.n_parameters]
@@ -230,8 +258,39 @@ class NeuralNet(Model):
 
         self.top_layer.lr_multiplier = value[i:i+self.top_layer.n_parameters]
 
+        if self.flat_parameters is not None:
+            self._make_flat_lr_multiplier()
+
+    @property
+    def defer_weight_decay(self):
+        """ Whether backpropagation leaves the gradients of the L1
+        and L2 penalties out, so that the parameter updater can add
+        them in the same pass over memory as the update. The weights
+        that the updater has to apply are given by
+        :attr:`weight_decay` and, for flat parameters, by
+        ``flat_weight_decay``. This is set by the parameter updater.
+        """
+
+        return self._defer_weight_decay
+
+    @defer_weight_decay.setter
+    def defer_weight_decay(self, value):
+        self._defer_weight_decay = value
+        for hl in self.hidden_layers:
+            hl.defer_weight_decay = value
+        self.top_layer.defer_weight_decay = value
+
+        if self.flat_parameters is not None:
+            self._make_flat_weight_decay()
+
+    @property
+    def weight_decay(self):
+        return [decay for hl in self.hidden_layers + [self.top_layer]
+                for decay in hl.weight_decay]
+
     def update_parameters(self, value):
         assert len(value) == self.n_parameters
+        self.clear_inference_cache()
 
         i = 0
         for hl in self.hidden_layers:
@@ -240,6 +299,148 @@ class NeuralNet(Model):
 
         self.top_layer.update_parameters(value[-self.top_layer.n_parameters:])
 
+    def flatten_parameters(self):
+        """ Moves all parameters of the model into a single
+        contiguous buffer.
+
+        Afterwards, the parameters of every layer are views into
+        ``flat_parameters`` and backpropagation writes the gradients
+        into views of ``flat_gradients``. ``flat_lr_multiplier``
+        holds the learning rate multiplier for every element and
+        ``flat_weight_decay`` the L1 and L2 penalty weights that the
+        updater applies to every element (see
+        :attr:`defer_weight_decay`), or ``None``. The
+        parameter updaters use these buffers to update all
+        parameters with a few vector operations, independently of
+        the number of layers.
+
+        Call this before creating the optimizer.
+        """
+
+        parameters = self.parameters
+        assert all(p.dtype == np.float32 for p in parameters)
+        offsets = np.cumsum([0] + [p.size for p in parameters])
+
+        self.flat_parameters = gpuarray.empty((int(offsets[-1]),), np.float32,
+                                              allocator=memory_pool.allocate)
+        self.flat_gradients = gpuarray.zeros((int(offsets[-1]),), np.float32,
+                                             allocator=memory_pool.allocate)
+
+        views = self._flat_views(self.flat_parameters, parameters, offsets)
+        for param, view in izip(parameters, views):
+            copy_array(param, view)
+
+        # Assign the views with the parameter setters of the layers
+        flat_parameters = self.flat_parameters
+        self.flat_parameters = None
+        self.parameters = views
+        self.flat_parameters = flat_parameters
+
+        self.gradient_views = self._flat_views(self.flat_gradients,
+                                               parameters, offsets)
+        i = 0
+        for hl in self.hidden_layers:
+            hl.gradient_targets = self.gradient_views[i:i + hl.n_parameters]
+            i += hl.n_parameters
+        self.top_layer.gradient_targets = self.gradient_views[i:]
+
+        self._make_flat_lr_multiplier()
+        self._make_flat_weight_decay()
+
+    def use_workspace(self, batch_size=None):
+        """ Makes the layers keep their activations, deltas and
+        gradients in a :class:`hebel.workspace.Workspace`, so that
+        they are allocated once and reused in every training pass
+        instead of being allocated for every mini-batch.
+
+        The arrays returned by :meth:`training_pass` are overwritten
+        by the next training pass. Predictions are not affected.
+
+        **Parameters:**
+
+        batch_size : integer, optional
+            If given, all buffers for mini-batches of this size are
+            allocated right away with a training pass on zeros, so
+            the memory use (``workspace.nbytes``) is known before
+            training starts. Otherwise, the buffers are allocated in
+            the first training pass. A smaller last mini-batch gets
+            its own set of buffers.
+
+        **Returns:**
+
+        workspace : :class:`hebel.workspace.Workspace`
+        """
+
+        self.workspace = Workspace()
+        for hl in self.hidden_layers:
+            hl.workspace = self.workspace
+        self.top_layer.workspace = self.workspace
+
+        if batch_size is not None:
+            if not np.isscalar(self.n_out):
+                raise ValueError("Can only plan the workspace for models "
+                                 "with a single output")
+            input_data = gpuarray.zeros((batch_size, self.n_in), np.float32,
+                                        allocator=memory_pool.allocate)
+            targets = gpuarray.zeros((batch_size, self.n_out), np.float32,
+                                     allocator=memory_pool.allocate)
+            self.training_pass(input_data, targets)
+
+        return self.workspace
+
+    @staticmethod
+    def _flat_views(flat_buffer, parameters, offsets):
+        return [flat_buffer[start:stop].reshape(p.shape)
+                for p, start, stop in izip(parameters, offsets[:-1], offsets[1:])]
+
+    def _make_flat_lr_multiplier(self):
+        lr_multiplier = np.concatenate(
+            [np.repeat(np.float32(lr), p.size)
+             for lr, p in izip(self.lr_multiplier, self.parameters)])
+        self.flat_lr_multiplier = gpuarray.to_gpu(lr_multiplier,
+                                                  allocator=memory_pool.allocate)
+
+    def _make_flat_weight_decay(self):
+        weight_decay = self.weight_decay
+        if not any(l1 or l2 for l1, l2 in weight_decay):
+            self.flat_weight_decay = None
+            return
+
+        flat_weight_decay = []
+        for i in (0, 1):
+            penalty_weight = np.concatenate(
+                [np.repeat(np.float32(decay[i]), p.size)
+                 for decay, p in izip(weight_decay, self.parameters)])
+            flat_weight_decay.append(
+                gpuarray.to_gpu(penalty_weight,
+                                allocator=memory_pool.allocate))
+        self.flat_weight_decay = tuple(flat_weight_decay)
+
+    def __getstate__(self):
+        # The views into the flat buffers don't survive pickling and
+        # are set up again when unpickling
+        state = self.__dict__.copy()
+        state.pop('_inference_cache', None)
+        if self.flat_parameters is not None:
+            for key in ('flat_parameters', 'flat_gradients',
+                        'flat_lr_multiplier', 'flat_weight_decay',
+                        'gradient_views'):
+                state.pop(key, None)
+            state['_flatten_parameters'] = True
+        return state
+
+    def __setstate__(self, state):
+        # Flattening copies the parameters into a new buffer, so a
+        # flattened model loaded with load_model doesn't keep its
+        # parameters in the memory map
+        flatten = state.pop('_flatten_parameters', False)
+        self.__dict__.update(state)
+        # The weight decay is only left to the updater that asks for
+        # it, which isn't restored with the model
+        self.defer_weight_decay = False
+        if flatten:
+            self.flatten_parameters()
+
     def checksum(self):
         """ Returns an MD5 digest of the model.
 
@@ -327,35 +528,47 @@ class NeuralNet(Model):
             Gradients obtained from backpropagation in the backward pass.
         """
 
+        # The parameters are about to be updated
+        self.clear_inference_cache()
+
         # Forward pass
-        loss, hidden_cache, logistic_cache = self.evaluate(
-            input_data, targets, return_cache=True, prediction=False)
+        with section('forward'):
+            loss, hidden_cache, logistic_cache = self.evaluate(
+                input_data, targets, return_cache=True, prediction=False)
 
         if not np.isfinite(loss):
             raise ValueError('Infinite activations!')
 
         # Backpropagation
-        if self.hidden_layers:
-            hidden_activations = hidden_cache[-1][0]
-        else:
-            hidden_activations = input_data
+        with section('backward'):
+            if self.hidden_layers:
+                hidden_activations = hidden_cache[-1][0]
+            else:
+                hidden_activations = input_data
 
-        df_top_layer = \
-          self.top_layer.backprop(hidden_activations, targets,
-                                  cache=logistic_cache)
-        gradients = list(df_top_layer[0][::-1])
-        df_hidden = df_top_layer[1]
+            df_top_layer = \
+              self.top_layer.backprop(hidden_activations, targets,
+                                      cache=logistic_cache)
+            gradients = list(df_top_layer[0][::-1])
+            df_hidden = df_top_layer[1]
 
-        if self.hidden_layers:
-            hidden_inputs = [input_data] + [c[0] for c in hidden_cache[:-1]]            
-            for hl, hc, hi in \
-                zip(self.hidden_layers[::-1], hidden_cache[::-1],
-                    hidden_inputs[::-1]):
-                g, df_hidden = hl.backprop(hi, df_hidden, cache=hc)
-                gradients.extend(g[::-1])
+            if self.hidden_layers:
+                hidden_inputs = [input_data] + [c[0] for c in hidden_cache[:-1]]
+                for hl, hc, hi in \
+                    zip(self.hidden_layers[::-1], hidden_cache[::-1],
+                        hidden_inputs[::-1]):
+                    g, df_hidden = hl.backprop(hi, df_hidden, cache=hc)
+                    gradients.extend(g[::-1])
 
         gradients.reverse()
 
+        if self.flat_parameters is not None:
+            # Copy gradients of layers that don't support gradient_targets
+            for gparam, gview in izip(gradients, self.gradient_views):
+                if gparam is not gview:
+                    copy_array(gparam, gview)
+            gradients = self.gradient_views
+
         return loss, gradients
 
     def test_error(self, test_data, average=True):
@@ -375,22 +588,20 @@ class NeuralNet(Model):
         test_error : float
         """
 
-        test_error = 0.
+        # The errors are accumulated on the device and only copied to
+        # the host once the whole data set has been evaluated
+        hidden_layers, top_layer = self.inference_layers()
+        test_error = gpuarray.zeros((), np.float64)
         for batch_data, batch_targets in test_data:
-            _, hidden_cache, logistic_cache = \
-              self.evaluate(batch_data, batch_targets,
-                            return_cache=True,
-                            prediction=True)
-
-            if self.hidden_layers:
-                hidden_activations = hidden_cache[-1]
-            else:
-                hidden_activations = batch_data
-
-            test_error += self.top_layer.test_error(hidden_activations,
-                                                    batch_targets, average=False,
-                                                    cache=logistic_cache,
-                                                    prediction=True)
+            activations = self._inference_pass(batch_data, hidden_layers,
+                                               top_layer)
+            batch_error = top_layer.test_error(None, batch_targets,
+                                               average=False,
+                                               cache=activations,
+                                               prediction=True,
+                                               synchronize=False)
+            test_error._axpbyz(1., batch_error, 1., test_error)
+        test_error = float(test_error.get())
 
         if average: test_error /= float(test_data.N)
 
@@ -422,6 +633,10 @@ class NeuralNet(Model):
             Results of intermediary computations.    
         """
 
+        if not return_cache:
+            return self._inference_pass(input_data, self.hidden_layers,
+                                        self.top_layer, prediction)
+
         hidden_cache = None     # Create variable in case there are no hidden layers
         if self.hidden_layers:
             # Forward pass
@@ -441,12 +656,147 @@ class NeuralNet(Model):
         # Use dropout_predict if last hidden layer has dropout
         activations = \
           self.top_layer.feed_forward(hidden_activations,
-                                      prediction=False)
+                                      prediction=prediction)
 
         if return_cache:
             return activations, hidden_cache
         return activations
 
+    def inference_layers(self):
+        """ Returns copies of the layers for prediction, in which the
+        ``1 - dropout`` scaling of each layer's outputs is folded
+        into the weights of the next layer, see
+        :meth:`hebel.layers.HiddenLayer.inference_layer`.
+
+        The copies share all other parameters with the model. They
+        are cached, so that repeated calls to :meth:`predict` and
+        :meth:`test_error` (e.g. in every validation epoch) don't
+        copy the weights again, until the next :meth:`training_pass`
+        or change of the parameters through :attr:`parameters` or
+        :meth:`update_parameters`. After changing the parameters in
+        place in any other way, call :meth:`clear_inference_cache`.
+
+        **Returns:**
+
+        hidden_layers : list
+            Copies of the hidden layers. Layers that don't do
+            anything in prediction mode are left out.
+
+        top_layer : :class:`hebel.layers.TopLayer`
+            Copy of the top layer.
+        """
+
+        if self._inference_cache is None:
+            hidden_layers = []
+            scale = 1.
+            for hl in self.hidden_layers:
+                hl, scale = hl.inference_layer(scale)
+                if hl is not None:
+                    hidden_layers.append(hl)
+            top_layer, _ = self.top_layer.inference_layer(scale)
+            self._inference_cache = hidden_layers, top_layer
+        return self._inference_cache
+
+    def clear_inference_cache(self):
+        """ Discards the layers cached by :meth:`inference_layers`,
+        so that they are recreated from the current parameters.
+        """
+
+        self._inference_cache = None
+
+    @staticmethod
+    def _inference_pass(input_data, hidden_layers, top_layer,
+                        prediction=True):
+        # Only the activations of the current layer are referenced,
+        # so each intermediate result is freed as soon as the next
+        # layer has consumed it
+        activations = input_data
+        for hl in hidden_layers:
+            activations = hl.feed_forward(activations,
+                                          prediction=prediction)[0]
+        return top_layer.feed_forward(activations, prediction=prediction)
+
+    def predict(self, data, batch_size=1000, out=None):
+        """ Compute predictions in prediction mode, one batch at a time.
+
+        Batches are run through the network without keeping any
+        caches or dropout masks and the predictions of each batch are
+        copied into ``out`` as soon as they are computed, so that only
+        one batch of activations is ever held on the device.
+
+        **Parameters:**
+
+        data : ``DataProvider``, ``GPUArray``, or ``numpy.ndarray``
+            The data to compute predictions for. If a
+            :class:`hebel.data_providers.DataProvider` is given, its
+            batches are used (and its targets ignored), otherwise the
+            array is split into batches of ``batch_size`` rows. The
+            data provider must not shuffle the data.
+
+        batch_size : integer, optional
+            Number of rows per batch when ``data`` is an array.
+
+        out : ``numpy.ndarray`` or string, optional
+            Array to write the predictions into. If a string is given,
+            it is taken as the path of a ``.npy`` file that the
+            predictions are written to through a memory map. By
+            default, a new array is allocated.
+
+        **Returns:**
+
+        predictions : ``numpy.ndarray``
+            The predictions, with one row per example (``out`` if it
+            was given, or a ``numpy.memmap`` if ``out`` is a path).
+        """
+
+        if isinstance(data, DataProvider):
+            if getattr(data, 'shuffle', False):
+                raise ValueError("Can't predict from a shuffled data provider")
+            N = data.N
+            batches = (batch_data for batch_data, _ in data)
+        else:
+            N = data.shape[0]
+            batches = self._array_batches(data, batch_size)
+
+        hidden_layers, top_layer = self.inference_layers()
+
+        # Allocated up front, so that empty input gives an empty array
+        shape = (N, top_layer.n_out)
+        if out is None:
+            out = np.empty(shape, np.float32)
+        elif isinstance(out, basestring):
+            out = np.lib.format.open_memmap(
+                out, mode='w+', dtype=np.float32, shape=shape)
+
+        start = 0
+        for batch_data in batches:
+            prediction = self._inference_pass(batch_data, hidden_layers,
+                                              top_layer)
+            stop = start + prediction.shape[0]
+
+            chunk = out[start:stop]
+            if chunk.dtype == prediction.dtype and chunk.flags.c_contiguous:
+                prediction.get(ary=chunk)
+            else:
+                chunk[...] = prediction.get()
+            start = stop
+
+        if start != N:
+            raise ValueError("Got %d predictions for %d examples" % (start, N))
+
+        if isinstance(out, np.memmap):
+            out.flush()
+        return out
+
+    @staticmethod
+    def _array_batches(data, batch_size):
+        for i in range(0, data.shape[0], batch_size):
+            batch_data = data[i:i+batch_size]
+            if not isinstance(batch_data, gpuarray.GPUArray):
+                batch_data = gpuarray.to_gpu(
+                    np.ascontiguousarray(batch_data, np.float32))
+            yield batch_data
+
     def calibrate_learning_rate(self, data_provider, mini_batches=None):
         lr_multiplier = []
         for i, (data, targets) in enumerate(data_provider):
@@ -22,19 +22,332 @@ shell.
 """
 
 import numpy as np
-import time, cPickle, os, sys
+import time, cPickle, os, sys, json
+import threading
+from collections import deque
+from Queue import Queue
 from datetime import datetime
+from .utils.serial import dumps_model
+from .profiler import Tracer, section
+from . import memory_pool
+
+
+class CheckpointWriter(object):
+    """ Writes pickled models to disk in a background thread.
+
+    :meth:`save` pickles the model into memory on the calling thread,
+    which copies the parameters from the device, and queues the
+    result. The worker thread writes it to a temporary file and
+    renames it to its final name, so a checkpoint file is either
+    complete or doesn't exist. At most ``max_in_flight`` checkpoints
+    are held in memory; :meth:`save` blocks until a write has
+    finished if there are more.
+
+    :param max_in_flight: Maximum number of checkpoints that are
+        waiting to be written.
+    :param keep_last: Number of checkpoints to keep for each
+        ``group`` passed to :meth:`save`. Older checkpoints are
+        deleted. If this is ``None``, all checkpoints are kept.
+    :param serialize: Function that serializes the model into a
+        string. By default, the model is pickled.
+    """
+
+    _thread = None
+    _error = None
+
+    def __init__(self, max_in_flight=2, keep_last=None, serialize=None):
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+        self.keep_last = keep_last
+        self.serialize = serialize if serialize is not None else \
+            (lambda obj: cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL))
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._queue = Queue()
+        self._written = {}
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._write_checkpoints)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _check_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error[0], error[1], error[2]
+
+    def save(self, obj, path, group=None):
+        """ Pickle ``obj`` and write it to ``path`` in the background.
+
+        :param obj: The object to save, usually the model.
+        :param path: The path of the checkpoint file.
+        :param group: If ``keep_last`` is set, only the most recent
+            ``keep_last`` checkpoints saved with the same ``group``
+            are kept.
+        """
+
+        self._check_error()
+        # Wait for a slot before serializing, so that no more than
+        # max_in_flight serialized checkpoints exist at a time
+        self._in_flight.acquire()
+        try:
+            with section('checkpoint_serialize', 'checkpoint'):
+                data = self.serialize(obj)
+        except:
+            self._in_flight.release()
+            raise
+
+        if self._thread is None:
+            self._start()
+        self._queue.put((data, path, group))
+
+    def _write_checkpoints(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+
+            data, path, group = item
+            try:
+                with section('checkpoint_write', 'checkpoint'):
+                    self._write(data, path)
+                if group is not None and self.keep_last is not None:
+                    self._remove_old(path, group)
+            except:
+                self._error = sys.exc_info()
+            finally:
+                del data, item
+                self._in_flight.release()
+                self._queue.task_done()
+
+    @staticmethod
+    def _write(data, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+
+    def _remove_old(self, path, group):
+        written = self._written.setdefault(group, deque())
+        if path in written:
+            written.remove(path)
+        written.append(path)
+        while len(written) > self.keep_last:
+            old_path = written.popleft()
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+    def flush(self):
+        """ Wait until all checkpoints are written and raise any error
+        that occured while writing them.
+        """
+
+        if self._thread is not None:
+            self._queue.join()
+        self._check_error()
+
+    def close(self):
+        """ Write all pending checkpoints and stop the worker thread. """
+
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._check_error()
+
+
+class TrainingMetrics(object):
+    """ Collects the throughput and the step latencies of one epoch
+    of training for the progress monitors.
+
+    :meth:`hebel.optimizers.SGD.run` reports every training step
+    through the ``report_step`` method of the progress monitor. For
+    each step, it measures how long it waited for the data provider
+    and how long the forward and backward pass and the parameter
+    update took. On the GPU, the step time includes waiting for the
+    kernels of the previous step to finish.
+    """
+
+    percentiles = (50, 95, 99)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.n_examples = 0
+        self.data_t = []
+        self.step_t = []
+
+    def add_step(self, n_examples, data_t, step_t):
+        self.n_examples += n_examples
+        self.data_t.append(data_t)
+        self.step_t.append(step_t)
+
+    def summary(self, epoch):
+        """ Returns the metrics of the epoch as a dictionary and resets
+        the statistics.
+        """
+
+        data_t = sum(self.data_t)
+        compute_t = sum(self.step_t)
+        train_t = max(data_t + compute_t, 1e-12)
+        metrics = {
+            'epoch': epoch,
+            'examples': self.n_examples,
+            'batches': len(self.step_t),
+            'examples_per_second': self.n_examples / train_t,
+            'batches_per_second': len(self.step_t) / train_t,
+            'data_wait_seconds': data_t,
+            'compute_seconds': compute_t
+        }
+
+        if self.step_t:
+            latencies = np.percentile(self.step_t, self.percentiles)
+        else:
+            latencies = len(self.percentiles) * [0.]
+        for p, latency in zip(self.percentiles, latencies):
+            metrics['step_latency_p%d_seconds' % p] = float(latency)
+
+        for name in ('active_blocks', 'held_blocks',
+                     'active_bytes', 'managed_bytes'):
+            try:
+                metrics['memory_pool_' + name] = getattr(memory_pool, name)
+            except (AttributeError, RuntimeError):
+                # Older PyCUDA versions don't count bytes
+                pass
+
+        self.reset()
+        return metrics
+
+    @staticmethod
+    def format(metrics):
+        """ Formats the metrics as a line for the log. """
+        s = '%.1f examples/s, %.2f batches/s, step latency ' \
+            'p50/p95/p99: %.1f/%.1f/%.1f ms, data wait: %.2fs, ' \
+            'compute: %.2fs' % (
+                metrics['examples_per_second'], metrics['batches_per_second'],
+                1e3 * metrics['step_latency_p50_seconds'],
+                1e3 * metrics['step_latency_p95_seconds'],
+                1e3 * metrics['step_latency_p99_seconds'],
+                metrics['data_wait_seconds'], metrics['compute_seconds'])
+        if 'memory_pool_active_blocks' in metrics:
+            s += ', memory pool: %d active/%d held blocks' % \
+                 (metrics['memory_pool_active_blocks'],
+                  metrics['memory_pool_held_blocks'])
+        return s
+
+    @staticmethod
+    def write(metrics, path, format='jsonl'):
+        """ Writes the metrics to a file.
+
+        :param metrics: A dictionary from :meth:`summary`.
+        :param path: The path of the metrics file.
+        :param format: ``jsonl`` appends the metrics to ``path`` as a
+            line of JSON. ``prometheus`` replaces ``path`` with the
+            metrics in the Prometheus text format, e.g. for the
+            textfile collector of the node exporter.
+        """
+
+        if format == 'jsonl':
+            with open(path, 'a') as f:
+                f.write(json.dumps(metrics, sort_keys=True) + '\n')
+        elif format == 'prometheus':
+            lines = []
+            for name, value in sorted(metrics.iteritems()):
+                if name.startswith('step_latency_'):
+                    continue
+                lines.append('# TYPE hebel_%s gauge' % name)
+                lines.append('hebel_%s %r' % (name, value))
+            lines.append('# TYPE hebel_step_latency_seconds summary')
+            for p in TrainingMetrics.percentiles:
+                lines.append('hebel_step_latency_seconds{quantile="%g"} %r' %
+                             (p / 100., metrics['step_latency_p%d_seconds' % p]))
+
+            # Replace the file atomically, so it is never read half-written
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.rename(tmp_path, path)
+        else:
+            raise ValueError('Unknown metrics format "%s"' % format)
+
 
 class ProgressMonitor(object):
+    """ Reports the progress of training and saves checkpoints of
+    the model to ``save_model_path``.
+
+    Checkpoints are written in the background by a
+    :class:`CheckpointWriter`, so the training thread only waits for
+    the model to be pickled into memory.
+
+    **Parameters:**
+
+    save_interval : integer, optional
+        Save a checkpoint every ``save_interval`` epochs. If this is
+        omitted, the best model so far is saved whenever the
+        validation error improves.
+
+    keep_last : integer, optional
+        Number of periodic checkpoints to keep. Older checkpoints
+        are deleted. By default, all checkpoints are kept.
+
+    keep_best : bool, optional
+        Also save the best model so far when using
+        ``save_interval`` and keep it after training.
+
+    max_in_flight : integer, optional
+        Maximum number of checkpoints that are waiting to be
+        written before training blocks.
+
+    checkpoint_format : {``pickle``, ``binary``}, optional
+        Whether to pickle the checkpoints (``.pkl`` files) or to use
+        the binary model format of :func:`hebel.utils.serial.save_model`
+        (``.hbm`` files), which can be loaded with
+        :func:`hebel.utils.serial.load_model`.
+
+    metrics_format : {``jsonl``, ``prometheus``}, optional
+        If given, the throughput and latency metrics of every epoch
+        (see :class:`TrainingMetrics`) are also written to
+        ``metrics.jsonl`` or ``metrics.prom`` in the output directory.
+    """
+
+    log = None
+    profiler = None
+    checkpoint_writer = None
+
     def __init__(self, experiment_name=None, save_model_path=None,
                  save_interval=None, output_to_log=False, 
-                 model=None, make_subdir=True):
+                 model=None, make_subdir=True,
+                 keep_last=None, keep_best=False, max_in_flight=2,
+                 checkpoint_format='pickle', metrics_format=None):
 
         self.experiment_name = experiment_name
         self.save_model_path = save_model_path
         self.save_interval = save_interval
         self.output_to_log = output_to_log
         self.model = model
+        self.keep_best = keep_best
+
+        if checkpoint_format == 'pickle':
+            serialize = None
+            self._checkpoint_ext = 'pkl'
+        elif checkpoint_format == 'binary':
+            serialize = dumps_model
+            self._checkpoint_ext = 'hbm'
+        else:
+            raise ValueError('Unknown checkpoint format "%s"'
+                             % checkpoint_format)
+
+        if metrics_format not in (None, 'jsonl', 'prometheus'):
+            raise ValueError('Unknown metrics format "%s"' % metrics_format)
+        self.metrics_format = metrics_format
+
+        self.checkpoint_writer = CheckpointWriter(max_in_flight, keep_last,
+                                                  serialize)
+        self.metrics = TrainingMetrics()
+        self.epoch_metrics = []
 
         self.train_error = []
         self.validation_error = []
@@ -97,6 +410,9 @@ class ProgressMonitor(object):
     def start_training(self):
         self.start_time = datetime.now()
 
+    def report_step(self, n_examples, data_t, step_t):
+        self.metrics.add_step(n_examples, data_t, step_t)
+
     def report(self, epoch, train_error, validation_error=None,
                new_best=None, epoch_t=None):
         # Print logs
@@ -105,6 +421,16 @@ class ProgressMonitor(object):
             self.validation_error.append((epoch, validation_error))
         self.print_error(epoch, train_error, validation_error, new_best)
 
+        if self.metrics.step_t:
+            metrics = self.metrics.summary(epoch)
+            self.epoch_metrics.append(metrics)
+            self.print_('  ' + TrainingMetrics.format(metrics))
+            if self.metrics_format is not None:
+                ext = 'jsonl' if self.metrics_format == 'jsonl' else 'prom'
+                TrainingMetrics.write(
+                    metrics, os.path.join(self.save_path, 'metrics.' + ext),
+                    self.metrics_format)
+
         if epoch_t is not None:
             self.avg_epoch_t = ((epoch - 1) * \
                                 self.avg_epoch_t + epoch_t) / epoch \
@@ -113,15 +439,19 @@ class ProgressMonitor(object):
         # Pickle model
         if self.save_interval is not None:
             if not epoch % self.save_interval:
-                filename = 'model_%s_epoch%04d.pkl' % (
+                filename = 'model_%s_epoch%04d.%s' % (
                   self.experiment_name,
-                  epoch)
+                  epoch, self._checkpoint_ext)
                 path = os.path.join(self.save_path, filename)
-                cPickle.dump(self.model, open(path, 'wb'))
-        elif new_best is not None and new_best:
-            filename = 'model_%s_current_best.pkl' % self.experiment_name
-            path = os.path.join(self.save_path, filename)
-            cPickle.dump(self.model, open(path, 'wb'))
+                self.checkpoint_writer.save(self.model, path, group='epoch')
+        if new_best and (self.save_interval is None or self.keep_best):
+            self.checkpoint_writer.save(self.model, self._current_best_path)
+
+    @property
+    def _current_best_path(self):
+        filename = 'model_%s_current_best.%s' % (self.experiment_name,
+                                                 self._checkpoint_ext)
+        return os.path.join(self.save_path, filename)
 
     def print_error(self, epoch, train_error, validation_error=None, new_best=None):
         if validation_error is not None:
@@ -156,21 +486,45 @@ class ProgressMonitor(object):
         self.print_("Avg. time per epoch %.2fs" % self.avg_epoch_t)
 
         # Pickle model
-        filename = 'model_%s_final.pkl' % self.experiment_name
+        filename = 'model_%s_final.%s' % (self.experiment_name,
+                                          self._checkpoint_ext)
         path = os.path.join(self.save_path, filename)
         self.print_("Saving model to %s" % path)
-        cPickle.dump(self.model, open(path, 'wb'))
-        if self.save_interval is None:
-            os.remove(os.path.join(
-                self.save_path, 'model_%s_current_best.pkl' % self.experiment_name))
+        self.checkpoint_writer.save(self.model, path)
+        self.checkpoint_writer.close()
+        if self.save_interval is None and \
+           os.path.exists(self._current_best_path):
+            os.remove(self._current_best_path)
+
+        if self.profiler is not None:
+            self.print_(self.profiler.report())
+            self.profiler.dump(os.path.join(self.save_path, 'profile.json'))
+            if isinstance(self.profiler, Tracer):
+                self.profiler.dump_trace(
+                    os.path.join(self.save_path, 'trace.json'))
 
     def __del__(self):
-        if self.output_to_log:
+        # __init__ may have failed before the writer or log was created
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.close()
+        if self.log is not None:
             self.log.close()
 
 
 class SimpleProgressMonitor(object):
-    def __init__(self, model=None):
+    """ Prints the progress of training.
+
+    :param model: The model that is trained.
+    :param metrics_path: If given, the throughput and latency metrics
+        of every epoch (see :class:`TrainingMetrics`) are written to
+        this file.
+    :param metrics_format: ``jsonl`` or ``prometheus``, see
+        :meth:`TrainingMetrics.write`.
+    """
+
+    profiler = None
+
+    def __init__(self, model=None, metrics_path=None, metrics_format='jsonl'):
         self.model = model
 
         self.train_error = []
@@ -178,9 +532,19 @@ class SimpleProgressMonitor(object):
         self.avg_epoch_t = None
         self._time = datetime.now().strftime('%Y-%m-%dT%H-%M-%S')
 
+        if metrics_format not in ('jsonl', 'prometheus'):
+            raise ValueError('Unknown metrics format "%s"' % metrics_format)
+        self.metrics_path = metrics_path
+        self.metrics_format = metrics_format
+        self.metrics = TrainingMetrics()
+        self.epoch_metrics = []
+
     def start_training(self):
         self.start_time = datetime.now()
 
+    def report_step(self, n_examples, data_t, step_t):
+        self.metrics.add_step(n_examples, data_t, step_t)
+
     def report(self, epoch, train_error, validation_error=None,
                new_best=None, epoch_t=None):
         self.train_error.append((epoch, train_error))
@@ -190,6 +554,14 @@ class SimpleProgressMonitor(object):
         # Print logs
         self.print_error(epoch, train_error, validation_error, new_best)
 
+        if self.metrics.step_t:
+            metrics = self.metrics.summary(epoch)
+            self.epoch_metrics.append(metrics)
+            print '  ' + TrainingMetrics.format(metrics)
+            if self.metrics_path is not None:
+                TrainingMetrics.write(metrics, self.metrics_path,
+                                      self.metrics_format)
+
         if epoch_t is not None and epoch > 0:
             self.avg_epoch_t = ((epoch - 1) * \
                                 self.avg_epoch_t + epoch_t) / epoch \
@@ -227,16 +599,23 @@ class SimpleProgressMonitor(object):
         print "Runtime: %dm %ds" % (self.train_time.total_seconds() // 60,
                                     self.train_time.total_seconds() % 60)
         print "Avg. time per epoch %.2fs" % self.avg_epoch_t
+        if self.profiler is not None:
+            print self.profiler.report()
         sys.stdout.flush()
 
 
 class DummyProgressMonitor(object):
+    profiler = None
+
     def __init__(self, model=None):
         self.model = model
 
     def start_training(self):
         pass
 
+    def report_step(self, n_examples, data_t, step_t):
+        pass
+
     def report(self, epoch, train_error, validation_error=None,
                new_best=None, epoch_t=None):
         pass
@@ -20,46 +20,85 @@ algorithm we have in online stochastic gradient descent (SGD).
 """
 
 import numpy as np
-import time, cPickle, sys, os, inspect
-from .pycuda_ops.matrix import vector_normalize
+import time, sys
+from itertools import izip
+from .pycuda_ops import gpuarray
+from .pycuda_ops.matrix import vector_normalize, copy_array
 from .schedulers import constant_scheduler
 from .monitors import SimpleProgressMonitor, DummyProgressMonitor
 from . import memory_pool
-from pycuda._driver import MemoryError
+from .profiler import section
+try:
+    from pycuda._driver import MemoryError
+except ImportError:
+    # Running without PyCUDA on the CPU backend
+    pass
 
 
 class EarlyStoppingModule(object):
+    """ Keeps a snapshot of the parameters with the lowest validation
+    loss and restores them at the end of training.
+
+    The snapshot buffers are allocated on the device the first time
+    the validation loss improves and every later improvement is a
+    device-to-device copy. If there isn't enough device memory for
+    the snapshot, it is kept in host memory instead.
+    """
+
     def __init__(self, model, verbose):
         self.model = model
         self.best_validation_loss = np.inf
         self.verbose = verbose
+        self.best_parameters = None
+
+    def _allocate_snapshot(self):
+        parameters = self.model.parameters
+        try:
+            return [gpuarray.empty(p.shape, p.dtype,
+                                   allocator=memory_pool.allocate)
+                    for p in parameters]
+        except MemoryError:
+            memory_pool.free_held()
+
+        try:
+            return [gpuarray.empty(p.shape, p.dtype,
+                                   allocator=memory_pool.allocate)
+                    for p in parameters]
+        except MemoryError:
+            return [np.empty(p.shape, p.dtype) for p in parameters]
 
     def update(self, epoch, validation_loss):
         if validation_loss < self.best_validation_loss:
             self.best_validation_loss = validation_loss
-            try:
-                del self.best_model
-            except AttributeError:
-                pass
 
-            try:
-                self.best_model = cPickle.dumps(self.model)
-            except MemoryError:
-                memory_pool.free_held()
-                self.best_model = cPickle.dumps(self.model)
+            if self.best_parameters is None:
+                self.best_parameters = self._allocate_snapshot()
+
+            for param, snapshot in izip(self.model.parameters,
+                                        self.best_parameters):
+                if isinstance(snapshot, gpuarray.GPUArray):
+                    copy_array(param, snapshot)
+                else:
+                    param.get(ary=snapshot)
 
-            # assert self.best_model[0] is not self.model.parameters[0]
             self.best_epoch = epoch
             return True
         return False
 
     def finish(self):
-        # self.model.parameters = self.best_model
-        try:
-            self.model = cPickle.loads(self.best_model)
-        except AttributeError:
-            # Training has not yet reached the first validation epoch, so there is no self.best_model
+        if self.best_parameters is None:
+            # Training has not yet reached the first validation epoch,
+            # so there is no snapshot
             return
+
+        for param, snapshot in izip(self.model.parameters,
+                                    self.best_parameters):
+            if isinstance(snapshot, gpuarray.GPUArray):
+                copy_array(snapshot, param)
+            else:
+                param.set(snapshot)
+        self.model.clear_inference_cache()
+
         if self.verbose:
             print "Optimization complete. " \
                   "Best validation error of %.5g obtained in self.epoch %d" % \
@@ -79,9 +118,22 @@ class SGD(object):
                  learning_rate_schedule=constant_scheduler(.1),
                  momentum_schedule=None,
                  early_stopping=True,
-                 verbose=True):
+                 verbose=True,
+                 profiler=None,
+                 stop_condition=None):
 
         """ Stochastic gradient descent
+
+        If a :class:`hebel.profiler.Profiler` is given as
+        ``profiler``, it runs during training and the progress
+        monitor prints its report at the end. Pass a
+        :class:`hebel.profiler.Tracer` to record a timeline of the
+        training steps.
+
+        ``stop_condition`` is an optional function that is called as
+        ``stop_condition(epoch, progress_monitor)`` after every
+        validation and ends training early when it returns true, e.g.
+        :class:`hebel.sweep.MedianStoppingRule`.
         """
 
         ### Initialization
@@ -121,7 +173,13 @@ class SGD(object):
         if self.progress_monitor.model is None:
             self.progress_monitor.model = self.model
 
+        self.profiler = profiler
+        if profiler is not None and \
+           getattr(self.progress_monitor, 'profiler', None) is None:
+            self.progress_monitor.profiler = profiler
+
         self.early_stopping = early_stopping
+        self.stop_condition = stop_condition
         self.verbose = verbose
         self.epoch = 0
 
@@ -139,6 +197,13 @@ class SGD(object):
         self.progress_monitor.task_id = task_id
         self.progress_monitor.yaml_config = yaml_config
 
+        if self.profiler is not None:
+            self.profiler.start()
+
+        # Progress monitors written before report_step existed only
+        # report epochs
+        report_step = getattr(self.progress_monitor, 'report_step', None)
+
         # Main loop
         for self.epoch in range(self.epoch + 1, self.epoch + iterations + 1):
             learning_parameters = map(lambda lp: lp.next(),
@@ -151,24 +216,39 @@ class SGD(object):
                 # Train on mini-batches
                 train_loss = 0.
 
-                for batch_idx, (batch_data, batch_targets) in \
-                  enumerate(self.train_data):
+                batches = iter(self.train_data)
+                while True:
+                    t_data = time.time()
+                    with section('data'):
+                        try:
+                            batch_data, batch_targets = batches.next()
+                        except StopIteration:
+                            break
+                    t_step = time.time()
                     batch_size = self.train_data.batch_size
 
-                    self.parameter_updater.pre_gradient_update()
+                    with section('update'):
+                        self.parameter_updater.pre_gradient_update()
 
                     batch_loss, gradients = \
                         self.model.training_pass(batch_data, batch_targets)
                     train_loss += batch_loss
-                    self.parameter_updater\
-                      .post_gradient_update(gradients, batch_size,
-                                            learning_parameters)
+
+                    with section('update'):
+                        self.parameter_updater\
+                          .post_gradient_update(gradients, batch_size,
+                                                learning_parameters)
+
+                    if report_step is not None:
+                        report_step(batch_data.shape[0], t_step - t_data,
+                                    time.time() - t_step)
 
                 # Evaluate on validation data
                 if self.validation_data is not None and \
                    not self.epoch % validation_interval:
-                    validation_loss_rate = self.model.test_error(
-                        self.validation_data)
+                    with section('validation'):
+                        validation_loss_rate = self.model.test_error(
+                            self.validation_data)
                     # validation_loss = 0.
                     # for batch_idx, (batch_data, batch_targets) in \
                     #   enumerate(self.validation_data):
@@ -190,6 +270,13 @@ class SGD(object):
                                                  validation_loss_rate,
                                                  new_best,
                                                  epoch_t=epoch_t)
+
+                    if self.stop_condition is not None and \
+                       self.stop_condition(self.epoch, self.progress_monitor):
+                        if self.verbose:
+                            print "Stopping training early in epoch %d" % \
+                                self.epoch
+                        break
                 else:
                     epoch_t = time.time() - t
                     self.progress_monitor.report(self.epoch, train_loss,
@@ -199,9 +286,11 @@ class SGD(object):
                 print "Keyboard interrupt. Stopping training and cleaning up."
                 keyboard_interrupt = True
 
+        if self.profiler is not None:
+            self.profiler.stop()
+
         if self.early_stopping_module is not None:
             self.early_stopping_module.finish()
-            # self.model = self.early_stopping_module.model
 
         self.progress_monitor.finish_training()
 
@@ -213,3 +302,4 @@ class SGD(object):
             for w in self.model.parameters:
                 if len(w.shape) == 2:
                     vector_normalize(w, self.max_vec_norm)
+            self.model.clear_inference_cache()
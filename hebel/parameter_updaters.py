@@ -19,13 +19,20 @@ such as momentum and Nesterov momentum.
 
 """
 
-from pycuda import gpuarray
+from .pycuda_ops import gpuarray
+from .pycuda_ops.elementwise import sgd_update, momentum_update, \
+    nesterov_update
 from itertools import izip
 
 
 class ParameterUpdater(object):
+    # Whether ``post_gradient_update`` applies the L1 and L2 weight
+    # decay, so that backpropagation can leave it out of the gradients
+    applies_weight_decay = False
+
     def __init__(self, model):
         self.model = model
+        model.defer_weight_decay = self.applies_weight_decay
 
     def pre_gradient_update(self, stream=None):
         pass
@@ -33,68 +40,75 @@ class ParameterUpdater(object):
     def post_gradient_update(self, gradients, stream=None):
         pass
 
+    def _flat_weight_decay(self):
+        return self.model.flat_weight_decay or (0., 0.)
+
 
 class SimpleSGDUpdate(ParameterUpdater):
+    applies_weight_decay = True
+
     def post_gradient_update(self, gradients, batch_size,
                              learning_parameters,
                              stream=None):
         learning_rate = learning_parameters[0]
 
-        multiplier = [-lr_mult * learning_rate / batch_size for lr_mult in
-                      self.model.lr_multiplier]
-        update = zip(gradients, multiplier)
-        self.model.update_parameters(update)
+        if self.model.flat_parameters is not None:
+            l1, l2 = self._flat_weight_decay()
+            sgd_update(self.model.flat_parameters, self.model.flat_gradients,
+                       -learning_rate / batch_size,
+                       self.model.flat_lr_multiplier, l1, l2)
+            return
+
+        for param, gparam, lr_multiplier, (l1, l2) in \
+          izip(self.model.parameters, gradients,
+               self.model.lr_multiplier, self.model.weight_decay):
+            sgd_update(param, gparam,
+                       -learning_rate * lr_multiplier / batch_size,
+                       l1_penalty_weight=l1, l2_penalty_weight=l2)
 
 
 class MomentumUpdate(ParameterUpdater):
+    applies_weight_decay = True
+
     def __init__(self, model):
-        self.model = model
-        self.velocity = [gpuarray.zeros_like(p)
-                         for p in self.model.parameters]
+        super(MomentumUpdate, self).__init__(model)
+        if self.model.flat_parameters is not None:
+            self.velocity = gpuarray.zeros_like(self.model.flat_parameters)
+        else:
+            self.velocity = [gpuarray.zeros_like(p)
+                             for p in self.model.parameters]
+
+    # Fused kernel that applies the weight decay and updates the
+    # velocity and the parameters
+    update_kernel = staticmethod(momentum_update)
 
     def post_gradient_update(self, gradients, batch_size,
                              learning_parameters, stream=None):
         learning_rate, momentum = learning_parameters
 
-        updates = []
-        for gparam, vparam, lr_multiplier in \
-            izip(gradients, self.velocity, self.model.lr_multiplier):
-            vparam._axpbyz(momentum,
-                           gparam, -learning_rate * lr_multiplier / batch_size,
-                           vparam, stream=stream)
-            updates.append((vparam, 1.))
-        self.model.update_parameters(updates)
+        if self.model.flat_parameters is not None:
+            l1, l2 = self._flat_weight_decay()
+            self.update_kernel(self.model.flat_parameters, self.velocity,
+                               self.model.flat_gradients, momentum,
+                               -learning_rate / batch_size,
+                               self.model.flat_lr_multiplier, l1, l2)
+            return
 
+        for param, gparam, vparam, lr_multiplier, (l1, l2) in \
+          izip(self.model.parameters, gradients, self.velocity,
+               self.model.lr_multiplier, self.model.weight_decay):
+            self.update_kernel(param, vparam, gparam, momentum,
+                               -learning_rate * lr_multiplier / batch_size,
+                               l1_penalty_weight=l1, l2_penalty_weight=l2)
 
-class NesterovMomentumUpdate(MomentumUpdate):
-    def pre_gradient_update(self):
-        """ First step of Nesterov momentum method:
-        take step in direction of accumulated gradient
-        """
 
-        updates = zip(self.velocity, self.model.n_parameters * [1.])
-        self.model.update_parameters(updates)
-
-    def post_gradient_update(self, gradients, batch_size,
-                             learning_parameters, stream=None):
-        """ Second step of Nesterov momentum method:
-        take step in direction of new gradient and update velocity
-        """
-
-        learning_rate, momentum = learning_parameters
-
-        updates = []
-        for param, gparam, vparam, lr_multiplier in \
-          izip(self.model.parameters, gradients,
-              self.velocity, self.model.lr_multiplier):
-
-            updates.append(
-                (gparam, -learning_rate * lr_multiplier / batch_size))
-            # param -= learning_rate*lr_multiplier/batch_size*gparam
-            # param._axpbyz(1., gparam, -learning_rate*lr_multiplier/batch_size,
-            #               param, stream=stream)
-            # vparam = momentum*vparam \
-            #    - learning_rate*lr_multiplier/batch_size*gparam
-            vparam._axpbyz(momentum, gparam, -learning_rate*lr_multiplier/batch_size,
-                           vparam, stream=stream)
-        self.model.update_parameters(updates)
+class NesterovMomentumUpdate(MomentumUpdate):
+    """ Nesterov momentum in the look-ahead form: the parameters are
+    kept at the point ``param + momentum * velocity`` at which the
+    gradient is computed, so every step is a single pass over memory
+    in ``post_gradient_update`` (see
+    :func:`hebel.pycuda_ops.elementwise.nesterov_update`) and no
+    step is needed before the gradient.
+    """
+
+    update_kernel = staticmethod(nesterov_update)
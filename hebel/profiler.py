@@ -0,0 +1,266 @@
+# Copyright (C) 2013  Hannes Bretschneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+""" An opt-in profiler that records how much time goes into each
+operation in :mod:`hebel.pycuda_ops`, each layer's ``feed_forward``
+and ``backprop`` and the phases of :meth:`hebel.optimizers.SGD.run`
+(loading data, the parameter update and validation).
+
+Pass a :class:`Profiler` to :class:`hebel.optimizers.SGD` and the
+progress monitor prints the report at the end of training, or use
+it directly::
+
+    profiler = Profiler()
+    with profiler:
+        model.training_pass(data, targets)
+    print profiler.report()
+
+The times of nested calls are inclusive, e.g. the time of
+``HiddenLayer.feed_forward`` includes the time of ``linalg.dot``. On
+the GPU, the device is synchronized after every call, so that the
+times include the kernels that a call launched. When no profiler is
+running, the hooks only check a global variable.
+
+A :class:`Tracer` additionally records every call and section as a
+span on a timeline, including the work of the prefetching and
+checkpoint writer threads, and writes it in the Trace Event Format
+that ``chrome://tracing`` and Perfetto can display.
+"""
+
+import os
+import json
+import time
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+# The running profiler, if any
+_active = None
+
+
+def profiled(method):
+    """ Decorator for layer methods that reports the calls to the
+    running profiler as ``<layer class>.<method>``.
+    """
+
+    name = method.__name__
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if _active is None:
+            return method(self, *args, **kwargs)
+        return _active.call('%s.%s' % (self.__class__.__name__, name),
+                            method, (self,) + args, kwargs, 'layer')
+    return wrapper
+
+
+def _arrays(obj):
+    if isinstance(obj, (tuple, list)):
+        for x in obj:
+            for array in _arrays(x):
+                yield array
+    elif hasattr(obj, 'nbytes') and hasattr(obj, 'shape'):
+        yield obj
+
+
+def _new_bytes(result, args, kwargs):
+    """ Bytes of the arrays returned by a call that weren't passed in,
+    e.g. as ``target``.
+    """
+
+    inputs = set(id(x) for x in _arrays(list(args) + kwargs.values()))
+    return sum(x.nbytes for x in _arrays(result) if id(x) not in inputs)
+
+
+class Profiler(object):
+    """ Records the number of calls, the wall time and the bytes of
+    newly allocated results for every profiled operation, layer
+    method and section.
+
+    **Parameters:**
+
+    synchronize : bool, optional
+        Whether to wait for the device to finish after every call, so
+        that the times include the kernels that were
+        launched. Without synchronization, the times on the GPU only
+        measure how long it takes to launch the kernels.
+    """
+
+    def __init__(self, synchronize=True):
+        self.synchronize = synchronize
+        self.stats = {}
+        self._thread = None
+
+    def start(self):
+        """ Make this the running profiler. """
+        global _active
+        self._thread = threading.current_thread()
+        _active = self
+
+    def stop(self):
+        global _active
+        if _active is self:
+            _active = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def reset(self):
+        self.stats = {}
+
+    def _synchronize(self):
+        from . import backend, context
+        # Only the thread that started the profiler owns the context
+        if self.synchronize and backend == 'gpu' and \
+           threading.current_thread() is self._thread:
+            context.synchronize()
+
+    def record(self, name, duration, nbytes=0, start=None, category=None):
+        """ Add a call to ``name`` to the statistics. """
+        try:
+            stats = self.stats[name]
+        except KeyError:
+            stats = self.stats[name] = [0, 0., 0]
+        stats[0] += 1
+        stats[1] += duration
+        stats[2] += nbytes
+
+    def call(self, name, func, args, kwargs, category=None):
+        """ Call ``func`` and record the call as ``name``. """
+        t = time.time()
+        result = func(*args, **kwargs)
+        self._synchronize()
+        self.record(name, time.time() - t, _new_bytes(result, args, kwargs),
+                    t, category)
+        return result
+
+    @contextmanager
+    def section(self, name, category='phase'):
+        """ Context manager that records the time spent in its block
+        as ``name``.
+        """
+        t = time.time()
+        yield
+        self._synchronize()
+        self.record(name, time.time() - t, start=t, category=category)
+
+    def summary(self):
+        """ Returns the statistics as a list of dictionaries, sorted by
+        total time.
+        """
+        return [{'name': name, 'calls': calls, 'time': total_time,
+                 'bytes': nbytes}
+                for name, (calls, total_time, nbytes) in
+                sorted(self.stats.iteritems(), key=lambda x: -x[1][1])]
+
+    def report(self):
+        """ Returns the statistics as a table, sorted by total time. """
+        lines = ['%-40s %8s %10s %10s %10s' %
+                 ('Name', 'Calls', 'Total [s]', 'Mean [ms]', 'Alloc [MB]')]
+        for entry in self.summary():
+            lines.append('%-40s %8d %10.3f %10.3f %10.1f' % (
+                entry['name'], entry['calls'], entry['time'],
+                1e3 * entry['time'] / entry['calls'],
+                entry['bytes'] / 2. ** 20))
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        """ Writes the statistics to ``path`` as JSON. """
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=1)
+
+
+class Tracer(Profiler):
+    """ A :class:`Profiler` that also records a span for every call
+    and section, so the timeline of training can be inspected, e.g. to
+    see whether data loading overlaps with computation.
+
+    Use :meth:`dump_trace` to write the spans to a JSON file that can
+    be opened in ``chrome://tracing`` or https://ui.perfetto.dev. When
+    a ``Tracer`` is passed to :class:`hebel.optimizers.SGD`,
+    :class:`hebel.monitors.ProgressMonitor` writes the trace to
+    ``trace.json`` at the end of training.
+
+    **Parameters:**
+
+    synchronize : bool, optional
+        See :class:`Profiler`.
+    """
+
+    def __init__(self, synchronize=True):
+        super(Tracer, self).__init__(synchronize)
+        self.reset()
+
+    def reset(self):
+        super(Tracer, self).reset()
+        self.events = []
+        self._thread_names = {}
+        self._t0 = time.time()
+
+    def record(self, name, duration, nbytes=0, start=None, category=None):
+        super(Tracer, self).record(name, duration, nbytes)
+        if start is None:
+            return
+
+        thread = threading.current_thread()
+        tid = thread.ident
+        if tid not in self._thread_names:
+            self._thread_names[tid] = thread.name
+
+        event = {'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+                 'ts': 1e6 * (start - self._t0), 'dur': 1e6 * duration}
+        if category is not None:
+            event['cat'] = category
+        if nbytes:
+            event['args'] = {'bytes': nbytes}
+        self.events.append(event)
+
+    def trace(self):
+        """ Returns the trace as a dictionary in the Trace Event Format. """
+        pid = os.getpid()
+        metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                     'tid': tid, 'args': {'name': name}}
+                    for tid, name in self._thread_names.iteritems()]
+        return {'traceEvents': metadata + self.events,
+                'displayTimeUnit': 'ms'}
+
+    def dump_trace(self, path):
+        """ Writes the trace to ``path`` as JSON. """
+        with open(path, 'w') as f:
+            json.dump(self.trace(), f)
+
+
+class _NullSection(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_null_section = _NullSection()
+
+
+def section(name, category='phase'):
+    """ Context manager that records the time spent in the block as
+    ``name`` if a profiler is running and does nothing otherwise.
+    """
+    if _active is None:
+        return _null_section
+    return _active.section(name, category)
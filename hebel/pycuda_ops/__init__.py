@@ -14,18 +14,89 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import sys
 import numpy as np
+from functools import wraps
+from importlib import import_module
+from .. import profiler
 eps = np.finfo(np.float32).eps
 
-def init():
-    from . import elementwise
-    from . import matrix
-    from . import reductions
-    from . import softmax
-    from . import linalg
-
-    elementwise.init()
-    matrix.init()
-    reductions.init()
-    # softmax.init()
-    linalg.init()
\ No newline at end of file
+# NumPy implementations of the ops, set by ``init`` when running on
+# the CPU backend
+_cpu_ops = None
+
+# Modules whose kernels have been compiled
+_initialized_modules = set()
+
+def _init_module(module_name):
+    module = sys.modules[module_name]
+    if hasattr(module, 'init'):
+        module.init()
+    _initialized_modules.add(module_name)
+
+def cpu_dispatch(func):
+    """ Routes calls to the function of the same name in
+    :mod:`hebel.pycuda_ops.cpu` when Hebel runs on the CPU backend.
+
+    On the GPU, the first call to an op of a module runs the module's
+    ``init`` function, which compiles its kernels or loads cuBLAS, so
+    that none of that happens before an op is actually needed.
+
+    The calls are also reported to the running
+    :class:`hebel.profiler.Profiler`, if any.
+    """
+
+    name = func.__name__
+    module_name = func.__module__
+    profile_name = '%s.%s' % (module_name.rsplit('.', 1)[-1], name)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if _cpu_ops is not None:
+            impl = getattr(_cpu_ops, name)
+        else:
+            if module_name not in _initialized_modules:
+                _init_module(module_name)
+            impl = func
+        if profiler._active is not None:
+            return profiler._active.call(profile_name, impl, args, kwargs,
+                                         'op')
+        return impl(*args, **kwargs)
+    return wrapper
+
+
+class _ArrayModule(object):
+    """ Stands in for ``pycuda.gpuarray`` or ``pycuda.cumath`` and
+    forwards to :mod:`hebel.pycuda_ops.cpuarray` instead when running
+    on the CPU backend.
+    """
+
+    def __init__(self, gpu_module_name):
+        self._gpu_module_name = gpu_module_name
+        self._module = None
+        self._module_is_cpu = None
+
+    def __getattr__(self, name):
+        is_cpu = _cpu_ops is not None
+        if self._module is None or self._module_is_cpu != is_cpu:
+            self._module = import_module('hebel.pycuda_ops.cpuarray') \
+                if is_cpu else import_module(self._gpu_module_name)
+            self._module_is_cpu = is_cpu
+        return getattr(self._module, name)
+
+gpuarray = _ArrayModule('pycuda.gpuarray')
+cumath = _ArrayModule('pycuda.cumath')
+
+def init(backend='gpu'):
+    global _cpu_ops
+
+    if backend == 'cpu':
+        from . import cpu
+        _cpu_ops = cpu
+        return
+    elif backend != 'gpu':
+        raise ValueError('Unknown backend "%s", must be "gpu" or "cpu"'
+                         % backend)
+
+    # The kernels of each module are compiled by the first call to
+    # one of its ops (see ``cpu_dispatch``)
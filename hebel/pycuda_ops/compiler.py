@@ -0,0 +1,122 @@
+# Copyright (C) 2013  Hannes Bretschneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+""" Compiles CUDA kernels and caches the binaries on disk, so that a
+new process can load its kernels without running ``nvcc``.
+
+The cache is keyed by a hash of the source, the compiler options and
+the architecture of the device. It is kept in the directory given by
+the environment variable ``HEBEL_KERNEL_CACHE`` or in
+``~/.cache/hebel/kernels``. Setting ``HEBEL_KERNEL_CACHE`` to an
+empty string disables the cache.
+"""
+
+import os
+import errno
+import hashlib
+import tempfile
+
+
+def kernel_cache_dir():
+    """ Returns the directory of the kernel cache or ``None`` if the
+    cache is disabled.
+    """
+
+    path = os.environ.get('HEBEL_KERNEL_CACHE')
+    if path is None:
+        cache_home = os.environ.get('XDG_CACHE_HOME',
+                                    os.path.join(os.path.expanduser('~'),
+                                                 '.cache'))
+        path = os.path.join(cache_home, 'hebel', 'kernels')
+    return path or None
+
+
+def cache_key(source, arch, options=None, no_extern_c=False):
+    """ Hash of everything that determines the compiled binary. """
+    h = hashlib.sha1()
+    h.update(repr((source, arch, tuple(options or ()), bool(no_extern_c))))
+    return h.hexdigest()
+
+
+def compile_cached(source, arch, compile, options=None, no_extern_c=False,
+                   cache_dir=None):
+    """ Returns the binary for ``source`` from the cache, or compiles it
+    with ``compile(source, options=options, arch=arch,
+    no_extern_c=no_extern_c)`` and stores the result in the cache.
+
+    :param source: The CUDA source code.
+    :param arch: The architecture of the device, e.g. ``sm_35``.
+    :param compile: The function that compiles the source, usually
+        :func:`pycuda.compiler.compile`.
+    :param options: Options for ``nvcc``.
+    :param no_extern_c: Whether to omit wrapping the source in
+        ``extern "C"``.
+    :param cache_dir: The directory of the cache. Defaults to
+        :func:`kernel_cache_dir`.
+    """
+
+    if cache_dir is None:
+        cache_dir = kernel_cache_dir()
+    if cache_dir is None:
+        return compile(source, options=options, arch=arch,
+                       no_extern_c=no_extern_c)
+
+    path = os.path.join(cache_dir, arch,
+                        cache_key(source, arch, options, no_extern_c) +
+                        '.cubin')
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    binary = compile(source, options=options, arch=arch,
+                     no_extern_c=no_extern_c)
+
+    # Several processes may compile the same kernel at the same time,
+    # so the binary is written to a temporary file and renamed
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(binary)
+    os.rename(tmp_path, path)
+    return binary
+
+
+def device_arch():
+    """ Returns the architecture of the current device, e.g. ``sm_35``. """
+    from pycuda import driver
+    return 'sm_%d%d' % driver.Context.get_device().compute_capability()
+
+
+def source_module(source, options=None, no_extern_c=False):
+    """ Replacement for :class:`pycuda.compiler.SourceModule` that
+    uses the on-disk kernel cache.
+    """
+
+    from pycuda import driver, compiler
+    binary = compile_cached(
+        source, device_arch(),
+        lambda *args, **kwargs: compiler.compile(*args, cache_dir=False,
+                                                 **kwargs),
+        options, no_extern_c)
+    return driver.module_from_buffer(binary)
@@ -0,0 +1,412 @@
+# Copyright (C) 2013  Hannes Bretschneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+""" NumPy implementations of the operations in
+:mod:`hebel.pycuda_ops`. They take the same arguments as their CUDA
+counterparts and are dispatched to automatically when Hebel is
+initialized with ``backend='cpu'``. Matrix products go through
+``numpy.dot`` and use whatever BLAS NumPy is linked against.
+"""
+
+import numpy as np
+from . import eps
+from .cpuarray import CPUArray, empty, empty_like, to_cpuarray
+from .. import sampler
+
+
+def _target(target, shape, dtype):
+    if target is None:
+        return empty(shape, dtype)
+    assert target.shape == shape
+    return target
+
+
+### linalg
+
+def dot(x_gpu, y_gpu, transa='N', transb='N', handle=None, target=None):
+    if len(x_gpu.shape) == 1 and len(y_gpu.shape) == 1:
+        if x_gpu.size != y_gpu.size:
+            raise ValueError('arrays must be of same length: '
+                             'x_gpu.size = %d, y_gpu.size = %d' %
+                             (x_gpu.size, y_gpu.size))
+        return np.dot(x_gpu, y_gpu)
+
+    x = x_gpu if len(x_gpu.shape) > 1 else x_gpu.reshape((1, x_gpu.shape[0]))
+    y = y_gpu if len(y_gpu.shape) > 1 else y_gpu.reshape((1, y_gpu.shape[0]))
+
+    transa = transa.lower()
+    transb = transb.lower()
+    if transa not in ('n', 't', 'c'):
+        raise ValueError('invalid value "%s" for transa' % transa)
+    if transb not in ('n', 't', 'c'):
+        raise ValueError('invalid value "%s" for transb' % transb)
+
+    if transa != 'n': x = x.T
+    if transb != 'n': y = y.T
+
+    if x.shape[1] != y.shape[0]:
+        raise ValueError('objects are not aligned: x_shape = %s, y_shape = %s' %
+                         (x_gpu.shape, y_gpu.shape))
+
+    if target is None:
+        return to_cpuarray(np.dot(x, y))
+
+    # GEMM writes into the target buffer, reshape 1D targets
+    out = target.reshape((x.shape[0], y.shape[1]))
+    np.dot(x, y, out=out)
+    return target
+
+
+### elementwise
+
+def sign(x, target=None):
+    target = _target(target, x.shape, x.dtype)
+    np.sign(x, out=target)
+    return target
+
+def sigmoid(x):
+    np.negative(x, out=x)
+    np.exp(x, out=x)
+    x += 1.
+    np.reciprocal(x, out=x)
+
+def df_sigmoid(f, target=None):
+    target = _target(target, f.shape, f.dtype)
+    np.subtract(1., f, out=target)
+    target *= f
+    return target
+
+def tanh(x):
+    np.tanh(x, out=x)
+
+def df_tanh(f, target=None):
+    target = _target(target, f.shape, f.dtype)
+    np.square(f, out=target)
+    np.subtract(1., target, out=target)
+    return target
+
+def relu(x):
+    np.maximum(x, 0., out=x)
+
+def df_relu(x, target=None):
+    target = _target(target, x.shape, x.dtype)
+    np.greater(x, 0., out=target)
+    return target
+
+def linear(x):
+    pass
+
+def df_linear(x, target=None):
+    return x
+
+def sample_dropout_mask(x, dropout_probability=.5, columns=None, stream=None,
+                        target=None, dropout_mask=None, dropout_prob_array=None):
+    """ Samples a dropout mask and applies it in place"""
+
+    if columns is not None:
+        assert len(columns) == 2
+        x = x[:, columns[0]:columns[1]]
+
+    shape = x.shape
+
+    if dropout_prob_array is None:
+        dropout_prob_array = empty(shape, x.dtype)
+    sampler.fill_uniform(dropout_prob_array)
+
+    if dropout_mask is None:
+        dropout_mask = empty(shape, np.int8)
+    np.greater(dropout_prob_array, dropout_probability, out=dropout_mask)
+
+    if target is None: target = x
+    np.multiply(x, dropout_mask, out=target)
+
+    return dropout_mask
+
+def apply_dropout_mask(x, mask, columns=None, stream=None):
+    if columns is not None:
+        assert len(columns) == 2
+        x = x[:, columns[0]:columns[1]]
+
+    assert x.shape == mask.shape
+    np.multiply(x, mask, out=x)
+
+def nan_to_zeros(x, target=None):
+    target = _target(target, x.shape, x.dtype)
+    if target is not x:
+        target[...] = x
+    target[np.isnan(target)] = 0.
+    return target
+
+def substract_labels(a, labels, target=None):
+    labels = labels.reshape(-1)
+    target = _target(target, a.shape, a.dtype)
+    target[...] = a
+    rows = np.flatnonzero(labels >= 0)
+    target[rows, labels[rows]] -= 1.
+    target[labels < 0] = 0.
+    return target
+
+def log_labels(mat, labels, target=None):
+    labels = labels.reshape(-1)
+    target = _target(target, (mat.shape[0],), mat.dtype)
+    target.fill(0.)
+    rows = np.flatnonzero(labels >= 0)
+    target[rows] = np.log(mat[rows, labels[rows]] + eps)
+    return target
+
+def dequantize(x, scale=1., offset=0., dtype=np.float32, target=None):
+    target = _target(target, x.shape, dtype)
+    target[...] = x
+    target *= scale
+    target += offset
+    return target
+
+def scaled_axpy(x, y, scale, alpha):
+    x += alpha * scale * y
+
+def add_weight_decay(grad, param, l1_penalty_weight=0., l2_penalty_weight=0.):
+    assert grad.shape == param.shape
+    if l1_penalty_weight:
+        grad += l1_penalty_weight * np.sign(param)
+    if l2_penalty_weight:
+        grad += l2_penalty_weight * param
+
+def _step(grad, alpha, scale):
+    step = alpha * grad
+    if scale is not None:
+        step *= scale
+    return step
+
+def _gradient(grad, param, l1_penalty_weight, l2_penalty_weight):
+    if np.isscalar(l1_penalty_weight) and np.isscalar(l2_penalty_weight) \
+       and not (l1_penalty_weight or l2_penalty_weight):
+        return grad
+    return grad + l1_penalty_weight * np.sign(param) + \
+        l2_penalty_weight * param
+
+def sgd_update(param, grad, alpha, scale=None,
+               l1_penalty_weight=0., l2_penalty_weight=0.):
+    assert param.shape == grad.shape
+    grad = _gradient(grad, param, l1_penalty_weight, l2_penalty_weight)
+    param += _step(grad, alpha, scale)
+
+def momentum_update(param, velocity, grad, momentum, alpha, scale=None,
+                    l1_penalty_weight=0., l2_penalty_weight=0.):
+    assert param.shape == velocity.shape == grad.shape
+    grad = _gradient(grad, param, l1_penalty_weight, l2_penalty_weight)
+    velocity *= momentum
+    velocity += _step(grad, alpha, scale)
+    param += velocity
+
+def nesterov_update(param, velocity, grad, momentum, alpha, scale=None,
+                    l1_penalty_weight=0., l2_penalty_weight=0.):
+    assert param.shape == velocity.shape == grad.shape
+    grad = _gradient(grad, param, l1_penalty_weight, l2_penalty_weight)
+    step = _step(grad, alpha, scale)
+    velocity *= momentum
+    velocity += step
+    param += momentum * velocity + step
+
+def mult_matrix(a, b, target=None):
+    assert a.shape == b.shape
+    target = _target(target, a.shape, a.dtype)
+    np.multiply(a, b, out=target)
+    return target
+
+def substract_matrix(a, b, target=None):
+    assert a.shape == b.shape
+    target = _target(target, a.shape, a.dtype)
+    np.subtract(a, b, out=target)
+    return target
+
+
+### matrix
+
+def add_vec_to_mat(mat, vec, axis=None, inplace=False,
+                   target=None, substract=False):
+    if axis is None:
+        if vec.shape[0] == mat.shape[0]:
+            axis = 0
+        elif vec.shape[0] == mat.shape[1]:
+            axis = 1
+        else:
+            raise ValueError('Vector length must be equal '
+                             'to one side of the matrix')
+
+    assert vec.shape[0] == mat.shape[axis]
+    vec = vec[:, None] if axis == 0 else vec[None, :]
+
+    if inplace:
+        target = mat
+    elif target is None:
+        target = empty_like(mat)
+
+    if substract:
+        np.subtract(mat, vec, out=target)
+    else:
+        np.add(mat, vec, out=target)
+    return target
+
+def vector_normalize(mat, max_vec_norm=1.):
+    """ Normalize each column vector in mat to length
+    max_vec_norm if it is longer than max_vec_norm
+    """
+    vec_norm = np.sqrt(np.square(mat).sum(0))
+    scale = np.where(vec_norm > max_vec_norm,
+                     max_vec_norm / vec_norm, 1.)
+    mat *= scale.astype(mat.dtype)
+
+def extract_columns(mat, start=0, stop=None, target=None):
+    if len(mat.shape) not in (2, 3):
+        raise ValueError("mat must have two or three dimensions")
+    M = mat.shape[1]
+    if stop is None:
+        stop = M
+    assert start >= 0 and start <= M and stop >= 0 and \
+        stop <= M and stop > start
+
+    columns = mat[:, start:stop]
+    if target is None:
+        return to_cpuarray(columns.copy())
+    target[...] = columns.reshape(target.shape)
+    return target
+
+def insert_columns(src, dst, offset):
+    h_src = src.shape[0]
+    w_src = int(np.prod(src.shape[1:]))
+    h_dst, w_dst = dst.shape
+
+    assert dst.dtype == src.dtype
+    assert h_src == h_dst
+    assert w_dst >= offset + w_src
+
+    dst[:, offset:offset + w_src] = src.reshape((h_src, w_src))
+
+def copy_array(src, dst):
+    assert src.size == dst.size
+    assert src.dtype == dst.dtype
+    dst[...] = src.reshape(dst.shape)
+
+def pad_array(mat, left=0, right=0, val=0., new_shape=None, stream=None):
+    if len(mat.shape) < 2:
+        raise ValueError('Array must be at least two-dimensional.')
+
+    height = mat.shape[0]
+    width = int(np.prod(mat.shape[1:]))
+    padded_mat = empty((height, width + left + right), mat.dtype).fill(val)
+    padded_mat[:, left:left + width] = mat.reshape((height, width))
+
+    if new_shape is not None:
+        padded_mat = padded_mat.reshape(new_shape)
+    return padded_mat
+
+def rand_array(shape, dtype=np.float32, dist='uniform', stream=None):
+    mat = empty(shape, dtype)
+    if dist == 'uniform':
+        sampler.fill_uniform(mat)
+    elif dist == 'normal':
+        sampler.fill_normal(mat)
+    return mat
+
+
+### reductions
+
+def max_by_axis(mat, axis=0):
+    assert axis in (0, 1)
+    return to_cpuarray(mat.max(axis).astype(np.float32))
+
+def argmax_mismatch(mat, targets):
+    return to_cpuarray(np.float32(np.sum(mat.argmax(1) != targets.argmax(1))))
+
+def argmax_mismatch_labels(mat, labels):
+    labels = labels.reshape(-1)
+    return to_cpuarray(np.float32(np.sum((labels >= 0) &
+                                         (mat.argmax(1) != labels))))
+
+def binary_mismatch(mat, targets):
+    return to_cpuarray(np.float32(np.sum((mat >= .5) != (targets >= .5))))
+
+def matrix_sum_out_axis(mat, axis=0, cache_one_vector=True, target=None):
+    if axis not in (0, 1):
+        raise ValueError('axis must be 0 or 1')
+
+    if target is None:
+        return to_cpuarray(mat.sum(axis))
+    assert target.shape == (mat.shape[1 - axis],)
+    np.sum(mat, axis, out=target)
+    return target
+
+
+### softmax
+
+def logsumexp(mat):
+    max_dim = mat.max(1)
+    tmp = np.exp(mat - max_dim[:, None])
+    return to_cpuarray(max_dim + np.log(tmp.sum(1)))
+
+def softmax(mat):
+    tmp = mat - mat.max(1)[:, None]
+    np.exp(tmp, out=tmp)
+    tmp /= tmp.sum(1)[:, None]
+    return to_cpuarray(tmp)
+
+def cross_entropy(x, y):
+    loss = y * np.log(x + eps)
+    loss[np.isnan(loss)] = 0.
+    return to_cpuarray(np.asarray(-loss.sum()))
+
+def cross_entropy_labels(x, labels):
+    return to_cpuarray(np.asarray(-log_labels(x, labels).sum()))
+
+def cross_entropy_logistic(x, y):
+    loss = y * np.log(x + eps) + (1. - y) * np.log(1. - x + eps)
+    return to_cpuarray(np.asarray(-loss.sum()))
+
+
+### sparse
+
+def csr_dot(x, y, transa='N', target=None):
+    transa = transa.lower()
+    if transa not in ('n', 't'):
+        raise ValueError('invalid value "%s" for transa' % transa)
+
+    indptr = np.asarray(x.indptr)
+    rows = np.repeat(np.arange(x.shape[0]), np.diff(indptr))
+    indices = np.asarray(x.indices)
+    values = np.asarray(x.data)
+
+    if transa == 'n':
+        if x.shape[1] != y.shape[0]:
+            raise ValueError('objects are not aligned: x_shape = %s, '
+                             'y_shape = %s' % (x.shape, y.shape))
+        shape = (x.shape[0], y.shape[1])
+        products = values[:, None] * y[indices]
+    else:
+        if x.shape[0] != y.shape[0]:
+            raise ValueError('objects are not aligned: x_shape = %s, '
+                             'y_shape = %s' % (x.shape, y.shape))
+        shape = (x.shape[1], y.shape[1])
+        order = np.argsort(indices, kind='mergesort')
+        products = values[order, None] * y[rows[order]]
+        rows = indices[order]
+
+    # Sum the products of each row of the target
+    target = _target(target, shape, np.float32)
+    target.fill(0.)
+    if rows.size:
+        starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+        target[rows[starts]] = np.add.reduceat(products, starts)
+    return target
@@ -0,0 +1,152 @@
+# Copyright (C) 2013  Hannes Bretschneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+""" Host replacements for the parts of ``pycuda.gpuarray``,
+``pycuda.cumath``, ``pycuda.curandom`` and ``pycuda.tools`` that Hebel
+uses. These are used in place of PyCUDA when Hebel is initialized
+with ``backend='cpu'``.
+"""
+
+import numpy as np
+
+
+class CPUArray(np.ndarray):
+    """ A ``numpy.ndarray`` that provides the subset of the
+    ``GPUArray`` interface used by Hebel, so that layers, models and
+    parameter updaters can run on the host unchanged.
+    """
+
+    def __new__(cls, shape, dtype=np.float32, allocator=None, order='C'):
+        return np.ndarray.__new__(cls, shape, dtype, order=order)
+
+    def get(self, ary=None, **kwargs):
+        if ary is None:
+            return np.array(self)
+        ary[...] = self
+        return ary
+
+    def set(self, ary, **kwargs):
+        self[...] = ary
+
+    def fill(self, value, stream=None):
+        np.ndarray.fill(self, value)
+        return self
+
+    def _axpbyz(self, selffac, other, otherfac, out,
+                add_timer=None, stream=None):
+        """ Compute ``out = selffac * self + otherfac * other`` """
+        if out is self:
+            if selffac != 1.:
+                out *= selffac
+        else:
+            np.multiply(self, selffac, out=out)
+
+        if otherfac == 1.:
+            out += other
+        else:
+            out += otherfac * other
+        return out
+
+    def mul_add(self, selffac, other, otherfac, add_timer=None, stream=None):
+        return self._axpbyz(selffac, other, otherfac, empty_like(self))
+
+GPUArray = CPUArray
+
+
+def to_cpuarray(ary):
+    """ View ``ary`` as a ``CPUArray`` without copying """
+    if isinstance(ary, CPUArray):
+        return ary
+    return np.asarray(ary).view(CPUArray)
+
+
+def empty(shape, dtype=np.float32, allocator=None, order='C'):
+    return CPUArray(shape, dtype, order=order)
+
+
+def zeros(shape, dtype=np.float32, allocator=None, order='C'):
+    return empty(shape, dtype, order=order).fill(0)
+
+
+def empty_like(other_ary):
+    return CPUArray(other_ary.shape, other_ary.dtype)
+
+
+def zeros_like(other_ary):
+    return empty_like(other_ary).fill(0)
+
+
+def to_gpu(ary, allocator=None):
+    """ Copy ``ary`` into a new C-contiguous ``CPUArray`` """
+    return np.array(ary, order='C').view(CPUArray)
+
+
+def sum(a, dtype=None, stream=None):
+    return to_cpuarray(np.asarray(np.sum(a, dtype=dtype)))
+
+
+def exp(a, out=None, stream=None):
+    return to_cpuarray(np.exp(a, out=out))
+
+
+def log(a, out=None, stream=None):
+    return to_cpuarray(np.log(a, out=out))
+
+
+class HostRandomNumberGenerator(object):
+    """ Replacement for ``pycuda.curandom.XORWOWRandomNumberGenerator``
+    based on ``numpy.random.RandomState``.
+    """
+
+    def __init__(self, seed=None):
+        self.state = np.random.RandomState(
+            int(seed) if seed is not None else None)
+
+    def fill_uniform(self, data, stream=None):
+        data[...] = self.state.random_sample(data.shape)
+
+    def fill_normal(self, data, stream=None):
+        data[...] = self.state.standard_normal(data.shape)
+
+    def gen_uniform(self, shape, dtype, stream=None):
+        result = empty(shape, dtype)
+        self.fill_uniform(result)
+        return result
+
+    def gen_normal(self, shape, dtype, stream=None):
+        result = empty(shape, dtype)
+        self.fill_normal(result)
+        return result
+
+
+class HostMemoryPool(object):
+    """ Stands in for ``pycuda.tools.DeviceMemoryPool``. Host memory is
+    managed by NumPy, so there is nothing to hold on to.
+    """
+
+    held_blocks = 0
+    active_blocks = 0
+    active_bytes = 0
+    managed_bytes = 0
+
+    def allocate(self, nbytes):
+        return np.empty(nbytes, np.uint8)
+
+    def free_held(self):
+        pass
+
+    def stop_holding(self):
+        pass
@@ -15,42 +15,80 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import numpy as np
-from pycuda import gpuarray
-from pycuda.elementwise import ElementwiseKernel
+from . import gpuarray, cpu_dispatch, eps
 from .. import sampler, memory_pool
 from .matrix import extract_columns, insert_columns
+from .compiler import source_module
+
+_elementwise_template = """
+__global__ void %(name)s(%(arguments)s, const unsigned int n)
+{
+    const unsigned int total_threads = gridDim.x * blockDim.x;
+    for (unsigned int i = blockIdx.x * blockDim.x + threadIdx.x;
+         i < n; i += total_threads) {
+        %(operation)s;
+    }
+}
+"""
+
+_scalar_formats = {'float': 'f', 'double': 'd', 'int': 'i',
+                   'unsigned int': 'I', 'char': 'b'}
+
+def _prepare_format(arguments):
+    """ Format string for ``prepare`` from a C argument list. """
+    formats = []
+    for arg in arguments.split(','):
+        if '*' in arg:
+            formats.append('P')
+        else:
+            ctype = ' '.join(arg.replace('const ', '').split()[:-1])
+            formats.append(_scalar_formats[ctype])
+    return ''.join(formats) + 'I'
 
 class Kernel(object):
-    """ Defers creation of the ElementwiseKernels until the first
-    runtime and automatically selects kernels for double and float.
+    """ An elementwise kernel with a float and a double variant. Each
+    variant is compiled the first time it is called with arrays of
+    its type, using the on-disk cache of
+    :mod:`hebel.pycuda_ops.compiler`.
     """
 
     def __init__(self, name, signature_float, code_float, 
                  signature_double, code_double):
         self.name = name
-        self.kernel_float = ElementwiseKernel(signature_float, code_float, name)
-        self.kernel_double = ElementwiseKernel(signature_double, code_double, name)
+        self.code = {'float': (signature_float, code_float),
+                     'double': (signature_double, code_double)}
+        self.kernels = {}
 
     def __call__(self, *args, **kwargs):
-        if args[0].dtype == np.float32:
-            self.kernel_float(*args, **kwargs)
-        elif args[0].dtype == np.float64:
-            self.kernel_double(*args, **kwargs)
-        else:
-            raise ValueError("Unknown datatype, must be np.float32 or np.float64")
+        x = args[0]
+        kernel = self.get_kernel(x.dtype)
+        kernel.prepared_async_call(
+            x._grid, x._block, kwargs.get('stream'),
+            *([getattr(arg, 'gpudata', arg) for arg in args] +
+              [np.uint32(x.size)]))
 
     def get_kernel(self, dtype):
         if dtype == np.float32 or dtype == 'float':
-            return self.kernel_float
+            ctype = 'float'
         elif dtype == np.float64 or dtype == 'double':
-            return self.kernel_double
+            ctype = 'double'
         else:
             raise ValueError("Unknown datatype, must be np.float32 or np.float64")
 
+        try:
+            return self.kernels[ctype]
+        except KeyError:
+            arguments, operation = self.code[ctype]
+            source = _elementwise_template % {
+                'name': self.name, 'arguments': arguments,
+                'operation': operation}
+            kernel = source_module(source).get_function(self.name)\
+                .prepare(_prepare_format(arguments))
+            self.kernels[ctype] = kernel
+            return kernel
+
 all_kernels = None
 def init():
-    from pycuda import elementwise
-    
     global all_kernels
 
     all_kernels_code = {
@@ -121,7 +159,7 @@ def init():
                                 target[i] = mat[i];
                           }
                         """),
-            'double':  ("double *mat, double *targets, char *dropout_mask, "
+            'double':  ("double *mat, double *target, char *dropout_mask, "
                         "double *dropout_prob_array, float dropout_probability",
                         """if (dropout_prob_array[i] <= dropout_probability) {
                             dropout_mask[i] = 0.;
@@ -151,7 +189,7 @@ def init():
         'mult_matrix': {
             'float': ("const float *a, const float *b, float *c",
                       "c[i] = a[i] * b[i];"),
-            'double': ("const double *b, const double *b, double *c",
+            'double': ("const double *a, const double *b, double *c",
                        "c[i] = a[i] * b[i];")
 
         },
@@ -160,9 +198,136 @@ def init():
                       "c[i] = a[i] - b[i];"),
             'double': ("const double *a, const double *b, double *c",
                        "c[i] = a[i] - b[i];")
+        },
+
+        'scaled_axpy': {
+            'float': ("float *x, const float *y, const float *scale, float alpha",
+                      "x[i] += alpha * scale[i] * y[i];"),
+            'double': ("double *x, const double *y, const double *scale, double alpha",
+                       "x[i] += alpha * scale[i] * y[i];")
+        },
+
+        'add_weight_decay': {
+            'float': ("float *grad, const float *param, float l1, float l2",
+                      """const float p = param[i];
+                      grad[i] += l1 * ((p > 0.) - (p < 0.)) + l2 * p;
+                      """),
+            'double': ("double *grad, const double *param, double l1, double l2",
+                       """const double p = param[i];
+                       grad[i] += l1 * ((p > 0.) - (p < 0.)) + l2 * p;
+                       """)
+        },
+
+        # Class labels index the columns of one-hot targets, rows
+        # with negative labels are ignored
+        'substract_labels': {
+            'float': ("const float *a, const int *labels, float *c, "
+                      "unsigned int width",
+                      """const int label = labels[i / width];
+                      c[i] = label < 0 ? 0. : a[i] - (i % width == label);
+                      """),
+            'double': ("const double *a, const int *labels, double *c, "
+                       "unsigned int width",
+                       """const int label = labels[i / width];
+                       c[i] = label < 0 ? 0. : a[i] - (i % width == label);
+                       """)
+        },
+
+        'log_labels': {
+            'float': ("float *target, const float *mat, const int *labels, "
+                      "unsigned int width, float eps",
+                      """const int label = labels[i];
+                      target[i] = label < 0 ? 0. :
+                          logf(mat[i * width + label] + eps);
+                      """),
+            'double': ("double *target, const double *mat, const int *labels, "
+                       "unsigned int width, double eps",
+                       """const int label = labels[i];
+                       target[i] = label < 0 ? 0. :
+                           log(mat[i * width + label] + eps);
+                       """)
         }
     }
 
+    # The optimizer updates come in two variants: one with a scalar
+    # step size and one with an additional per-element multiplier.
+    # Each has a ``_decay`` variant that adds the gradients of the L1
+    # and L2 penalties on the fly, with scalar weights or, together
+    # with the multiplier, per-element weights.
+    update_kernels_code = {
+        'sgd_update': (
+            "%(t)s *param, const %(t)s *grad, %(t)s alpha",
+            """param[i] += %(step)s * g;
+            """),
+
+        'momentum_update': (
+            "%(t)s *param, %(t)s *velocity, const %(t)s *grad, "
+            "%(t)s momentum, %(t)s alpha",
+            """velocity[i] = momentum * velocity[i] + %(step)s * g;
+            param[i] += velocity[i];
+            """),
+
+        # The parameters are kept at the look-ahead point, so there
+        # is no separate step before the gradient is computed
+        'nesterov_update': (
+            "%(t)s *param, %(t)s *velocity, const %(t)s *grad, "
+            "%(t)s momentum, %(t)s alpha",
+            """const %(t)s delta = %(step)s * g;
+            const %(t)s v = momentum * velocity[i] + delta;
+            velocity[i] = v;
+            param[i] += momentum * v + delta;
+            """)
+    }
+
+    gradient_code = "const %(t)s g = grad[i];\n"
+    decay_code = """const %%(t)s p = param[i];
+            const %%(t)s g = grad[i] + l1%(idx)s * ((p > 0.) - (p < 0.)) +
+                l2%(idx)s * p;
+            """
+
+    for name, (signature, code) in update_kernels_code.iteritems():
+        for suffix, scale_arg, step, decay_arg, idx in (
+                ('', '', 'alpha', ', %(t)s l1, %(t)s l2', ''),
+                ('_scaled', ', const %(t)s *scale', 'alpha * scale[i]',
+                 ', const %(t)s *l1, const %(t)s *l2', '[i]')):
+            for decay_suffix, decay_args, gradient in (
+                    ('', '', gradient_code),
+                    ('_decay', decay_arg, decay_code % {'idx': idx})):
+                all_kernels_code[name + suffix + decay_suffix] = {
+                    t: ((signature + scale_arg + decay_args) % {'t': t},
+                        (gradient + code) % {'t': t, 'step': step})
+                    for t in ('float', 'double')
+                }
+
+    # Expand data from a compact storage type to the compute type.
+    # float16 is read as raw bits, since not every CUDA version has a
+    # half type.
+    half_to_float = """const unsigned int h = x[i];
+            const unsigned int exponent = (h >> 10) & 0x1f;
+            const unsigned int mantissa = h & 0x3ff;
+            float value;
+            if (exponent == 0)
+                value = ldexpf((float) mantissa, -24);
+            else if (exponent == 31)
+                value = __int_as_float(0x7f800000 | (mantissa << 13));
+            else
+                value = __int_as_float(((exponent + 112) << 23) |
+                                       (mantissa << 13));
+            if (h & 0x8000) value = -value;
+            """
+    storage_types = (('uint8', 'unsigned char', '', 'x[i]'),
+                     ('int8', 'signed char', '', 'x[i]'),
+                     ('uint16', 'unsigned short', '', 'x[i]'),
+                     ('int16', 'short', '', 'x[i]'),
+                     ('float16', 'unsigned short', half_to_float, 'value'))
+    for storage, ctype, prologue, value in storage_types:
+        all_kernels_code['dequantize_' + storage] = {
+            t: ("%s *target, const %s *x, %s scale, %s offset" %
+                (t, ctype, t, t),
+                prologue + "target[i] = %s * scale + offset;" % value)
+            for t in ('float', 'double')
+        }
+
     all_kernels = {
         name: Kernel(name, 
                      val['float'][0], val['float'][1],
@@ -170,6 +335,7 @@ def init():
         for name, val in all_kernels_code.iteritems()
     }
 
+@cpu_dispatch
 def sign(x, target=None):
     assert x.flags.c_contiguous
     if target is None:
@@ -180,10 +346,12 @@ def sign(x, target=None):
     all_kernels['sign'](x, target)
     return target
 
+@cpu_dispatch
 def sigmoid(x):
     assert x.flags.c_contiguous
     all_kernels['sigmoid'](x)
 
+@cpu_dispatch
 def df_sigmoid(f, target=None):
     assert f.flags.c_contiguous
     if target is None:
@@ -191,10 +359,12 @@ def df_sigmoid(f, target=None):
     all_kernels['df_sigmoid'](f, target)
     return target
 
+@cpu_dispatch
 def tanh(x):
     assert x.flags.c_contiguous
     all_kernels['tanh_inplace'](x)
 
+@cpu_dispatch
 def df_tanh(f, target=None):
     assert f.flags.c_contiguous
     if target is None:
@@ -202,10 +372,12 @@ def df_tanh(f, target=None):
     all_kernels['df_tanh'](f, target)
     return target
 
+@cpu_dispatch
 def relu(x):
     assert x.flags.c_contiguous
     all_kernels['relu'](x)
 
+@cpu_dispatch
 def df_relu(x, target=None):
     assert x.flags.c_contiguous
     if target is None:
@@ -216,9 +388,11 @@ def df_relu(x, target=None):
 def linear(x):
     pass
 
-def df_linear(x):
+def df_linear(x, target=None):
+    # Passes the activations through, so ``target`` is never used
     return x
 
+@cpu_dispatch
 def sample_dropout_mask(x, dropout_probability=.5, columns=None, stream=None, target=None,
                         dropout_mask=None, dropout_prob_array=None):
     """ Samples a dropout mask and applies it in place"""
@@ -250,6 +424,7 @@ def sample_dropout_mask(x, dropout_probability=.5, columns=None, stream=None, ta
 
     return dropout_mask
 
+@cpu_dispatch
 def apply_dropout_mask(x, mask, columns=None, stream=None):
     assert x.flags.c_contiguous
 
@@ -266,6 +441,7 @@ def apply_dropout_mask(x, mask, columns=None, stream=None):
     if columns is not None:
         insert_columns(x, x_tmp, columns[0])
 
+@cpu_dispatch
 def nan_to_zeros(x, target=None):
     assert x.flags.c_contiguous
     if target is None:
@@ -274,6 +450,7 @@ def nan_to_zeros(x, target=None):
     all_kernels['nan_to_zeros'](x, target)
     return target
 
+@cpu_dispatch
 def mult_matrix(a, b, target=None):
     assert a.shape == b.shape
     if target is None:
@@ -282,6 +459,7 @@ def mult_matrix(a, b, target=None):
     all_kernels['mult_matrix'](a, b, target)
     return target
 
+@cpu_dispatch
 def substract_matrix(a, b, target=None):
     assert a.shape == b.shape
     if target is None:
@@ -289,3 +467,150 @@ def substract_matrix(a, b, target=None):
 
     all_kernels['substract_matrix'](a, b, target)
     return target
+
+@cpu_dispatch
+def substract_labels(a, labels, target=None):
+    """ Computes ``a - targets``, where the one-hot ``targets`` are
+    given as a vector of ``int32`` class labels. Rows with negative
+    labels are set to zero.
+    """
+    assert a.flags.c_contiguous
+    assert labels.dtype == np.int32 and labels.size == a.shape[0]
+    if target is None:
+        target = gpuarray.empty_like(a)
+
+    all_kernels['substract_labels'](a, labels, target, np.uint32(a.shape[1]))
+    return target
+
+@cpu_dispatch
+def log_labels(mat, labels, target=None):
+    """ Gathers ``log(mat[i, labels[i]] + eps)`` for every row ``i``,
+    or zero if the label is negative.
+    """
+    assert mat.flags.c_contiguous
+    assert labels.dtype == np.int32 and labels.size == mat.shape[0]
+    if target is None:
+        target = gpuarray.empty((mat.shape[0],), mat.dtype,
+                                allocator=memory_pool.allocate)
+
+    all_kernels['log_labels'](target, mat, labels, np.uint32(mat.shape[1]),
+                              mat.dtype.type(eps))
+    return target
+
+@cpu_dispatch
+def dequantize(x, scale=1., offset=0., dtype=np.float32, target=None):
+    """ Expands ``x`` from a compact storage type (``uint8``,
+    ``int8``, ``uint16``, ``int16`` or ``float16``) to ``dtype`` as
+    ``x * scale + offset``.
+    """
+    assert x.flags.c_contiguous
+    if target is None:
+        target = gpuarray.empty(x.shape, dtype,
+                                allocator=memory_pool.allocate)
+    assert target.shape == x.shape
+    assert target.flags.c_contiguous
+
+    try:
+        kernel = all_kernels['dequantize_' + x.dtype.name]
+    except KeyError:
+        raise ValueError("Can't dequantize data of type %s" % x.dtype)
+    kernel(target, x, target.dtype.type(scale), target.dtype.type(offset))
+    return target
+
+@cpu_dispatch
+def scaled_axpy(x, y, scale, alpha):
+    """ Computes ``x += alpha * scale * y`` in place """
+    assert x.shape == y.shape == scale.shape
+    all_kernels['scaled_axpy'](x, y, scale, x.dtype.type(alpha))
+
+@cpu_dispatch
+def add_weight_decay(grad, param, l1_penalty_weight=0., l2_penalty_weight=0.):
+    """ Adds the gradients of the L1 and L2 penalties to ``grad`` in
+    place, without allocating temporaries.
+    """
+
+    assert grad.shape == param.shape
+    all_kernels['add_weight_decay'](grad, param,
+                                    grad.dtype.type(l1_penalty_weight),
+                                    grad.dtype.type(l2_penalty_weight))
+
+def _update_kernel(name, args, param, alpha, scale,
+                   l1_penalty_weight, l2_penalty_weight):
+    dtype = param.dtype.type
+    args = list(args) + [dtype(alpha)]
+    if scale is not None:
+        assert scale.shape == param.shape
+        name += '_scaled'
+        args.append(scale)
+
+    if isinstance(l1_penalty_weight, gpuarray.GPUArray):
+        if scale is None:
+            raise ValueError("Per-element penalty weights require scale")
+        assert l1_penalty_weight.shape == l2_penalty_weight.shape == \
+            param.shape
+        name += '_decay'
+        args.extend((l1_penalty_weight, l2_penalty_weight))
+    elif l1_penalty_weight or l2_penalty_weight:
+        if scale is not None:
+            raise ValueError("Penalty weights must be per-element arrays "
+                             "if scale is given")
+        name += '_decay'
+        args.extend((dtype(l1_penalty_weight), dtype(l2_penalty_weight)))
+
+    all_kernels[name](*args)
+
+@cpu_dispatch
+def sgd_update(param, grad, alpha, scale=None,
+               l1_penalty_weight=0., l2_penalty_weight=0.):
+    """ Gradient descent step in a single pass over memory::
+
+        param += alpha * scale * (grad + l1 * sign(param) + l2 * param)
+
+    ``scale`` is an optional array of per-element multipliers. The
+    penalty weights are scalars, or per-element arrays if ``scale``
+    is given.
+    """
+
+    assert param.shape == grad.shape
+    _update_kernel('sgd_update', (param, grad), param, alpha, scale,
+                   l1_penalty_weight, l2_penalty_weight)
+
+@cpu_dispatch
+def momentum_update(param, velocity, grad, momentum, alpha, scale=None,
+                    l1_penalty_weight=0., l2_penalty_weight=0.):
+    """ Momentum step in a single pass over memory::
+
+        g = grad + l1 * sign(param) + l2 * param
+        velocity = momentum * velocity + alpha * scale * g
+        param += velocity
+
+    ``scale`` is an optional array of per-element multipliers. The
+    penalty weights are scalars, or per-element arrays if ``scale``
+    is given.
+    """
+
+    assert param.shape == velocity.shape == grad.shape
+    _update_kernel('momentum_update',
+                   (param, velocity, grad, param.dtype.type(momentum)),
+                   param, alpha, scale, l1_penalty_weight, l2_penalty_weight)
+
+@cpu_dispatch
+def nesterov_update(param, velocity, grad, momentum, alpha, scale=None,
+                    l1_penalty_weight=0., l2_penalty_weight=0.):
+    """ Nesterov momentum step in a single pass over memory::
+
+        g = grad + l1 * sign(param) + l2 * param
+        velocity = momentum * velocity + alpha * scale * g
+        param += momentum * velocity + alpha * scale * g
+
+    ``param`` holds the look-ahead point at which the next gradient
+    is computed, so no update is needed before the gradient.
+    ``scale`` is an optional array of per-element multipliers. The
+    penalty weights are scalars, or per-element arrays if ``scale``
+    is given.
+    """
+
+    assert param.shape == velocity.shape == grad.shape
+    _update_kernel('nesterov_update',
+                   (param, velocity, grad, param.dtype.type(momentum)),
+                   param, alpha, scale, l1_penalty_weight, l2_penalty_weight)
@@ -27,15 +27,21 @@
 # SUCH DAMAGE.
 
 from string import lower
-import pycuda.gpuarray as gpuarray
 import numpy as np
-from . import cublas
+from . import gpuarray, cpu_dispatch
 from .. import memory_pool
 
+cublas = None
 def init():
+    """ Loads cuBLAS and creates the default handle. This is done by
+    the first call to ``dot``.
+    """
+    global cublas
     global _global_cublas_handle
+    from . import cublas
     _global_cublas_handle = cublas.cublasCreate()
 
+@cpu_dispatch
 def dot(x_gpu, y_gpu, transa='N', transb='N', handle=None, target=None):
     """
     Dot product of two arrays.
@@ -16,10 +16,11 @@
 
 from .. import memory_pool, sampler
 import numpy as np
-from pycuda import driver as drv
-from pycuda import gpuarray
+from . import gpuarray, cpu_dispatch
 from ..utils.math import ceil_div
 
+drv = None
+
 add_row_vec_kernel = None
 add_col_vec_kernel = None
 vector_normalize_kernel = None
@@ -27,8 +28,10 @@ _compilation_constants = {
     'add_vec_block_size': 16
 }
 def init():
-    from pycuda.compiler import SourceModule
+    from .compiler import source_module
+    from pycuda import driver
     
+    global drv
     global add_row_vec_kernel
     global add_col_vec_kernel
     global vector_normalize_kernel
@@ -122,11 +125,13 @@ def init():
     }
     """ % _compilation_constants
 
-    mod = SourceModule(code)
+    mod = source_module(code)
     add_row_vec_kernel = mod.get_function('addRowVecToMat').prepare('PPPIIi')
     add_col_vec_kernel = mod.get_function('addColVecToMat').prepare('PPPIIi')
     vector_normalize_kernel = mod.get_function("kVectorNormalize").prepare('PfII')
+    drv = driver
 
+@cpu_dispatch
 def add_vec_to_mat(mat, vec, axis=None, inplace=False,
                    target=None, substract=False):
     """ Add a vector to a matrix
@@ -179,6 +184,7 @@ def add_vec_to_mat(mat, vec, axis=None, inplace=False,
     return target
 
 
+@cpu_dispatch
 def vector_normalize(mat, max_vec_norm=1.):
     """ Normalize each column vector in mat to length
     max_vec_norm if it is longer than max_vec_norm
@@ -193,6 +199,7 @@ def vector_normalize(mat, max_vec_norm=1.):
         np.int32(m),
         np.int32(n))
 
+@cpu_dispatch
 def extract_columns(mat, start=0, stop=None, target=None):
     dtype = mat.dtype
     itemsize = np.dtype(dtype).itemsize
@@ -238,6 +245,7 @@ def extract_columns(mat, start=0, stop=None, target=None):
     return target
 
 
+@cpu_dispatch
 def insert_columns(src, dst, offset):
     dtype = src.dtype
     itemsize = np.dtype(dtype).itemsize
@@ -261,6 +269,18 @@ def insert_columns(src, dst, offset):
     copy.height = h_src
     copy(aligned=True)
 
+@cpu_dispatch
+def copy_array(src, dst):
+    """ Copies the contents of ``src`` into ``dst``, which must have
+    the same size and dtype, but may have a different shape.
+    """
+
+    assert src.size == dst.size
+    assert src.dtype == dst.dtype
+    assert src.flags.c_contiguous and dst.flags.c_contiguous
+    drv.memcpy_dtod(dst.gpudata, src.gpudata, src.nbytes)
+
+@cpu_dispatch
 def pad_array(mat, left=0, right=0, val=0., new_shape=None, stream=None):
     assert mat.flags.c_contiguous
 
@@ -304,6 +324,7 @@ def pad_array(mat, left=0, right=0, val=0., new_shape=None, stream=None):
         
     return padded_mat
     
+@cpu_dispatch
 def rand_array(shape, dtype=np.float32, dist='uniform', stream=None):
     mat = gpuarray.empty(shape, dtype, allocator=memory_pool.allocate)
     if dist == 'uniform':
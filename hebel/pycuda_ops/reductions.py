@@ -15,17 +15,23 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import numpy as np
-from pycuda import gpuarray
+from . import gpuarray, cpu_dispatch
 from . import linalg
 from .. import memory_pool
+from ..utils.math import ceil_div
 
 max_column = None
 max_row = None
+argmax_mismatch_kernel = None
+argmax_mismatch_labels_kernel = None
+binary_mismatch_kernel = None
 def init():
-    from pycuda.compiler import SourceModule
+    from .compiler import source_module
 
     global max_column
     global max_row
+    global argmax_mismatch_kernel
+    global argmax_mismatch_labels_kernel
 
     code = """
 #include "float.h"
@@ -91,13 +97,60 @@ __global__ void kMaxRowwise(float* mat,
     }
     // __syncthreads();
 }
+
+__global__ void kArgmaxMismatch(float* mat,
+                                float* targets,
+                                float* errors,
+                                unsigned int width,
+                                unsigned int height) {
+    const unsigned int row = blockIdx.x * blockDim.x + threadIdx.x;
+    if (row >= height) return;
+
+    const float* mat_row = mat + row * width;
+    const float* targets_row = targets + row * width;
+    unsigned int mat_argmax = 0;
+    unsigned int targets_argmax = 0;
+
+    for (unsigned int i = 1; i < width; i++) {
+        if (mat_row[i] > mat_row[mat_argmax])
+            mat_argmax = i;
+        if (targets_row[i] > targets_row[targets_argmax])
+            targets_argmax = i;
+    }
+
+    errors[row] = mat_argmax != targets_argmax;
+}
+
+__global__ void kArgmaxMismatchLabels(float* mat,
+                                      int* labels,
+                                      float* errors,
+                                      unsigned int width,
+                                      unsigned int height) {
+    const unsigned int row = blockIdx.x * blockDim.x + threadIdx.x;
+    if (row >= height) return;
+
+    const float* mat_row = mat + row * width;
+    const int label = labels[row];
+    int mat_argmax = 0;
+
+    for (unsigned int i = 1; i < width; i++) {
+        if (mat_row[i] > mat_row[mat_argmax])
+            mat_argmax = i;
+    }
+
+    errors[row] = label >= 0 && mat_argmax != label;
+}
 """
 
-    mod = SourceModule(code)
+    mod = source_module(code)
     max_column = mod.get_function("kMaxColumnwise").prepare('PPII')
     max_row = mod.get_function("kMaxRowwise").prepare('PPII')
+    argmax_mismatch_kernel = mod.get_function("kArgmaxMismatch").prepare('PPPII')
+    argmax_mismatch_labels_kernel = \
+        mod.get_function("kArgmaxMismatchLabels").prepare('PPPII')
 
 
+@cpu_dispatch
 def max_by_axis(mat, axis=0):
     assert mat.flags.c_contiguous
     assert axis in (0, 1)
@@ -121,10 +174,76 @@ def max_by_axis(mat, axis=0):
     return target
 
 
+@cpu_dispatch
+def argmax_mismatch(mat, targets):
+    """ Count the rows in which the largest element of ``mat`` and
+    ``targets`` are in different columns. The count is returned as a
+    scalar ``GPUArray``, so no synchronization with the host takes
+    place.
+    """
+
+    assert mat.flags.c_contiguous and targets.flags.c_contiguous
+    assert mat.shape == targets.shape
+
+    n, m = mat.shape
+    errors = gpuarray.empty(n, dtype=np.float32,
+                            allocator=memory_pool.allocate)
+    block_size = 128
+    argmax_mismatch_kernel.prepared_call(
+        (ceil_div(n, block_size), 1, 1), (block_size, 1, 1),
+        mat.gpudata, targets.gpudata, errors.gpudata,
+        np.uint32(m), np.uint32(n))
+    return gpuarray.sum(errors)
+
+
+@cpu_dispatch
+def argmax_mismatch_labels(mat, labels):
+    """ Count the rows in which the largest element of ``mat`` is not
+    in the column given by the ``int32`` class label of the row. Rows
+    with negative labels are not counted. The count is returned as a
+    scalar ``GPUArray``.
+    """
+
+    assert mat.flags.c_contiguous
+    assert labels.dtype == np.int32 and labels.size == mat.shape[0]
+
+    n, m = mat.shape
+    errors = gpuarray.empty(n, dtype=np.float32,
+                            allocator=memory_pool.allocate)
+    block_size = 128
+    argmax_mismatch_labels_kernel.prepared_call(
+        (ceil_div(n, block_size), 1, 1), (block_size, 1, 1),
+        mat.gpudata, labels.gpudata, errors.gpudata,
+        np.uint32(m), np.uint32(n))
+    return gpuarray.sum(errors)
+
+
+@cpu_dispatch
+def binary_mismatch(mat, targets):
+    """ Count the elements that are on different sides of 0.5 in
+    ``mat`` and ``targets``. The count is returned as a scalar
+    ``GPUArray``.
+    """
+
+    assert mat.shape == targets.shape
+
+    global binary_mismatch_kernel
+    if binary_mismatch_kernel is None:
+        # PyCUDA keeps its own on-disk cache for reduction kernels
+        from pycuda.reduction import ReductionKernel
+        binary_mismatch_kernel = ReductionKernel(
+            np.float32, neutral="0",
+            reduce_expr="a+b",
+            map_expr="(x[i] >= .5f) != (y[i] >= .5f)",
+            arguments="const float *x, const float *y")
+    return binary_mismatch_kernel(mat, targets)
+
+
 def _matrix_sum_out_axis_wrapper():
     one_vector_cache = {}
 
-    def f(mat, axis=0, cache_one_vector=True, target=None):
+    @cpu_dispatch
+    def matrix_sum_out_axis(mat, axis=0, cache_one_vector=True, target=None):
         assert mat.flags.c_contiguous
         N, M = mat.shape
 
@@ -166,5 +285,5 @@ def _matrix_sum_out_axis_wrapper():
 
         # target.shape = (target.shape[0], 1)
         return target
-    return f
+    return matrix_sum_out_axis
 matrix_sum_out_axis = _matrix_sum_out_axis_wrapper()
@@ -14,15 +14,15 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-from . import eps
+from . import eps, gpuarray, cumath, cpu_dispatch
 from .. import memory_pool
 from .reductions import max_by_axis
 from .matrix import add_vec_to_mat
 from .reductions import matrix_sum_out_axis
-from .elementwise import nan_to_zeros
-from pycuda import cumath, gpuarray
+from .elementwise import nan_to_zeros, log_labels
 import numpy as np
 
+@cpu_dispatch
 def logsumexp(mat):
     max_dim = max_by_axis(mat, 1)
     tmp = add_vec_to_mat(mat, max_dim, 0, substract=True)
@@ -34,6 +34,7 @@ def logsumexp(mat):
     max_dim += tmp
     return max_dim
 
+@cpu_dispatch
 def softmax(mat):
     tmp = gpuarray.empty_like(mat)
     L = logsumexp(mat)
@@ -41,12 +42,22 @@ def softmax(mat):
     tmp = cumath.exp(tmp)
     return tmp
 
+@cpu_dispatch
 def cross_entropy(x, y):
     loss = y * cumath.log(x + eps)
     nan_to_zeros(loss, loss)
     loss = -gpuarray.sum(loss)
     return loss
 
+@cpu_dispatch
+def cross_entropy_labels(x, labels):
+    """ Cross entropy with one-hot targets given as a vector of
+    ``int32`` class labels, which only needs the probability of the
+    correct class in every row. Rows with negative labels are ignored.
+    """
+    return -gpuarray.sum(log_labels(x, labels))
+
+@cpu_dispatch
 def cross_entropy_logistic(x, y):
     loss = y * cumath.log(x + eps) + (1. - y) * cumath.log(1. - x + eps)
     loss = -gpuarray.sum(loss)
@@ -0,0 +1,262 @@
+# Copyright (C) 2013  Hannes Bretschneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+""" Sparse input matrices in compressed sparse row (CSR) format and
+the sparse-dense matrix products that
+:class:`hebel.layers.HiddenLayer` needs to take them as input.
+"""
+
+import numpy as np
+from . import gpuarray, cpu_dispatch
+from ..utils.math import ceil_div
+
+csr_dot_kernel = None
+csr_dot_trans_kernel = None
+_compilation_constants = {
+    'block_size': 128,
+    'max_grid_rows': 65535
+}
+def init():
+    from .compiler import source_module
+
+    global csr_dot_kernel
+    global csr_dot_trans_kernel
+
+    code = """
+    // target = x * y, one thread per element of target
+    __global__ void kCsrDot(const float *data,
+                            const int *indices,
+                            const int *indptr,
+                            const float *y,
+                            float *target,
+                            const unsigned int n,
+                            const unsigned int m)
+    {
+      const unsigned int col = blockIdx.x * blockDim.x + threadIdx.x;
+      if (col >= m) return;
+
+      for (unsigned int row = blockIdx.y; row < n; row += gridDim.y) {
+        float sum = 0.;
+        for (int k = indptr[row]; k < indptr[row+1]; k++)
+          sum += data[k] * y[indices[k]*m+col];
+        target[row*m+col] = sum;
+      }
+    }
+
+    // target += x^T * y, scattering each row of y into the rows of
+    // target that the row of x has entries in
+    __global__ void kCsrDotTrans(const float *data,
+                                 const int *indices,
+                                 const int *indptr,
+                                 const float *y,
+                                 float *target,
+                                 const unsigned int n,
+                                 const unsigned int m)
+    {
+      const unsigned int col = blockIdx.x * blockDim.x + threadIdx.x;
+      if (col >= m) return;
+
+      for (unsigned int row = blockIdx.y; row < n; row += gridDim.y) {
+        const float y_val = y[row*m+col];
+        for (int k = indptr[row]; k < indptr[row+1]; k++)
+          atomicAdd(target + indices[k]*m + col, data[k] * y_val);
+      }
+    }
+    """
+
+    mod = source_module(code)
+    csr_dot_kernel = mod.get_function('kCsrDot').prepare('PPPPPII')
+    csr_dot_trans_kernel = mod.get_function('kCsrDotTrans').prepare('PPPPPII')
+
+
+class CSRMatrix(object):
+    """ A sparse matrix in compressed sparse row (CSR) format.
+
+    Row ``i`` has the values ``data[indptr[i]:indptr[i+1]]`` in the
+    columns ``indices[indptr[i]:indptr[i+1]]``. The arrays may either
+    be ``numpy.array`` objects in host memory, or ``GPUArray``
+    objects (see :meth:`to_gpu`). A ``scipy.sparse.csr_matrix`` can
+    be converted with :meth:`from_csr`.
+
+    Slicing rows of a host matrix (``x[i:j]``) returns a view, without
+    copying any data.
+
+    **Parameters:**
+
+    data : array_like
+        The nonzero values.
+
+    indices : array_like
+        The column of each value.
+
+    indptr : array_like
+        The start of each row in ``data`` and ``indices``, followed
+        by the number of values.
+
+    shape : tuple
+        The shape ``(n_rows, n_columns)`` of the matrix.
+    """
+
+    def __init__(self, data, indices, indptr, shape):
+        if len(indptr) != shape[0] + 1:
+            raise ValueError("indptr must have n_rows + 1 entries")
+        self.data = data
+        self.indices = indices
+        self.indptr = indptr
+        self.shape = tuple(shape)
+
+    @classmethod
+    def from_csr(cls, matrix):
+        """ Converts a ``scipy.sparse.csr_matrix`` or any object with
+        the same attributes.
+        """
+        return cls(matrix.data, matrix.indices, matrix.indptr, matrix.shape)
+
+    @classmethod
+    def from_dense(cls, array):
+        """ Converts a dense two-dimensional ``numpy.array`` """
+        array = np.asarray(array)
+        rows, indices = np.nonzero(array)
+        indptr = np.zeros(array.shape[0] + 1, np.int64)
+        np.cumsum(np.bincount(rows, minlength=array.shape[0]),
+                  out=indptr[1:])
+        return cls(array[rows, indices], indices, indptr, array.shape)
+
+    @property
+    def nnz(self):
+        return self.data.shape[0]
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def on_device(self):
+        return isinstance(self.data, gpuarray.GPUArray)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        if self.on_device:
+            raise TypeError("Only host matrices can be sliced")
+        if not isinstance(rows, slice):
+            raise TypeError("CSRMatrix only supports slicing rows, "
+                            "use take_rows to gather them")
+
+        start, stop, step = rows.indices(self.shape[0])
+        if step != 1:
+            raise ValueError("Slices of a CSRMatrix must be contiguous")
+        stop = max(start, stop)
+        indptr = self.indptr[start:stop+1]
+        begin, end = indptr[0], indptr[-1]
+        return CSRMatrix(self.data[begin:end], self.indices[begin:end],
+                         indptr - begin, (stop - start, self.shape[1]))
+
+    def take_rows(self, rows):
+        """ Returns a new host matrix with the rows ``rows`` """
+        if self.on_device:
+            raise TypeError("Only host matrices support take_rows")
+
+        rows = np.asarray(rows)
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        indptr = np.zeros(rows.shape[0] + 1, np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+
+        # Position of every value of the new matrix in the old one
+        offsets = np.repeat(starts - indptr[:-1], lengths)
+        positions = np.arange(indptr[-1]) + offsets
+        return CSRMatrix(self.data[positions], self.indices[positions],
+                         indptr, (rows.shape[0], self.shape[1]))
+
+    def to_gpu(self, allocator=None):
+        """ Copies the matrix to the device, with ``float32`` values
+        and ``int32`` indices.
+        """
+        indptr = np.asarray(self.indptr)
+        return CSRMatrix(
+            gpuarray.to_gpu(np.ascontiguousarray(self.data, np.float32),
+                            allocator=allocator),
+            gpuarray.to_gpu(np.ascontiguousarray(self.indices, np.int32),
+                            allocator=allocator),
+            gpuarray.to_gpu((indptr - indptr[0]).astype(np.int32),
+                            allocator=allocator),
+            self.shape)
+
+    def get(self):
+        """ Copies the matrix from the device to host memory """
+        if not self.on_device:
+            return self
+        return CSRMatrix(self.data.get(), self.indices.get(),
+                         self.indptr.get(), self.shape)
+
+    def toarray(self):
+        """ Returns the matrix as a dense ``numpy.array`` """
+        x = self.get()
+        indptr = np.asarray(x.indptr)
+        rows = np.repeat(np.arange(self.shape[0]), np.diff(indptr))
+        out = np.zeros(self.shape, x.dtype)
+        out[rows, x.indices[indptr[0]:indptr[-1]]] = \
+            x.data[indptr[0]:indptr[-1]]
+        return out
+
+
+@cpu_dispatch
+def csr_dot(x, y, transa='N', target=None):
+    """ Multiplies the sparse matrix ``x`` on the device with the
+    dense matrix ``y``.
+
+    Computes ``x * y`` or, if ``transa`` is ``'T'``, ``x^T * y``,
+    without converting ``x`` to a dense matrix. The latter scatters
+    the rows of ``y`` with atomic additions, so the order of the
+    summation (and the rounding) isn't deterministic.
+    """
+
+    transa = transa.lower()
+    if transa not in ('n', 't'):
+        raise ValueError('invalid value "%s" for transa' % transa)
+
+    n = x.shape[0]
+    m = y.shape[1]
+    if transa == 'n':
+        if x.shape[1] != y.shape[0]:
+            raise ValueError('objects are not aligned: x_shape = %s, '
+                             'y_shape = %s' % (x.shape, y.shape))
+        shape = (n, m)
+        kernel = csr_dot_kernel
+    else:
+        if x.shape[0] != y.shape[0]:
+            raise ValueError('objects are not aligned: x_shape = %s, '
+                             'y_shape = %s' % (x.shape, y.shape))
+        shape = (x.shape[1], m)
+        kernel = csr_dot_trans_kernel
+
+    if target is None:
+        target = gpuarray.empty(shape, np.float32)
+    assert target.shape == shape
+    if transa == 't':
+        target.fill(0.)
+
+    block_size = _compilation_constants['block_size']
+    grid = (ceil_div(m, block_size),
+            max(1, min(n, _compilation_constants['max_grid_rows'])), 1)
+    kernel.prepared_call(
+        grid, (block_size, 1, 1),
+        x.data.gpudata, x.indices.gpudata, x.indptr.gpudata,
+        y.gpudata, target.gpudata,
+        np.uint32(n), np.uint32(m))
+    return target
@@ -0,0 +1,281 @@
+# Copyright (C) 2013  Hannes Bretschneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+""" Runs hyperparameter sweeps over a YAML configuration.
+
+A sweep expands a search space into sets of overrides for
+:func:`hebel.config.load` (see :func:`grid_search` and
+:func:`random_search`), trains one model per set of overrides in a
+pool of worker processes, one per GPU or CPU slot, and writes a table
+of the results. Trials whose validation error falls behind the other
+trials can be stopped early by a :class:`MedianStoppingRule`.
+
+Use the script ``sweep_model.py`` to run a sweep from the command
+line.
+"""
+
+import os
+import csv
+import time
+import random
+import itertools
+import traceback
+import multiprocessing
+import numpy as np
+
+
+def grid_search(parameters):
+    """ Returns a list of overrides with every combination of the
+    values in ``parameters``.
+
+    :param parameters: A dictionary from dot-delimited paths in the
+        configuration (see :func:`hebel.config.load`) to lists of
+        values.
+    """
+
+    keys = sorted(parameters)
+    return [dict(zip(keys, values)) for values in
+            itertools.product(*[parameters[key] for key in keys])]
+
+
+def _sample(space, rng):
+    if isinstance(space, (list, tuple)):
+        return space[rng.randint(0, len(space) - 1)]
+    if isinstance(space, dict) and len(space) == 1:
+        (dist, (low, high)), = space.items()
+        if dist == 'uniform':
+            return rng.uniform(low, high)
+        if dist == 'log_uniform':
+            return float(np.exp(rng.uniform(np.log(low), np.log(high))))
+        if dist == 'randint':
+            return rng.randint(low, high)
+    raise ValueError('Unknown search space %r' % (space,))
+
+
+def random_search(parameters, n_trials, random_seed=None):
+    """ Returns ``n_trials`` randomly drawn sets of overrides.
+
+    :param parameters: A dictionary from dot-delimited paths in the
+        configuration to the values to draw from. A value is either a
+        list to choose from or a dictionary with a single key
+        ``uniform``, ``log_uniform`` or ``randint`` (both bounds are
+        inclusive) whose value is ``[low, high]``.
+    :param n_trials: The number of trials.
+    :param random_seed: Seed for the random number generator.
+    """
+
+    rng = random.Random(random_seed)
+    keys = sorted(parameters)
+    return [dict((key, _sample(parameters[key], rng)) for key in keys)
+            for _ in range(n_trials)]
+
+
+class MedianStoppingRule(object):
+    """ Stops a trial when its best validation error so far is worse
+    than the median of the best validation errors that the other
+    trials reached by the same epoch.
+
+    The validation errors are read from
+    ``progress_monitor.validation_error`` and shared between the
+    worker processes through ``history``.
+
+    :param history: A dictionary (usually from a
+        ``multiprocessing.Manager``) from trial ids to the validation
+        history of the trials.
+    :param trial_id: The id of this trial.
+    :param grace_epochs: Trials are never stopped before this epoch.
+    :param min_trials: The minimum number of other trials that must
+        have reached the epoch before a trial can be stopped.
+    """
+
+    def __init__(self, history, trial_id, grace_epochs=0, min_trials=3):
+        self.history = history
+        self.trial_id = trial_id
+        self.grace_epochs = grace_epochs
+        self.min_trials = min_trials
+        self.stopped = False
+
+    def __call__(self, epoch, progress_monitor):
+        validation_error = list(progress_monitor.validation_error)
+        if not validation_error:
+            return False
+        self.history[self.trial_id] = validation_error
+
+        if epoch < self.grace_epochs:
+            return False
+
+        best = min(error for _, error in validation_error)
+        # Only compare against trials that were validated both at or
+        # before and at or after this epoch; trials with other
+        # validation intervals may have no entry up to this epoch yet
+        others = [min(error for e, error in other_history if e <= epoch)
+                  for trial_id, other_history in self.history.items()
+                  if trial_id != self.trial_id and other_history and
+                  other_history[0][0] <= epoch <= other_history[-1][0]]
+        if len(others) < self.min_trials:
+            return False
+
+        self.stopped = best > np.median(others)
+        return self.stopped
+
+
+# Set in each worker process by ``_init_worker``
+_history = None
+_stopping_rule_params = None
+
+def _init_worker(device_ids, backend, history, stopping_rule_params):
+    import hebel
+    global _history, _stopping_rule_params
+    _history = history
+    _stopping_rule_params = stopping_rule_params
+
+    device_id = device_ids.get() if device_ids is not None else None
+    hebel.init(device_id=device_id, backend=backend)
+
+
+def _run_trial(args):
+    trial_id, yaml_src, overrides = args
+    from .config import run_from_config
+    from . import memory_pool
+
+    result = {'trial': trial_id, 'overrides': overrides,
+              'status': 'ok', 'stopped_early': False}
+    stopping_rule = MedianStoppingRule(_history, trial_id,
+                                       **_stopping_rule_params) \
+        if _stopping_rule_params is not None else None
+
+    t = time.time()
+    try:
+        config = run_from_config(yaml_src, overrides, stopping_rule)
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+        return result
+    finally:
+        result['time'] = time.time() - t
+        memory_pool.free_held()
+
+    progress_monitor = config['optimizer'].progress_monitor
+    validation_error = getattr(progress_monitor, 'validation_error', [])
+    train_error = getattr(progress_monitor, 'train_error', [])
+    if validation_error:
+        best_epoch, best_error = min(validation_error, key=lambda x: x[1])
+        result['best_validation_error'] = best_error
+        result['best_epoch'] = best_epoch
+    result['epochs'] = train_error[-1][0] if train_error else 0
+    result['test_error'] = getattr(progress_monitor, 'test_error', None)
+    result['stopped_early'] = stopping_rule is not None and \
+        stopping_rule.stopped
+    return result
+
+
+def run_sweep(yaml_src, trials, n_workers=None, devices=None,
+              early_termination=True, grace_epochs=0, min_trials=3,
+              results_path=None, verbose=True):
+    """ Trains a model for every set of overrides in ``trials`` and
+    returns the results, ordered by trial.
+
+    :param yaml_src: The YAML configuration that the overrides are
+        applied to.
+    :param trials: A list of dictionaries of overrides, e.g. from
+        :func:`grid_search` or :func:`random_search`.
+    :param n_workers: The number of worker processes on the CPU
+        backend. Ignored if ``devices`` is given.
+    :param devices: A list of GPU device ids. One worker process is
+        started for each device. Hebel must not be initialized in the
+        calling process, and without ``devices`` it may only be
+        initialized on the CPU.
+    :param early_termination: Whether to stop poor trials early with a
+        :class:`MedianStoppingRule`.
+    :param grace_epochs: See :class:`MedianStoppingRule`.
+    :param min_trials: See :class:`MedianStoppingRule`.
+    :param results_path: If given, the table of results is written to
+        this file (see :func:`write_results`).
+    :param verbose: Whether to print a line when a trial finishes.
+    """
+
+    import hebel
+    if devices is not None:
+        if hebel.is_initialized:
+            raise RuntimeError("Hebel can't be initialized before "
+                               "starting GPU worker processes")
+        device_ids = multiprocessing.Queue()
+        for device_id in devices:
+            device_ids.put(device_id)
+        n_workers = len(devices)
+        backend = 'gpu'
+    else:
+        if hebel.is_initialized and hebel.backend != 'cpu':
+            raise RuntimeError("Sweeps without devices run on the CPU "
+                               "backend")
+        device_ids = None
+        n_workers = n_workers or 1
+        backend = 'cpu'
+
+    manager = multiprocessing.Manager()
+    history = manager.dict()
+    stopping_rule_params = {'grace_epochs': grace_epochs,
+                            'min_trials': min_trials} \
+        if early_termination else None
+
+    results = []
+    pool = multiprocessing.Pool(n_workers, _init_worker,
+                                (device_ids, backend, history,
+                                 stopping_rule_params))
+    try:
+        for result in pool.imap_unordered(
+                _run_trial, [(i, yaml_src, overrides)
+                             for i, overrides in enumerate(trials)]):
+            results.append(result)
+            if verbose:
+                print 'Trial %d %s (%d/%d done): %s' % (
+                    result['trial'], result['status'], len(results),
+                    len(trials), result.get('best_validation_error'))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        manager.shutdown()
+
+    results.sort(key=lambda r: r['trial'])
+    if results_path is not None:
+        write_results(results, results_path)
+    return results
+
+
+def write_results(results, path):
+    """ Writes the results of a sweep to ``path`` as a tab-separated
+    table with one row per trial and one column per parameter, sorted
+    by the best validation error.
+    """
+
+    parameters = sorted(set(key for r in results for key in r['overrides']))
+    columns = ['trial', 'status', 'best_validation_error', 'best_epoch',
+               'epochs', 'stopped_early', 'test_error', 'time']
+
+    def sort_key(r):
+        error = r.get('best_validation_error')
+        return (error is None, error, r['trial'])
+
+    with open(path, 'wb') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(columns + parameters)
+        for r in sorted(results, key=sort_key):
+            writer.writerow(
+                [r.get(column, '') if r.get(column) is not None else ''
+                 for column in columns] +
+                [r['overrides'].get(p, '') for p in parameters])
@@ -26,6 +26,9 @@ from cPickle import BadPickleGet
 io = None
 hdf_reader = None
 import struct
+import zipfile
+import json
+from cStringIO import StringIO
 from . import environ
 from .string_utils import match
 import shutil
@@ -387,28 +390,38 @@ lush_magic = {
             507333715 : 'float64'
         }
 
-def read_bin_lush_matrix(filepath):
-    f = open(filepath,'rb')
+def read_bin_lush_matrix_header(fin):
+    """ Reads the header of a lush binary matrix from the open file
+    ``fin`` and returns the dtype, the number of dimensions and the
+    (padded) shape. Afterwards, ``fin`` points to the start of the
+    data.
+    """
     try:
-        magic = read_int(f)
+        magic = read_int(fin)
     except ValueError:
         raise ValueError("Couldn't read magic number")
-    ndim = read_int(f)
+    ndim = read_int(fin)
 
     if ndim == 0:
         shape = ()
     else:
-        shape = read_int(f, max(3, ndim))
-
-    total_elems = 1
-    for dim in shape:
-        total_elems *= dim
+        shape = read_int(fin, max(3, ndim))
 
     try:
         dtype = lush_magic[magic]
     except KeyError:
         raise ValueError('Unrecognized lush magic number '+str(magic))
 
+    return dtype, ndim, shape
+
+def read_bin_lush_matrix(filepath):
+    f = open(filepath,'rb')
+    dtype, ndim, shape = read_bin_lush_matrix_header(f)
+
+    total_elems = 1
+    for dim in shape:
+        total_elems *= dim
+
     rval = np.fromfile(file = f, dtype = dtype, count = total_elems)
 
     excess = f.read(-1)
@@ -423,6 +436,339 @@ def read_bin_lush_matrix(filepath):
 
     return rval
 
+def open_memmap(filepath, dtype=None, shape=None, offset=0, mode='r'):
+    """ Opens an array stored on disk as a ``numpy.memmap``, so that
+    it is only read from disk as it is accessed.
+
+    Files ending in ``.npy`` are opened with ``numpy.load``. If
+    ``dtype`` is given, the file is treated as raw binary data of
+    the given ``dtype`` and ``shape``, starting at byte
+    ``offset``. Otherwise, the file must be a lush binary matrix as
+    read by :func:`read_bin_lush_matrix`.
+    """
+    filepath = preprocess(filepath)
+
+    if filepath.endswith('.npy'):
+        return np.load(filepath, mmap_mode=mode)
+
+    if dtype is None:
+        f = open(filepath, 'rb')
+        try:
+            dtype, ndim, shape = read_bin_lush_matrix_header(f)
+            offset = f.tell()
+        finally:
+            f.close()
+        shape = tuple(shape[:ndim])
+
+    return np.memmap(filepath, dtype=dtype, mode=mode,
+                     offset=offset, shape=shape)
+
+def read_npy_header(fin):
+    """ Reads the header of a ``.npy`` file from the open file ``fin``
+    and returns the shape, whether the array is in Fortran order and
+    the dtype. Afterwards, ``fin`` points to the start of the data.
+    """
+    version = np.lib.format.read_magic(fin)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(fin)
+    return np.lib.format.read_array_header_2_0(fin)
+
+def read_array_header(filepath, key=None):
+    """ Returns the shape and dtype of the array in the ``.npy`` file
+    ``filepath``, or of the array ``key`` in the ``.npz`` file
+    ``filepath``, without reading the data.
+    """
+    filepath = preprocess(filepath)
+
+    if key is None:
+        f = open(filepath, 'rb')
+    else:
+        archive = zipfile.ZipFile(filepath)
+        f = archive.open(key + '.npy')
+    try:
+        shape, fortran_order, dtype = read_npy_header(f)
+    finally:
+        f.close()
+        if key is not None:
+            archive.close()
+    return shape, dtype
+
+def open_npz_memmap(filepath, key, mode='r'):
+    """ Opens the array ``key`` in the ``.npz`` file ``filepath`` as a
+    ``numpy.memmap``. Arrays that are stored uncompressed (as by
+    ``numpy.savez``) are mapped directly, compressed arrays (as by
+    ``numpy.savez_compressed``) are read into memory.
+    """
+    filepath = preprocess(filepath)
+
+    archive = zipfile.ZipFile(filepath)
+    try:
+        info = archive.getinfo(key + '.npy')
+    finally:
+        archive.close()
+
+    if info.compress_type != zipfile.ZIP_STORED:
+        return np.load(filepath)[key]
+
+    f = open(filepath, 'rb')
+    try:
+        # The data of the member starts after its local file header
+        f.seek(info.header_offset)
+        header = struct.unpack(zipfile.structFileHeader,
+                               f.read(zipfile.sizeFileHeader))
+        f.seek(header[zipfile._FH_FILENAME_LENGTH] +
+               header[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+        shape, fortran_order, dtype = read_npy_header(f)
+        offset = f.tell()
+    finally:
+        f.close()
+
+    return np.memmap(filepath, dtype=dtype, mode=mode, offset=offset,
+                     shape=shape, order='F' if fortran_order else 'C')
+
+def read_libsvm(filepath, n_features=None, zero_based=False,
+                dtype=np.float32, remap_binary=True):
+    """ Reads a file in the LibSVM/SVMlight format, in which every
+    line is an example of the form ``<label> <index>:<value> ...``.
+
+    Returns the features as a sparse
+    :class:`hebel.pycuda_ops.sparse.CSRMatrix` and the labels as a
+    ``numpy.array``. The feature indices start at one unless
+    ``zero_based`` is set. If ``n_features`` is not given, it is the
+    largest index in the file.
+
+    If all labels are integers, they are returned as ``int32`` class
+    labels that a :class:`hebel.layers.SoftmaxLayer` can train on,
+    otherwise as ``dtype``. Since a label of -1 marks an example that
+    is ignored, binary labels of -1 and +1 are mapped to 0 and 1
+    unless ``remap_binary`` is unset.
+    """
+    from ..pycuda_ops.sparse import CSRMatrix
+
+    filepath = preprocess(filepath)
+
+    labels = []
+    indices = []
+    values = []
+    indptr = [0]
+    with open(filepath) as f:
+        for line in f:
+            line = line.split('#', 1)[0].split()
+            if not line:
+                continue
+            labels.append(float(line[0]))
+            for feature in line[1:]:
+                index, value = feature.split(':')
+                if index == 'qid':
+                    continue
+                indices.append(int(index))
+                values.append(float(value))
+            indptr.append(len(indices))
+
+    indices = np.array(indices, np.int32)
+    if not zero_based:
+        indices -= 1
+    if indices.size and indices.min() < 0:
+        raise ValueError("Feature indices must start at %d" %
+                         (0 if zero_based else 1))
+
+    max_features = int(indices.max()) + 1 if indices.size else 0
+    if n_features is None:
+        n_features = max_features
+    elif n_features < max_features:
+        raise ValueError("The file has %d features, more than n_features" %
+                         max_features)
+
+    data = CSRMatrix(np.array(values, dtype), indices,
+                     np.array(indptr, np.int64),
+                     (len(labels), n_features))
+
+    labels = np.array(labels)
+    if np.all(labels == np.rint(labels)):
+        labels = labels.astype(np.int32)
+        if remap_binary and np.all((labels == -1) | (labels == 1)):
+            labels = (labels + 1) // 2
+    else:
+        labels = labels.astype(dtype)
+    return data, labels
+
+# Binary model format: magic, format version and header length,
+# followed by a JSON header, the pickled object graph without the
+# arrays and the raw arrays, each aligned to MODEL_ALIGNMENT bytes
+MODEL_MAGIC = 'HEBELMDL'
+MODEL_FORMAT_VERSION = 1
+MODEL_ALIGNMENT = 64
+_model_preamble = struct.Struct('<8sII')
+
+def _align(offset):
+    return -(-offset // MODEL_ALIGNMENT) * MODEL_ALIGNMENT
+
+def _json_architecture(value):
+    """ Converts the ``architecture`` of a layer into values that can
+    be stored as JSON. Classes and functions are stored by name.
+    """
+    if isinstance(value, dict):
+        return dict((str(k), _json_architecture(v))
+                    for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [_json_architecture(v) for v in value]
+    if value is None or isinstance(value, (basestring, bool, int, long, float)):
+        return value
+    if isinstance(value, np.generic):
+        return value.item()
+    if hasattr(value, '__name__'):
+        module = getattr(value, '__module__', None)
+        return '%s.%s' % (module, value.__name__) if module \
+            else value.__name__
+    return str(value)
+
+def _model_architecture(model):
+    """ The architecture of every layer of ``model``, or ``None`` if
+    the model doesn't consist of layers.
+    """
+    if not hasattr(model, 'top_layer'):
+        return None
+    layers = list(getattr(model, 'hidden_layers', [])) + [model.top_layer]
+    return [_json_architecture(layer.architecture) for layer in layers]
+
+def dumps_model(model):
+    """ Serializes ``model`` into the binary model format and returns
+    the result as a string.
+
+    All ``GPUArray`` objects referenced by the model (most importantly
+    the parameters) are stored as raw aligned blobs, which
+    :func:`load_model` can memory-map. The rest of the object graph is
+    pickled, which is small and quick to load. The header also
+    records the class, the architecture of every layer and, if
+    available, the checksum of the model, so that
+    :func:`read_model_header` can describe the model without loading
+    it.
+    """
+    from ..pycuda_ops import gpuarray
+
+    arrays = []
+    array_ids = {}
+    def persistent_id(obj):
+        if not isinstance(obj, gpuarray.GPUArray):
+            return None
+        if id(obj) not in array_ids:
+            array_ids[id(obj)] = len(arrays)
+            arrays.append(obj)
+        return array_ids[id(obj)]
+
+    skeleton = StringIO()
+    pickler = cPickle.Pickler(skeleton, cPickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = persistent_id
+    pickler.dump(model)
+    skeleton = skeleton.getvalue()
+
+    header = {
+        'class': '%s.%s' % (model.__class__.__module__,
+                            model.__class__.__name__),
+        'checksum': model.checksum() if hasattr(model, 'checksum') else None,
+        'architecture': _model_architecture(model),
+        'skeleton': None,
+        'arrays': []
+    }
+    # The offsets depend on the header length, so the header is laid
+    # out until its length doesn't change anymore
+    header_length = 0
+    while True:
+        offset = _align(_model_preamble.size + header_length)
+        header['skeleton'] = {'offset': offset, 'nbytes': len(skeleton)}
+        offset += len(skeleton)
+        header['arrays'] = []
+        for array in arrays:
+            offset = _align(offset)
+            header['arrays'].append({'offset': offset,
+                                     'shape': list(array.shape),
+                                     'dtype': np.dtype(array.dtype).str})
+            offset += array.nbytes
+        header_json = json.dumps(header, sort_keys=True)
+        if len(header_json) == header_length:
+            break
+        header_length = len(header_json)
+
+    out = StringIO()
+    out.write(_model_preamble.pack(MODEL_MAGIC, MODEL_FORMAT_VERSION,
+                                   header_length))
+    out.write(header_json)
+    for offset, data in [(header['skeleton']['offset'], skeleton)] + \
+        [(entry['offset'], np.ascontiguousarray(array.get()).tostring())
+         for entry, array in zip(header['arrays'], arrays)]:
+        out.write('\0' * (offset - out.tell()))
+        out.write(data)
+    return out.getvalue()
+
+def save_model(filepath, model):
+    """ Saves ``model`` in the binary model format, see
+    :func:`dumps_model`.
+    """
+    with open(preprocess(filepath), 'wb') as f:
+        f.write(dumps_model(model))
+
+def read_model_header(filepath):
+    """ Returns the header of a file in the binary model format as a
+    dictionary, without loading the model.
+    """
+    with open(preprocess(filepath), 'rb') as f:
+        magic, version, header_length = \
+            _model_preamble.unpack(f.read(_model_preamble.size))
+        if magic != MODEL_MAGIC:
+            raise ValueError('%s is not a Hebel model file' % filepath)
+        if version > MODEL_FORMAT_VERSION:
+            raise ValueError('Unsupported model format version %d' % version)
+        header = json.loads(f.read(header_length))
+    header['version'] = version
+    # Files from before the architecture was recorded
+    header.setdefault('architecture', None)
+    return header
+
+def load_model(filepath, mmap_mode='c'):
+    """ Loads a model saved with :func:`save_model`.
+
+    The arrays are memory-mapped with ``numpy.memmap`` and the given
+    ``mmap_mode``, so that only the pages that are used are read and
+    processes loading the same file share the page cache. On the CPU
+    backend the arrays of the model are views of the memory map
+    (which with the default mode ``'c'`` are copy-on-write), on the
+    GPU they are copied to the device. If ``mmap_mode`` is ``None``,
+    the file is read into memory instead.
+
+    A model that was saved after
+    :meth:`hebel.models.NeuralNet.flatten_parameters` is flattened
+    again when it is loaded, which copies all parameters out of the
+    memory map into a new flat buffer.
+    """
+    from .. import backend
+    from ..pycuda_ops import gpuarray
+    from ..pycuda_ops.cpuarray import to_cpuarray
+
+    filepath = preprocess(filepath)
+    header = read_model_header(filepath)
+
+    arrays = []
+    with open(filepath, 'rb') as f:
+        for entry in header['arrays']:
+            shape = tuple(entry['shape'])
+            dtype = np.dtype(str(entry['dtype']))
+            if mmap_mode is not None and np.prod(shape) > 0:
+                array = np.memmap(filepath, dtype=dtype, mode=mmap_mode,
+                                  offset=entry['offset'], shape=shape)
+            else:
+                f.seek(entry['offset'])
+                array = np.fromfile(f, dtype, int(np.prod(shape))) \
+                          .reshape(shape)
+            arrays.append(to_cpuarray(array) if backend == 'cpu'
+                          else gpuarray.to_gpu(np.ascontiguousarray(array)))
+
+        f.seek(header['skeleton']['offset'])
+        skeleton = f.read(header['skeleton']['nbytes'])
+
+    unpickler = cPickle.Unpickler(StringIO(skeleton))
+    unpickler.persistent_load = lambda pid: arrays[pid]
+    return unpickler.load()
+
 def load_train_file(config_file_path):
     """Loads and parses a yaml file for a Train object.
     Publishes the relevant training environment variables"""
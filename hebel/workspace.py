@@ -0,0 +1,71 @@
+# Copyright (C) 2013  Hannes Bretschneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+""" A ``Workspace`` holds the buffers for activations, deltas and
+gradients of a model, so that they are allocated once and then reused
+for every mini-batch instead of being allocated on every training
+pass.
+
+Layers request buffers by name and shape through
+:meth:`Workspace.get` and pass them to the ``target`` argument of the
+operations in :mod:`hebel.pycuda_ops`. A buffer is allocated the
+first time it is requested and the same buffer is returned for every
+later request with the same layer, name, shape and dtype. Use
+:meth:`hebel.models.NeuralNet.use_workspace` to set up a workspace
+for a model.
+"""
+
+import numpy as np
+from . import memory_pool
+from .pycuda_ops import gpuarray
+
+
+class Workspace(object):
+    """ A pool of reusable buffers, keyed by the layer that owns them,
+    a name, the shape and the dtype.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, owner, name, shape, dtype=np.float32):
+        """ Returns the buffer ``name`` of ``owner`` with the given
+        shape and dtype, allocating it if necessary.
+        """
+
+        key = (id(owner), name, tuple(shape), np.dtype(dtype))
+        try:
+            return self.buffers[key]
+        except KeyError:
+            buf = gpuarray.empty(shape, dtype, allocator=memory_pool.allocate)
+            self.buffers[key] = buf
+            return buf
+
+    @property
+    def nbytes(self):
+        """ The total size of all buffers in bytes """
+        return sum(buf.nbytes for buf in self.buffers.itervalues())
+
+    def clear(self):
+        """ Releases all buffers """
+        self.buffers = {}
+
+    def __getstate__(self):
+        # The buffers are scratch space and are not pickled
+        return {}
+
+    def __setstate__(self, state):
+        self.buffers = {}
@@ -17,6 +17,9 @@
 import hebel
 hebel.init(0)
 
+import os
+import shutil
+import tempfile
 import unittest
 import random
 import numpy as np
@@ -32,7 +35,15 @@ from hebel.monitors import SimpleProgressMonitor
 from hebel.schedulers import exponential_scheduler, linear_scheduler_up, \
     constant_scheduler
 from hebel.pycuda_ops.matrix import extract_columns, insert_columns
-from hebel.pycuda_ops.elementwise import sample_dropout_mask
+from hebel.pycuda_ops.elementwise import sample_dropout_mask, \
+    add_weight_decay, sgd_update, momentum_update, nesterov_update
+from hebel.pycuda_ops.reductions import argmax_mismatch, binary_mismatch, \
+    argmax_mismatch_labels
+from hebel.pycuda_ops.elementwise import substract_labels, dequantize
+from hebel.pycuda_ops.softmax import cross_entropy_labels
+from hebel.pycuda_ops import cpu, compiler
+from hebel.pycuda_ops.elementwise import Kernel
+from hebel.pycuda_ops.sparse import CSRMatrix, csr_dot
 
 
 class TestNeuralNetMNIST(unittest.TestCase):
@@ -150,6 +161,161 @@ class TestSampleDropoutMask(unittest.TestCase):
             self.assertTrue(np.all((X.get()[:, start:end] != 0.)
                                    == dropout_mask.get()))
 
+class TestFusedUpdates(unittest.TestCase):
+    def _arrays(self, dtype, n=4):
+        shape = (np.random.randint(1, 500), np.random.randint(1, 500))
+        return [np.random.randn(*shape).astype(dtype) for _ in range(n)]
+
+    def test_add_weight_decay(self):
+        for dtype in (np.float32, np.float64):
+            grad, param, _, _ = self._arrays(dtype)
+            grad_gpu = gpuarray.to_gpu(grad)
+            add_weight_decay(grad_gpu, gpuarray.to_gpu(param), .1, .01)
+            cpu.add_weight_decay(grad, param, .1, .01)
+            self.assertTrue(np.allclose(grad_gpu.get(), grad))
+
+    def test_momentum_updates(self):
+        for update, update_cpu in ((momentum_update, cpu.momentum_update),
+                                   (nesterov_update, cpu.nesterov_update)):
+            for dtype in (np.float32, np.float64):
+                for use_scale in (False, True):
+                    param, velocity, grad, scale = self._arrays(dtype)
+                    param_gpu = gpuarray.to_gpu(param)
+                    velocity_gpu = gpuarray.to_gpu(velocity)
+                    scale_gpu = gpuarray.to_gpu(scale) if use_scale else None
+                    update(param_gpu, velocity_gpu, gpuarray.to_gpu(grad),
+                           .9, -.01, scale=scale_gpu)
+                    update_cpu(param, velocity, grad, .9, -.01,
+                               scale=scale if use_scale else None)
+                    self.assertTrue(np.allclose(param_gpu.get(), param))
+                    self.assertTrue(np.allclose(velocity_gpu.get(), velocity))
+
+    def test_fused_weight_decay(self):
+        for dtype in (np.float32, np.float64):
+            param, velocity, grad, scale, l1, l2 = self._arrays(dtype, 6)
+            l1, l2 = np.abs(l1), np.abs(l2)
+            to_gpu = lambda *arrays: [gpuarray.to_gpu(a) for a in arrays]
+
+            # Scalar penalty weights
+            param_gpu, grad_gpu = to_gpu(param, grad)
+            sgd_update(param_gpu, grad_gpu, -.01, l1_penalty_weight=.1,
+                       l2_penalty_weight=.01)
+            p = param.copy()
+            cpu.sgd_update(p, grad, -.01, l1_penalty_weight=.1,
+                           l2_penalty_weight=.01)
+            self.assertTrue(np.allclose(param_gpu.get(), p))
+
+            # Per-element penalty weights
+            for update, update_cpu in ((momentum_update, cpu.momentum_update),
+                                       (nesterov_update, cpu.nesterov_update)):
+                param_gpu, velocity_gpu, grad_gpu, scale_gpu, l1_gpu, l2_gpu = \
+                    to_gpu(param, velocity, grad, scale, l1, l2)
+                update(param_gpu, velocity_gpu, grad_gpu, .9, -.01,
+                       scale_gpu, l1_gpu, l2_gpu)
+                p, v = param.copy(), velocity.copy()
+                update_cpu(p, v, grad, .9, -.01, scale, l1, l2)
+                self.assertTrue(np.allclose(param_gpu.get(), p))
+                self.assertTrue(np.allclose(velocity_gpu.get(), v))
+
+
+class TestMismatchCounts(unittest.TestCase):
+    def test_mismatch_counts(self):
+        for n, m in ((1, 1), (100, 10), (1000, 3)):
+            x = np.random.rand(n, m).astype(np.float32)
+            y = np.random.rand(n, m).astype(np.float32)
+            x_gpu, y_gpu = gpuarray.to_gpu(x), gpuarray.to_gpu(y)
+            self.assertEqual(argmax_mismatch(x_gpu, y_gpu).get(),
+                             cpu.argmax_mismatch(x, y))
+            self.assertEqual(binary_mismatch(x_gpu, y_gpu).get(),
+                             cpu.binary_mismatch(x, y))
+
+
+class TestClassLabels(unittest.TestCase):
+    def test_class_labels(self):
+        for n, m in ((1, 1), (100, 10), (1000, 3)):
+            x = np.random.rand(n, m).astype(np.float32)
+            labels = np.random.randint(-1, m, n).astype(np.int32)
+            x_gpu, labels_gpu = gpuarray.to_gpu(x), gpuarray.to_gpu(labels)
+            self.assertTrue(np.allclose(
+                substract_labels(x_gpu, labels_gpu).get(),
+                cpu.substract_labels(x, labels)))
+            self.assertTrue(np.allclose(
+                cross_entropy_labels(x_gpu, labels_gpu).get(),
+                cpu.cross_entropy_labels(x, labels), rtol=1e-4))
+            self.assertEqual(argmax_mismatch_labels(x_gpu, labels_gpu).get(),
+                             cpu.argmax_mismatch_labels(x, labels))
+
+
+class TestDequantize(unittest.TestCase):
+    def test_dequantize(self):
+        for dtype in (np.uint8, np.int8, np.uint16, np.int16):
+            info = np.iinfo(dtype)
+            x = np.random.randint(info.min, info.max + 1, 1000).astype(dtype)
+            x_gpu = gpuarray.to_gpu(x)
+            for target_dtype in (np.float32, np.float64):
+                self.assertTrue(np.allclose(
+                    dequantize(x_gpu, .5, -3., target_dtype).get(),
+                    cpu.dequantize(x, .5, -3., target_dtype)))
+
+        # Normal, subnormal and special values
+        x = np.r_[np.random.randn(1000), 1e-6, -3e-7, 0., -0., 65504.,
+                  np.inf, -np.inf].astype(np.float16)
+        y = dequantize(gpuarray.to_gpu(x)).get()
+        self.assertTrue(np.all(y == x.astype(np.float32)))
+        self.assertTrue(np.isnan(
+            dequantize(gpuarray.to_gpu(np.float16([np.nan]))).get()[0]))
+
+
+class TestCSRDot(unittest.TestCase):
+    def test_csr_dot(self):
+        for n, k, m in ((1, 1, 1), (100, 300, 10), (1000, 50, 130)):
+            x = np.random.randn(n, k).astype(np.float32)
+            x[np.random.rand(n, k) > .1] = 0.
+            y = np.random.randn(k, m).astype(np.float32)
+            delta = np.random.randn(n, m).astype(np.float32)
+
+            csr = CSRMatrix.from_dense(x).to_gpu()
+            self.assertTrue(np.allclose(
+                csr_dot(csr, gpuarray.to_gpu(y)).get(),
+                cpu.csr_dot(csr.get(), y), atol=1e-4))
+            self.assertTrue(np.allclose(
+                csr_dot(csr, gpuarray.to_gpu(delta), transa='T').get(),
+                cpu.csr_dot(csr.get(), delta, transa='T'), atol=1e-4))
+
+
+class TestKernelCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        os.environ['HEBEL_KERNEL_CACHE'] = self.cache_dir
+
+    def tearDown(self):
+        del os.environ['HEBEL_KERNEL_CACHE']
+        shutil.rmtree(self.cache_dir)
+
+    def test_lazy_kernel(self):
+        kernel = Kernel('scale_test',
+                        'float *x, float alpha', 'x[i] *= alpha',
+                        'double *x, double alpha', 'x[i] *= alpha')
+        self.assertEqual(kernel.kernels, {})
+
+        x = np.random.rand(1000).astype(np.float32)
+        x_gpu = gpuarray.to_gpu(x)
+        kernel(x_gpu, np.float32(2.))
+        self.assertEqual(kernel.kernels.keys(), ['float'])
+        self.assertTrue(np.allclose(x_gpu.get(), 2 * x))
+
+        arch_dir = os.path.join(self.cache_dir, compiler.device_arch())
+        self.assertEqual(len(os.listdir(arch_dir)), 1)
+
+        # A new kernel with the same source is loaded from the cache
+        kernel = Kernel('scale_test',
+                        'float *x, float alpha', 'x[i] *= alpha',
+                        'double *x, double alpha', 'x[i] *= alpha')
+        kernel(x_gpu, np.float32(.5))
+        self.assertEqual(len(os.listdir(arch_dir)), 1)
+        self.assertTrue(np.allclose(x_gpu.get(), x))
+
+
 class TestNeuralNetRegression(unittest.TestCase):
     def test_neural_net_regression(self):
         for _ in range(20):
@@ -0,0 +1,1452 @@
+# Copyright (C) 2013  Hannes Bretschneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import json
+import cPickle
+import shutil
+import struct
+import tempfile
+import time
+import unittest
+import hebel
+
+# A process can only be initialized with one backend
+if hebel.is_initialized and hebel.backend != 'cpu':
+    raise unittest.SkipTest("Hebel is already running on the %s backend"
+                            % hebel.backend)
+hebel.init(backend='cpu', random_seed=1234)
+
+import numpy as np
+from hebel import sampler
+from hebel.models import NeuralNet, NeuralNetRegression
+from hebel.layers import HiddenLayer, SoftmaxLayer
+from hebel.optimizers import SGD, EarlyStoppingModule
+from hebel.parameter_updaters import ParameterUpdater, SimpleSGDUpdate, \
+    MomentumUpdate, NesterovMomentumUpdate
+from hebel.data_providers import MiniBatchDataProvider, BatchDataProvider, \
+    PrefetchingDataProvider, MemmapDataProvider, ParallelDataProvider, \
+    ShardedDataProvider, SparseDataProvider, quantize
+from hebel.utils.serial import open_memmap, save_model, load_model, \
+    read_model_header, read_libsvm
+from hebel.monitors import SimpleProgressMonitor, ProgressMonitor, \
+    CheckpointWriter
+from hebel.cross_validation import CrossValidation
+from hebel.sweep import grid_search, random_search, MedianStoppingRule, \
+    write_results, run_sweep
+from hebel.profiler import Profiler, Tracer
+from hebel.schedulers import exponential_scheduler, linear_scheduler_up, \
+    constant_scheduler
+from hebel.pycuda_ops import gpuarray, linalg
+from hebel.pycuda_ops.matrix import add_vec_to_mat, extract_columns, \
+    insert_columns
+from hebel.pycuda_ops.reductions import matrix_sum_out_axis, max_by_axis, \
+    argmax_mismatch, binary_mismatch, argmax_mismatch_labels
+from hebel.pycuda_ops.softmax import softmax, cross_entropy, \
+    cross_entropy_labels
+from hebel.pycuda_ops.sparse import CSRMatrix, csr_dot
+from hebel.pycuda_ops.elementwise import sample_dropout_mask, \
+    add_weight_decay, sgd_update, momentum_update, nesterov_update, \
+    substract_matrix, \
+    substract_labels, nan_to_zeros, dequantize
+
+
+def make_classification_data(N=2000, D=20, n_out=3):
+    centers = 3 * np.random.randn(n_out, D)
+    labels = np.random.randint(0, n_out, N)
+    X = (centers[labels] + np.random.randn(N, D)).astype(np.float32)
+    Y = np.zeros((N, n_out), dtype=np.float32)
+    Y[np.arange(N), labels] = 1.
+    return X, Y
+
+
+class TestCPUOps(unittest.TestCase):
+    def test_dot(self):
+        for transa, transb in (('N', 'N'), ('T', 'N'), ('N', 'T')):
+            a = np.random.randn(30, 40).astype(np.float32)
+            b = np.random.randn(40 if transb == 'N' else 50,
+                                50 if transb == 'N' else 40).astype(np.float32)
+            if transa == 'T': a = a.T.copy()
+            c = linalg.dot(gpuarray.to_gpu(a), gpuarray.to_gpu(b),
+                           transa=transa, transb=transb)
+            a_ = a.T if transa == 'T' else a
+            b_ = b.T if transb == 'T' else b
+            self.assertTrue(np.allclose(c.get(), np.dot(a_, b_), atol=1e-4))
+
+    def test_add_vec_to_mat(self):
+        mat = gpuarray.to_gpu(np.random.randn(30, 40).astype(np.float32))
+        row = gpuarray.to_gpu(np.random.randn(40).astype(np.float32))
+        col = gpuarray.to_gpu(np.random.randn(30).astype(np.float32))
+        self.assertTrue(np.allclose(add_vec_to_mat(mat, row).get(),
+                                    mat.get() + row.get()[None, :]))
+        self.assertTrue(np.allclose(add_vec_to_mat(mat, col, 0, substract=True).get(),
+                                    mat.get() - col.get()[:, None]))
+
+    def test_reductions(self):
+        mat = gpuarray.to_gpu(np.random.randn(30, 40).astype(np.float32))
+        self.assertTrue(np.allclose(matrix_sum_out_axis(mat, 0).get(),
+                                    mat.get().sum(0), atol=1e-4))
+        self.assertTrue(np.allclose(matrix_sum_out_axis(mat, 1).get(),
+                                    mat.get().sum(1), atol=1e-4))
+        self.assertTrue(np.all(max_by_axis(mat, 1).get() == mat.get().max(1)))
+
+    def test_softmax(self):
+        mat = gpuarray.to_gpu(100 * np.random.randn(30, 40).astype(np.float32))
+        p = softmax(mat).get()
+        self.assertTrue(np.all(np.isfinite(p)))
+        self.assertTrue(np.allclose(p.sum(1), 1.))
+
+    def test_columns(self):
+        X = gpuarray.to_gpu(np.random.randn(50, 60).astype(np.float32))
+        Y = extract_columns(X, 10, 25)
+        self.assertTrue(np.all(X.get()[:, 10:25] == Y.get()))
+        Z = gpuarray.to_gpu(np.random.randn(50, 15).astype(np.float32))
+        insert_columns(Z, X, 30)
+        self.assertTrue(np.all(X.get()[:, 30:45] == Z.get()))
+
+    def test_mismatch_counts(self):
+        x = np.random.rand(50, 4).astype(np.float32)
+        y = np.random.rand(50, 4).astype(np.float32)
+        self.assertEqual(argmax_mismatch(gpuarray.to_gpu(x),
+                                         gpuarray.to_gpu(y)).get(),
+                         np.sum(x.argmax(1) != y.argmax(1)))
+        self.assertEqual(binary_mismatch(gpuarray.to_gpu(x),
+                                         gpuarray.to_gpu(y)).get(),
+                         np.sum((x >= .5) != (y >= .5)))
+
+    def test_sample_dropout_mask(self):
+        X = sampler.gen_uniform((1000, 1000), np.float32)
+        dropout_mask = sample_dropout_mask(X, .3)
+        self.assertLess(np.abs(.3 - (1. - dropout_mask.get().mean())), 1e-2)
+        self.assertTrue(np.all((X.get() != 0.) == dropout_mask.get()))
+
+
+class TestShuffling(unittest.TestCase):
+    def _epochs(self, data_provider, n_epochs=2):
+        return [np.concatenate([y.get()[:, 0] for x, y in data_provider])
+                for _ in range(n_epochs)]
+
+    def test_shuffle(self):
+        X = np.arange(250, dtype=np.float32)[:, None].repeat(3, 1)
+        Y = np.arange(250, dtype=np.float32)
+
+        for provider_class in (MiniBatchDataProvider,
+                               PrefetchingDataProvider):
+            epochs = self._epochs(provider_class(X, Y, 100, shuffle=True,
+                                                 random_seed=1))
+            for epoch in epochs:
+                self.assertTrue(np.all(np.sort(epoch) == Y))
+            self.assertFalse(np.all(epochs[0] == epochs[1]))
+            self.assertFalse(np.all(epochs[0] == Y))
+
+            # Same seed, same batches
+            epochs_again = self._epochs(
+                provider_class(X, Y, 100, shuffle=True, random_seed=1))
+            self.assertTrue(all(np.all(a == b)
+                                for a, b in zip(epochs, epochs_again)))
+
+        # Data and targets are shuffled together
+        for x, y in MiniBatchDataProvider(X, Y, 64, shuffle=True):
+            self.assertTrue(np.all(x.get()[:, 0] == y.get()[:, 0]))
+
+
+class TestFusedUpdates(unittest.TestCase):
+    def test_add_weight_decay(self):
+        grad, param = np.random.randn(2, 30, 40).astype(np.float32)
+        expected = grad + .1 * np.sign(param) + .01 * param
+        add_weight_decay(grad, param, .1, .01)
+        self.assertTrue(np.allclose(grad, expected))
+
+    def test_momentum_updates(self):
+        param, velocity, grad, scale = \
+            np.random.randn(4, 30, 40).astype(np.float32)
+        momentum, alpha = .9, -.01
+
+        expected_velocity = momentum * velocity + alpha * scale * grad
+        p, v = param.copy(), velocity.copy()
+        momentum_update(p, v, grad, momentum, alpha, scale)
+        self.assertTrue(np.allclose(v, expected_velocity))
+        self.assertTrue(np.allclose(p, param + expected_velocity))
+
+        p, v = param.copy(), velocity.copy()
+        nesterov_update(p, v, grad, momentum, alpha)
+        expected_velocity = momentum * velocity + alpha * grad
+        self.assertTrue(np.allclose(v, expected_velocity))
+        self.assertTrue(np.allclose(
+            p, param + momentum * expected_velocity + alpha * grad))
+
+    def test_fused_weight_decay(self):
+        param, velocity, grad, scale = \
+            np.random.randn(4, 30, 40).astype(np.float32)
+        l1, l2 = np.random.rand(2, 30, 40).astype(np.float32)
+        decayed = grad + l1 * np.sign(param) + l2 * param
+        momentum, alpha = .9, -.01
+
+        p = param.copy()
+        sgd_update(p, grad, alpha, l1_penalty_weight=.1, l2_penalty_weight=.01)
+        self.assertTrue(np.allclose(
+            p, param + alpha * (grad + .1 * np.sign(param) + .01 * param)))
+
+        p = param.copy()
+        sgd_update(p, grad, alpha, scale, l1, l2)
+        self.assertTrue(np.allclose(p, param + alpha * scale * decayed))
+
+        expected_velocity = momentum * velocity + alpha * scale * decayed
+        p, v = param.copy(), velocity.copy()
+        momentum_update(p, v, grad, momentum, alpha, scale, l1, l2)
+        self.assertTrue(np.allclose(v, expected_velocity))
+        self.assertTrue(np.allclose(p, param + expected_velocity))
+
+        p, v = param.copy(), velocity.copy()
+        nesterov_update(p, v, grad, momentum, alpha, scale, l1, l2)
+        self.assertTrue(np.allclose(v, expected_velocity))
+        self.assertTrue(np.allclose(
+            p, param + momentum * expected_velocity +
+            alpha * scale * decayed))
+
+
+class TestPrefetchingDataProvider(unittest.TestCase):
+    def test_batches(self):
+        # Non-contiguous float64 data with a partial last batch
+        X = np.random.randn(250, 20)[:, ::2]
+        Y = np.random.randn(250)
+        data_provider = PrefetchingDataProvider(X, Y, 100, n_prefetch=3)
+
+        for epoch in range(2):
+            batches = list((x.copy(), y.copy()) for x, y in data_provider)
+            self.assertEqual(len(batches), 3)
+            for i, (x, y) in enumerate(batches):
+                self.assertEqual(x.dtype, np.float32)
+                self.assertTrue(np.allclose(x, X[i*100:(i+1)*100]))
+                self.assertTrue(np.allclose(y[:, 0], Y[i*100:(i+1)*100]))
+
+        # Abandoning an epoch restarts at the first batch
+        iter(data_provider).next()
+        x, y = iter(data_provider).next()
+        self.assertTrue(np.allclose(x, X[:100]))
+
+        data_provider.batch_size = 125
+        self.assertEqual(len(list(data_provider)), 2)
+        data_provider.stop()
+
+    def test_train(self):
+        X, Y = make_classification_data()
+        train_data = PrefetchingDataProvider(X[:1500], Y[:1500], 100)
+        test_data = MiniBatchDataProvider(X[1500:], Y[1500:], 500)
+        model = NeuralNet(n_in=20, n_out=3, layers=[50])
+        optimizer = SGD(model, SimpleSGDUpdate, train_data, test_data,
+                        learning_rate_schedule=constant_scheduler(.5),
+                        progress_monitor=SimpleProgressMonitor())
+        optimizer.run(5)
+        self.assertLess(model.test_error(test_data), .1)
+        train_data.stop()
+
+
+class TestMemmapDataProvider(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_npy_and_lush(self):
+        X = np.random.randint(0, 256, (230, 10)).astype(np.uint8)
+        Y = np.random.randn(230, 3)
+        x_path = os.path.join(self.tmp_dir, 'x.mat')
+        y_path = os.path.join(self.tmp_dir, 'y.npy')
+
+        # Lush binary matrix: magic, ndim, dimensions padded to three
+        with open(x_path, 'wb') as f:
+            f.write(struct.pack('iiiii', 507333717, 2, 230, 10, 1))
+            f.write(X.tostring())
+        np.save(y_path, Y)
+
+        self.assertTrue(isinstance(open_memmap(x_path), np.memmap))
+        data_provider = MemmapDataProvider(x_path, y_path, 100)
+        batches = [(x.copy(), y.copy()) for x, y in data_provider]
+        self.assertEqual([x.shape[0] for x, y in batches], [100, 100, 30])
+        self.assertTrue(np.all(np.concatenate([x for x, y in batches]) == X))
+        self.assertTrue(np.allclose(np.concatenate([y for x, y in batches]), Y))
+        data_provider.stop()
+
+
+class TestShardedDataProvider(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+        # Shards of different sizes, compressed and uncompressed
+        self.X = np.arange(230 * 3, dtype=np.float64).reshape(230, 3)
+        self.Y = np.arange(230)
+        sizes = [50, 70, 30, 80]
+        start = 0
+        for i, size in enumerate(sizes):
+            save = np.savez_compressed if i % 2 else np.savez
+            save(os.path.join(self.tmp_dir, 'shard-%d.npz' % i),
+                 data=self.X[start:start+size],
+                 targets=self.Y[start:start+size])
+            start += size
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_in_order(self):
+        data_provider = ShardedDataProvider(
+            os.path.join(self.tmp_dir, 'shard-*.npz'), 60)
+        self.assertEqual(data_provider.N, 230)
+        self.assertEqual(data_provider.shape, (230, 3))
+
+        for epoch in range(2):
+            batches = [(x.copy(), y.copy()) for x, y in data_provider]
+            self.assertEqual([x.shape[0] for x, y in batches],
+                             [60, 60, 60, 50])
+            self.assertTrue(np.all(np.concatenate([x for x, y in batches])
+                                   == self.X))
+            self.assertTrue(np.all(np.concatenate([y for x, y in batches])
+                                   [:, 0] == self.Y))
+        data_provider.stop()
+
+    def test_npy_shards(self):
+        shards = []
+        for i, start in enumerate(range(0, 230, 100)):
+            x_path = os.path.join(self.tmp_dir, 'x%d.npy' % i)
+            y_path = os.path.join(self.tmp_dir, 'y%d.npy' % i)
+            np.save(x_path, self.X[start:start+100])
+            np.save(y_path, self.Y[start:start+100])
+            shards.append((x_path, y_path))
+
+        data_provider = ShardedDataProvider(shards, 100)
+        self.assertEqual(data_provider.N, 230)
+        x = np.concatenate([x.copy() for x, y in data_provider])
+        self.assertTrue(np.all(x == self.X))
+        data_provider.stop()
+
+    def test_shuffle(self):
+        data_provider = ShardedDataProvider(
+            os.path.join(self.tmp_dir, 'shard-*.npz'), 60,
+            shuffle=True, shuffle_buffer=100, random_seed=1)
+
+        epochs = []
+        for epoch in range(2):
+            batches = [(x.copy(), y.copy()) for x, y in data_provider]
+            self.assertEqual([x.shape[0] for x, y in batches],
+                             [60, 60, 60, 50])
+            data = np.concatenate([x for x, y in batches])
+            targets = np.concatenate([y for x, y in batches])[:, 0]
+
+            # Rows are shuffled, but stay together with their targets
+            self.assertTrue(np.all(data[:, 0] == 3 * targets))
+            self.assertTrue(np.all(np.sort(targets) == self.Y))
+            self.assertFalse(np.all(targets == self.Y))
+            epochs.append(targets)
+        self.assertFalse(np.all(epochs[0] == epochs[1]))
+        data_provider.stop()
+
+    def test_train(self):
+        X, Y = make_classification_data()
+        for i in range(3):
+            np.savez(os.path.join(self.tmp_dir, 'train-%d.npz' % i),
+                     data=X[500*i:500*(i+1)], targets=Y[500*i:500*(i+1)])
+        train_data = ShardedDataProvider(
+            os.path.join(self.tmp_dir, 'train-*.npz'), 100, shuffle=True)
+        test_data = MiniBatchDataProvider(X[1500:], Y[1500:], 500)
+        model = NeuralNet(n_in=20, n_out=3, layers=[50])
+        optimizer = SGD(model, SimpleSGDUpdate, train_data, test_data,
+                        learning_rate_schedule=constant_scheduler(.5),
+                        progress_monitor=SimpleProgressMonitor())
+        optimizer.run(5)
+        self.assertLess(model.test_error(test_data), .1)
+        train_data.stop()
+
+
+class _SquaringDataProvider(MiniBatchDataProvider):
+    """ Pre-processes every batch, some more slowly than others """
+
+    def __getitem__(self, batch_idx):
+        if batch_idx % 3 == 0:
+            time.sleep(.05)
+        data, targets = \
+            super(_SquaringDataProvider, self).__getitem__(batch_idx)
+        return data ** 2, targets
+
+
+class TestParallelDataProvider(unittest.TestCase):
+    def test_ordered(self):
+        X = np.random.randn(250, 10)
+        Y = np.random.randn(250)
+        data_provider = ParallelDataProvider(
+            _SquaringDataProvider(X, Y, 20), n_workers=3)
+        self.assertEqual(data_provider.N, 250)
+
+        for epoch in range(2):
+            batches = [(x.copy(), y.copy()) for x, y in data_provider]
+            self.assertEqual(len(batches), 13)
+            for i, (x, y) in enumerate(batches):
+                self.assertEqual(x.dtype, np.float32)
+                self.assertTrue(np.allclose(x, X[i*20:(i+1)*20] ** 2))
+                self.assertTrue(np.allclose(y[:, 0], Y[i*20:(i+1)*20]))
+
+        # Abandoning an epoch restarts at the first batch
+        iter(data_provider).next()
+        x, y = iter(data_provider).next()
+        self.assertTrue(np.allclose(x, X[:20] ** 2))
+
+        data_provider.batch_size = 125
+        self.assertEqual(len(list(data_provider)), 2)
+        data_provider.stop()
+
+    def test_unordered_and_shuffled(self):
+        X = np.arange(250, dtype=np.float32)[:, None]
+        Y = np.zeros(250)
+        for ordered, shuffle in ((False, False), (True, True)):
+            data_provider = ParallelDataProvider(
+                _SquaringDataProvider(X, Y, 20), n_workers=3,
+                ordered=ordered, shuffle=shuffle)
+            for epoch in range(2):
+                rows = np.concatenate([x[:, 0].copy()
+                                       for x, y in data_provider])
+                self.assertTrue(np.allclose(np.sort(rows), X[:, 0] ** 2))
+            data_provider.stop()
+
+    def test_worker_error(self):
+        data_provider = ParallelDataProvider(
+            MiniBatchDataProvider(np.ones((50, 2)), np.ones(50), 20))
+        data_provider.data_provider.targets_batches = \
+            data_provider.data_provider.targets_batches[:1]
+        data_provider._start_workers()
+        self.assertRaises(RuntimeError, list, data_provider)
+        data_provider.stop()
+
+
+class TestSparseInput(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_sparse(self, n, m, density=.1):
+        x = np.random.randn(n, m).astype(np.float32)
+        x[np.random.rand(n, m) > density] = 0.
+        x[3] = 0.               # An empty row
+        return x
+
+    def test_csr_matrix(self):
+        x = self.make_sparse(50, 30)
+        csr = CSRMatrix.from_dense(x)
+        self.assertEqual(csr.nnz, np.count_nonzero(x))
+        self.assertTrue(np.all(csr.toarray() == x))
+        self.assertTrue(np.all(csr[2:17].toarray() == x[2:17]))
+        self.assertTrue(np.all(csr[40:].toarray() == x[40:]))
+
+        idx = np.array([7, 3, 3, 49, 0])
+        self.assertTrue(np.all(csr.take_rows(idx).toarray() == x[idx]))
+
+        csr_device = csr[2:17].to_gpu()
+        self.assertTrue(csr_device.on_device)
+        self.assertEqual(csr_device.indices.dtype, np.int32)
+        self.assertTrue(np.all(csr_device.toarray() == x[2:17]))
+
+    def test_csr_dot(self):
+        x = self.make_sparse(50, 30)
+        csr = CSRMatrix.from_dense(x).to_gpu()
+        w = gpuarray.to_gpu(np.random.randn(30, 8).astype(np.float32))
+        delta = gpuarray.to_gpu(np.random.randn(50, 8).astype(np.float32))
+
+        self.assertTrue(np.allclose(csr_dot(csr, w).get(),
+                                    np.dot(x, w.get()), atol=1e-5))
+        target = gpuarray.empty((30, 8), np.float32).fill(1.)
+        self.assertIs(csr_dot(csr, delta, transa='T', target=target), target)
+        self.assertTrue(np.allclose(target.get(), np.dot(x.T, delta.get()),
+                                    atol=1e-5))
+        self.assertRaises(ValueError, csr_dot, csr, delta)
+
+    def test_read_libsvm(self):
+        path = os.path.join(self.tmp_dir, 'data.svm')
+        with open(path, 'w') as f:
+            f.write('1 1:.5 4:2 # comment\n'
+                    '\n'
+                    '0 qid:3 2:-1\n'
+                    '1\n')
+        data, labels = read_libsvm(path)
+        self.assertEqual(data.shape, (3, 4))
+        self.assertEqual(labels.dtype, np.int32)
+        self.assertTrue(np.all(labels == [1, 0, 1]))
+        self.assertTrue(np.all(data.toarray() ==
+                               [[.5, 0, 0, 2], [0, -1, 0, 0], [0, 0, 0, 0]]))
+        self.assertEqual(read_libsvm(path, n_features=10)[0].shape, (3, 10))
+        self.assertRaises(ValueError, read_libsvm, path, 2)
+
+        with open(path, 'w') as f:
+            f.write('-1 1:1\n+1 2:1\n')
+        self.assertTrue(np.all(read_libsvm(path)[1] == [0, 1]))
+        self.assertTrue(np.all(read_libsvm(path, remap_binary=False)[1] ==
+                               [-1, 1]))
+
+        with open(path, 'w') as f:
+            f.write('.5 1:1\n2 2:1\n')
+        labels = read_libsvm(path)[1]
+        self.assertEqual(labels.dtype, np.float32)
+        self.assertTrue(np.all(labels == [.5, 2]))
+
+    def test_hidden_layer(self):
+        x = self.make_sparse(40, 30)
+        csr = CSRMatrix.from_dense(x).to_gpu()
+        dense = gpuarray.to_gpu(x)
+        layer = HiddenLayer(30, 10, 'tanh')
+
+        activations = layer.feed_forward(csr)
+        self.assertTrue(np.allclose(activations[0].get(),
+                                    layer.feed_forward(dense)[0].get(),
+                                    atol=1e-5))
+
+        df_output = gpuarray.to_gpu(np.random.randn(40, 10)
+                                    .astype(np.float32))
+        (df_W, df_b), df_input = layer.backprop(csr, df_output.copy(),
+                                                activations)
+        (df_W_dense, df_b_dense), df_input_dense = \
+            layer.backprop(dense, df_output.copy(), activations)
+        self.assertIsNone(df_input)
+        self.assertIsNotNone(df_input_dense)
+        self.assertTrue(np.allclose(df_W.get(), df_W_dense.get(), atol=1e-5))
+        self.assertTrue(np.allclose(df_b.get(), df_b_dense.get()))
+
+    def test_first_layer_skips_input_gradients(self):
+        model = NeuralNet(n_in=20, n_out=3, layers=[10, 10])
+        self.assertEqual([hl.compute_input_gradients
+                          for hl in model.hidden_layers], [False, True])
+        model = NeuralNet(n_in=20, n_out=3, layers=[10], input_dropout=.2)
+        self.assertFalse(model.hidden_layers[1].compute_input_gradients)
+
+    def test_train(self):
+        X, Y = make_classification_data(D=100)
+        X[np.random.rand(*X.shape) > .2] = 0.
+        labels = Y.argmax(1)
+        path = os.path.join(self.tmp_dir, 'train.svm')
+        with open(path, 'w') as f:
+            for x, label in zip(X[:1500], labels[:1500]):
+                f.write('%d %s\n' % (label, ' '.join(
+                    '%d:%r' % (j + 1, float(x[j])) for j in np.nonzero(x)[0])))
+
+        # The labels in the file are used as targets
+        train_data = SparseDataProvider(path, None, 100, shuffle=True,
+                                        n_features=100)
+        self.assertEqual(train_data.N, 1500)
+        self.assertEqual(train_data.targets.dtype, np.int32)
+        test_data = SparseDataProvider(CSRMatrix.from_dense(X[1500:]),
+                                       Y[1500:], 500)
+        model = NeuralNet(n_in=100, n_out=3, layers=[50])
+        optimizer = SGD(model, SimpleSGDUpdate, train_data, test_data,
+                        learning_rate_schedule=constant_scheduler(.5),
+                        progress_monitor=SimpleProgressMonitor())
+        optimizer.run(10)
+        self.assertLess(model.test_error(test_data), .1)
+
+
+class TestClassLabels(unittest.TestCase):
+    def make_targets(self, N=50, n_out=4):
+        labels = np.random.randint(0, n_out, N).astype(np.int32)
+        labels[[3, 17]] = -1    # Ignored examples
+        one_hot = np.zeros((N, n_out), np.float32)
+        one_hot[np.arange(N), labels] = 1.
+        one_hot[labels < 0] = np.nan
+        return labels, one_hot
+
+    def test_ops(self):
+        labels, one_hot = self.make_targets()
+        x = softmax(gpuarray.to_gpu(np.random.randn(50, 4)
+                                    .astype(np.float32)))
+        labels_gpu = gpuarray.to_gpu(labels[:, None])
+        one_hot_gpu = gpuarray.to_gpu(one_hot)
+
+        delta = substract_matrix(x, one_hot_gpu)
+        nan_to_zeros(delta, delta)
+        self.assertTrue(np.allclose(substract_labels(x, labels_gpu).get(),
+                                    delta.get()))
+        self.assertTrue(np.allclose(cross_entropy_labels(x, labels_gpu).get(),
+                                    cross_entropy(x, one_hot_gpu).get()))
+
+        x_valid = x.get()[labels >= 0]
+        self.assertEqual(argmax_mismatch_labels(x, labels_gpu).get(),
+                         np.sum(x_valid.argmax(1) != labels[labels >= 0]))
+
+    def test_softmax_layer(self):
+        labels, one_hot = self.make_targets(n_out=3)
+        labels, one_hot = labels[labels >= 0], one_hot[labels >= 0]
+        layer = SoftmaxLayer(20, 3)
+        x = gpuarray.to_gpu(np.random.randn(labels.shape[0], 20)
+                            .astype(np.float32))
+        labels_gpu = gpuarray.to_gpu(labels)
+        one_hot_gpu = gpuarray.to_gpu(one_hot)
+
+        for error in ('cross_entropy_error', 'class_error', 'kl_error'):
+            self.assertTrue(np.allclose(
+                getattr(layer, error)(x, labels_gpu),
+                getattr(layer, error)(x, one_hot_gpu)))
+
+        (df_W, df_b), df_input = layer.backprop(x, labels_gpu)
+        df_W, df_b, df_input = df_W.get(), df_b.get(), df_input.get()
+        (df_W_one_hot, df_b_one_hot), df_input_one_hot = \
+            layer.backprop(x, one_hot_gpu)
+        self.assertTrue(np.allclose(df_W, df_W_one_hot.get(), atol=1e-5))
+        self.assertTrue(np.allclose(df_b, df_b_one_hot.get(), atol=1e-5))
+        self.assertTrue(np.allclose(df_input, df_input_one_hot.get(),
+                                    atol=1e-5))
+
+        self.assertRaises(ValueError, layer.class_error, x,
+                          gpuarray.to_gpu(labels[:-1]))
+        self.assertRaises(ValueError, layer.class_error, x,
+                          gpuarray.to_gpu(labels.astype(np.int16)))
+
+    def test_train(self):
+        X, Y = make_classification_data()
+        labels = Y.argmax(1)
+        train_data = PrefetchingDataProvider(X[:1500], labels[:1500], 100,
+                                             shuffle=True)
+        test_data = MiniBatchDataProvider(X[1500:], labels[1500:], 500)
+        self.assertEqual(test_data.targets.dtype, np.int32)
+
+        x, y = iter(train_data).next()
+        self.assertEqual(y.dtype, np.int32)
+        self.assertEqual(x.dtype, np.float32)
+
+        model = NeuralNet(n_in=20, n_out=3, layers=[50])
+        optimizer = SGD(model, SimpleSGDUpdate, train_data, test_data,
+                        learning_rate_schedule=constant_scheduler(.5),
+                        progress_monitor=SimpleProgressMonitor())
+        optimizer.run(5)
+        self.assertLess(model.test_error(test_data), .1)
+        train_data.stop()
+
+
+    def test_batch_data_provider(self):
+        X, Y = make_classification_data(N=200)
+        data = BatchDataProvider(X, Y.argmax(1).astype(np.int64))
+        x, y = iter(data).next()
+        self.assertEqual(y.dtype, np.int32)
+        self.assertEqual(y.shape, (200,))
+
+        model = NeuralNet(n_in=20, n_out=3, layers=[10])
+        model.training_pass(gpuarray.to_gpu(x), gpuarray.to_gpu(y))
+
+class TestCompactStorage(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.X = np.random.randn(230, 10).astype(np.float32)
+        self.Y = np.random.randn(230).astype(np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def assert_batches(self, data_provider, X, atol):
+        for epoch in range(2):
+            rows = []
+            for x, y in data_provider:
+                self.assertEqual(x.dtype, np.float32)
+                rows.append(np.concatenate((x, y), 1))
+            rows = np.concatenate(rows)
+            rows = rows[np.argsort(rows[:, -1])]
+            order = np.argsort(self.Y)
+            self.assertTrue(np.allclose(rows[:, :-1], X[order], atol=atol))
+
+    def test_quantize(self):
+        compact, scale, offset = quantize(self.X)
+        self.assertEqual(compact.dtype, np.uint8)
+        x = dequantize(gpuarray.to_gpu(compact), scale, offset).get()
+        self.assertEqual(x.dtype, np.float32)
+        self.assertLessEqual(np.abs(x - self.X).max(), scale / 2 + 1e-5)
+
+        compact, scale, offset = quantize(self.X, np.int16)
+        x = dequantize(gpuarray.to_gpu(compact), scale, offset).get()
+        self.assertLessEqual(np.abs(x - self.X).max(), scale / 2 + 1e-5)
+
+        compact, scale, offset = quantize(self.X, np.float16)
+        self.assertEqual((scale, offset), (1., 0.))
+        self.assertTrue(np.allclose(compact, self.X, atol=1e-2))
+
+        self.assertRaises(ValueError, quantize, self.X, np.float32)
+        self.assertRaises(ValueError, quantize, self.X, np.int32)
+        self.assertRaises(ValueError, quantize, self.X, np.int64)
+
+    def test_mini_batch(self):
+        compact, scale, offset = quantize(self.X)
+        for shuffle in (False, True):
+            data_provider = MiniBatchDataProvider(
+                compact, self.Y, 60, shuffle=shuffle,
+                scale=scale, offset=offset)
+            self.assertEqual(data_provider.data.dtype, np.uint8)
+            self.assert_batches(data_provider, self.X, scale)
+
+        self.assertRaises(ValueError, MiniBatchDataProvider,
+                          self.X, self.Y, 60, scale=2.)
+
+    def test_prefetching(self):
+        compact = self.X.astype(np.float16)
+        data_provider = PrefetchingDataProvider(compact, self.Y, 60,
+                                                shuffle=True)
+        self.assertEqual(data_provider._host_buffers[0][0].dtype,
+                         np.float16)
+        self.assert_batches(data_provider, self.X, 1e-2)
+        data_provider.stop()
+
+        compact, scale, offset = quantize(self.X)
+        path = os.path.join(self.tmp_dir, 'data.npy')
+        np.save(path, compact)
+        data_provider = MemmapDataProvider(path, self.Y, 60,
+                                           scale=scale, offset=offset)
+        self.assert_batches(data_provider, self.X, scale)
+        data_provider.stop()
+
+    def test_sharded(self):
+        compact, scale, offset = quantize(self.X)
+        for i, start in enumerate(range(0, 230, 100)):
+            np.savez(os.path.join(self.tmp_dir, 'shard-%d.npz' % i),
+                     data=compact[start:start+100],
+                     targets=self.Y[start:start+100])
+        data_provider = ShardedDataProvider(
+            os.path.join(self.tmp_dir, 'shard-*.npz'), 60,
+            shuffle=True, scale=scale, offset=offset)
+        self.assert_batches(data_provider, self.X, scale)
+        data_provider.stop()
+
+    def test_parallel(self):
+        compact, scale, offset = quantize(self.X)
+        data_provider = ParallelDataProvider(
+            MiniBatchDataProvider(compact, self.Y, 60,
+                                  scale=scale, offset=offset))
+        self.assertEqual(data_provider._host_buffers[0][0].dtype, np.uint8)
+        self.assert_batches(data_provider, self.X, scale)
+        data_provider.stop()
+
+    def test_train(self):
+        X, Y = make_classification_data()
+        compact, scale, offset = quantize(X)
+        train_data = MiniBatchDataProvider(compact[:1500], Y[:1500], 100,
+                                           scale=scale, offset=offset)
+        test_data = MiniBatchDataProvider(compact[1500:], Y[1500:], 500,
+                                          scale=scale, offset=offset)
+        model = NeuralNet(n_in=20, n_out=3, layers=[50])
+        optimizer = SGD(model, SimpleSGDUpdate, train_data, test_data,
+                        learning_rate_schedule=constant_scheduler(.5),
+                        progress_monitor=SimpleProgressMonitor())
+        optimizer.run(5)
+        self.assertLess(model.test_error(test_data), .1)
+
+
+class TestNeuralNetCPU(unittest.TestCase):
+    def setUp(self):
+        X, Y = make_classification_data()
+        self.train_data = MiniBatchDataProvider(X[:1500], Y[:1500], 100)
+        self.test_data = MiniBatchDataProvider(X[1500:], Y[1500:], 500)
+
+    def _train(self, parameter_updater, **kwargs):
+        model = NeuralNet(n_in=20, n_out=3, layers=[50],
+                          activation_function='relu', dropout=True)
+        optimizer = SGD(model, parameter_updater, self.train_data,
+                        self.test_data,
+                        learning_rate_schedule=exponential_scheduler(.5, .99),
+                        progress_monitor=SimpleProgressMonitor(),
+                        **kwargs)
+        optimizer.run(10)
+        self.assertLess(optimizer.progress_monitor.train_error[-1][1],
+                        optimizer.progress_monitor.train_error[0][1])
+        self.assertLess(model.test_error(self.test_data), .1)
+
+    def test_relu(self):
+        self._train(SimpleSGDUpdate)
+
+    def test_momentum(self):
+        self._train(MomentumUpdate,
+                    momentum_schedule=linear_scheduler_up(.5, .9, 5))
+
+    def test_nesterov_momentum(self):
+        self._train(NesterovMomentumUpdate,
+                    momentum_schedule=linear_scheduler_up(.5, .9, 5))
+
+
+class TestFlatParameters(unittest.TestCase):
+    def setUp(self):
+        X, Y = make_classification_data(N=500)
+        self.data = MiniBatchDataProvider(X, Y, 100)
+
+    def _models(self):
+        model = NeuralNet(n_in=20, n_out=3, layers=[30, 20],
+                          activation_function='tanh',
+                          l1_penalty_weight=.001, l2_penalty_weight=.001)
+        flat_model = NeuralNet(n_in=20, n_out=3, layers=[30, 20],
+                               activation_function='tanh',
+                               l1_penalty_weight=.001, l2_penalty_weight=.001)
+        flat_model.parameters = [p.copy() for p in model.parameters]
+        flat_model.flatten_parameters()
+        return model, flat_model
+
+    def test_views(self):
+        model, flat_model = self._models()
+        for p, q in zip(model.parameters, flat_model.parameters):
+            self.assertTrue(np.all(p.get() == q.get()))
+        self.assertEqual(flat_model.flat_parameters.size,
+                         sum(p.size for p in model.parameters))
+
+        x, y = iter(self.data).next()
+        _, gradients = flat_model.training_pass(x, y)
+        self.assertTrue(all(np.any(g.get() != 0.) for g in gradients))
+        self.assertTrue(np.all(np.concatenate([g.get().ravel() for g in gradients])
+                               == flat_model.flat_gradients.get()))
+
+        flat_model.flat_parameters.fill(1.)
+        self.assertTrue(all(np.all(p.get() == 1.)
+                            for p in flat_model.parameters))
+
+        # Unpickled models get new flat buffers
+        flat_model = cPickle.loads(cPickle.dumps(flat_model))
+        flat_model.flat_parameters.fill(2.)
+        self.assertTrue(all(np.all(p.get() == 2.)
+                            for p in flat_model.parameters))
+
+    def test_updaters(self):
+        for updater in (SimpleSGDUpdate, MomentumUpdate,
+                        NesterovMomentumUpdate):
+            model, flat_model = self._models()
+            for m in (model, flat_model):
+                SGD(m, updater, self.data, self.data,
+                    learning_rate_schedule=constant_scheduler(.1),
+                    momentum_schedule=constant_scheduler(.9),
+                    verbose=False).run(3)
+            for p, q in zip(model.parameters, flat_model.parameters):
+                self.assertTrue(np.allclose(p.get(), q.get(), atol=1e-5))
+
+    def test_deferred_weight_decay(self):
+        # An updater that relies on the gradients to include the
+        # weight decay
+        class Update(ParameterUpdater):
+            def post_gradient_update(self, gradients, batch_size,
+                                     learning_parameters, stream=None):
+                self.model.update_parameters(
+                    [(g, -learning_parameters[0] * lr_multiplier / batch_size)
+                     for g, lr_multiplier in
+                     zip(gradients, self.model.lr_multiplier)])
+
+        model, flat_model = self._models()
+        reference, _ = self._models()
+        reference.parameters = [p.copy() for p in model.parameters]
+        for m, updater in ((model, SimpleSGDUpdate),
+                           (flat_model, SimpleSGDUpdate),
+                           (reference, Update)):
+            SGD(m, updater, self.data, self.data,
+                learning_rate_schedule=constant_scheduler(.1),
+                verbose=False).run(3)
+
+        self.assertTrue(model.defer_weight_decay)
+        self.assertEqual(len(flat_model.flat_weight_decay), 2)
+        self.assertFalse(reference.defer_weight_decay)
+        for m in (model, flat_model):
+            for p, q in zip(m.parameters, reference.parameters):
+                self.assertTrue(np.allclose(p.get(), q.get(), atol=1e-5))
+
+
+class TestEarlyStopping(unittest.TestCase):
+    def test_snapshot(self):
+        for flat in (False, True):
+            model = NeuralNet(n_in=20, n_out=3, layers=[30])
+            if flat: model.flatten_parameters()
+            best_parameters = [p.get() for p in model.parameters]
+
+            early_stopping = EarlyStoppingModule(model, False)
+            early_stopping.finish()
+            self.assertTrue(early_stopping.update(1, .5))
+            for p in model.parameters:
+                p.fill(1.)
+            self.assertFalse(early_stopping.update(2, .6))
+            early_stopping.finish()
+
+            self.assertEqual(early_stopping.best_epoch, 1)
+            for p, q in zip(model.parameters, best_parameters):
+                self.assertTrue(np.all(p.get() == q))
+
+
+class TestCheckpoints(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_progress_monitor(self):
+        X, Y = make_classification_data(N=300)
+        data = MiniBatchDataProvider(X, Y, 100)
+        model = NeuralNet(n_in=20, n_out=3, layers=[10])
+        progress_monitor = ProgressMonitor('test', self.tmp_dir,
+                                           save_interval=1, keep_last=2,
+                                           keep_best=True, make_subdir=False)
+        SGD(model, SimpleSGDUpdate, data, data,
+            progress_monitor=progress_monitor,
+            learning_rate_schedule=constant_scheduler(.1)).run(5)
+
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ['model_test_current_best.pkl',
+                          'model_test_epoch0004.pkl',
+                          'model_test_epoch0005.pkl',
+                          'model_test_final.pkl'])
+        final_model = cPickle.load(
+            open(os.path.join(self.tmp_dir, 'model_test_final.pkl'), 'rb'))
+        for p, q in zip(model.parameters, final_model.parameters):
+            self.assertTrue(np.all(p.get() == q.get()))
+
+    def test_binary_format(self):
+        X, _ = make_classification_data(N=100)
+        for flat in (False, True):
+            model = NeuralNet(n_in=20, n_out=3, layers=[30, 10],
+                              activation_function='relu', dropout=.5)
+            if flat: model.flatten_parameters()
+            path = os.path.join(self.tmp_dir, 'model.hbm')
+            save_model(path, model)
+
+            header = read_model_header(path)
+            self.assertEqual(header['checksum'], model.checksum())
+            self.assertEqual(header['class'], 'hebel.models.neural_net.NeuralNet')
+            self.assertEqual([layer['class'] for layer in header['architecture']],
+                             ['hebel.layers.hidden_layer.HiddenLayer'] * 2 +
+                             ['hebel.layers.softmax_layer.SoftmaxLayer'])
+            self.assertEqual(header['architecture'][0]['n_units'], 30)
+            self.assertEqual(header['architecture'][0]['activation_function'],
+                             'relu')
+            self.assertTrue(all(entry['offset'] % 64 == 0
+                                for entry in header['arrays']))
+
+            loaded_model = load_model(path)
+            self.assertEqual(loaded_model.flat_parameters is not None, flat)
+            for p, q in zip(model.parameters, loaded_model.parameters):
+                self.assertTrue(np.all(p.get() == q.get()))
+            self.assertTrue(np.all(model.predict(X) == loaded_model.predict(X)))
+            if not flat:
+                # The parameters are views of the memory map
+                base = loaded_model.top_layer.W
+                while not isinstance(base, np.memmap) and base is not None:
+                    base = base.base
+                self.assertTrue(isinstance(base, np.memmap))
+
+        progress_monitor = ProgressMonitor('test', self.tmp_dir,
+                                           make_subdir=False,
+                                           checkpoint_format='binary')
+        progress_monitor.model = model
+        progress_monitor.start_training()
+        progress_monitor.report(1, 1., 1., new_best=True, epoch_t=1.)
+        progress_monitor.finish_training()
+        loaded_model = load_model(
+            os.path.join(self.tmp_dir, 'model_test_final.hbm'))
+        self.assertTrue(np.all(model.predict(X) == loaded_model.predict(X)))
+
+    def test_write_error(self):
+        writer = CheckpointWriter()
+        writer.save([1, 2], os.path.join(self.tmp_dir, 'missing', 'x.pkl'))
+        self.assertRaises(IOError, writer.flush)
+        writer.close()
+
+    def test_serialize_error(self):
+        def serialize(obj):
+            raise ValueError
+        writer = CheckpointWriter(max_in_flight=1, serialize=serialize)
+        # The in-flight slot is released, so repeated saves don't block
+        for _ in range(3):
+            self.assertRaises(ValueError, writer.save, [1, 2],
+                              os.path.join(self.tmp_dir, 'x.pkl'))
+        writer.close()
+
+    def test_invalid_arguments(self):
+        self.assertRaises(ValueError, ProgressMonitor, 'test', self.tmp_dir,
+                          checkpoint_format='hdf5')
+        self.assertRaises(ValueError, ProgressMonitor, 'test', self.tmp_dir,
+                          metrics_format='csv')
+        # Cleaning up a partially initialized monitor
+        ProgressMonitor.__new__(ProgressMonitor).__del__()
+
+
+class TestWorkspace(unittest.TestCase):
+    def test_workspace(self):
+        X, Y = make_classification_data(N=550)
+        data = MiniBatchDataProvider(X, Y, 100)
+
+        model = NeuralNet(n_in=20, n_out=3, layers=[30, 20],
+                          activation_function='relu')
+        ws_model = NeuralNet(n_in=20, n_out=3, layers=[30, 20],
+                             activation_function='relu')
+        ws_model.parameters = [p.copy() for p in model.parameters]
+
+        workspace = ws_model.use_workspace(100)
+        n_buffers = len(workspace.buffers)
+        self.assertGreater(workspace.nbytes, 0)
+
+        x, y = iter(data).next()
+        _, gradients = ws_model.training_pass(x, y)
+        _, gradients_again = ws_model.training_pass(x, y)
+        self.assertTrue(all(g is h for g, h in zip(gradients, gradients_again)))
+        self.assertEqual(len(workspace.buffers), n_buffers)
+
+        # Predictions don't return workspace buffers
+        prediction = ws_model.feed_forward(x)
+        self.assertFalse(any(prediction is buf
+                             for buf in workspace.buffers.itervalues()))
+
+        for m in (model, ws_model):
+            SGD(m, MomentumUpdate, data, data,
+                learning_rate_schedule=constant_scheduler(.1),
+                momentum_schedule=constant_scheduler(.9),
+                verbose=False).run(3)
+        for p, q in zip(model.parameters, ws_model.parameters):
+            self.assertTrue(np.allclose(p.get(), q.get(), atol=1e-5))
+
+
+class TestPredict(unittest.TestCase):
+    def test_predict(self):
+        X, Y = make_classification_data(N=550)
+        model = NeuralNet(n_in=20, n_out=3, layers=[30],
+                          activation_function='relu', dropout=.5)
+        expected = model.feed_forward(gpuarray.to_gpu(X)).get()
+
+        self.assertTrue(np.allclose(model.predict(X, 100), expected))
+        self.assertTrue(np.allclose(
+            model.predict(gpuarray.to_gpu(X), 128), expected))
+        self.assertTrue(np.allclose(
+            model.predict(MiniBatchDataProvider(X, Y, 100)), expected))
+
+        out = np.zeros((550, 3), np.float64)
+        self.assertTrue(model.predict(X, 64, out=out) is out)
+        self.assertTrue(np.allclose(out, expected))
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'predictions.npy')
+            model.predict(X, 100, out=path)
+            self.assertTrue(np.allclose(np.load(path), expected))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_predict_empty(self):
+        model = NeuralNet(n_in=20, n_out=3, layers=[30])
+        X = np.zeros((0, 20), np.float32)
+
+        predictions = model.predict(X)
+        self.assertEqual(predictions.shape, (0, 3))
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'predictions.npy')
+            predictions = model.predict(X, out=path)
+            self.assertTrue(isinstance(predictions, np.memmap))
+            self.assertEqual(np.load(path).shape, (0, 3))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class TestInferenceLayers(unittest.TestCase):
+    def test_dropout_folding(self):
+        X, Y = make_classification_data(N=300)
+        data = MiniBatchDataProvider(X, Y, 100)
+        model = NeuralNet(n_in=20, n_out=3, layers=[30, 20],
+                          activation_function='tanh', dropout=.5,
+                          input_dropout=.2)
+        hidden_layers, top_layer = model.inference_layers()
+
+        # The input dropout layer is skipped and no copy scales its
+        # activations
+        self.assertEqual(len(hidden_layers), 2)
+        self.assertTrue(all(hl.dropout == 0. for hl in hidden_layers))
+        self.assertTrue(np.allclose(hidden_layers[0].W.get(),
+                                    .8 * model.hidden_layers[1].W.get()))
+        self.assertTrue(np.allclose(top_layer.W.get(),
+                                    .5 * model.top_layer.W.get()))
+        self.assertEqual(model.hidden_layers[1].dropout, .5)
+
+        # Same predictions as scaling the activations
+        x = gpuarray.to_gpu(X)
+        prediction, _ = model.feed_forward(x, return_cache=True)
+        self.assertTrue(np.allclose(model.predict(X), prediction.get(),
+                                    atol=1e-5))
+
+        test_error = 0.
+        for batch_data, batch_targets in data:
+            _, _, activations = model.evaluate(batch_data, batch_targets,
+                                               return_cache=True)
+            test_error += model.top_layer.test_error(
+                None, batch_targets, average=False, cache=activations)
+        self.assertAlmostEqual(model.test_error(data), test_error / 300.)
+
+    def test_cache(self):
+        X, Y = make_classification_data(N=200)
+        data = MiniBatchDataProvider(X, Y, 100)
+        model = NeuralNet(n_in=20, n_out=3, layers=[30], dropout=.5)
+        layers = model.inference_layers()
+        self.assertTrue(model.inference_layers() is layers)
+
+        # Training invalidates the cache
+        SGD(model, SimpleSGDUpdate, data, data,
+            progress_monitor=SimpleProgressMonitor(),
+            early_stopping=False).run(1)
+        self.assertFalse(model.inference_layers() is layers)
+        self.assertTrue(np.allclose(model.inference_layers()[1].W.get(),
+                                    .5 * model.top_layer.W.get()))
+
+        # So does setting the parameters
+        layers = model.inference_layers()
+        model.parameters = [p.copy() * 2. for p in model.parameters]
+        self.assertFalse(model.inference_layers() is layers)
+        self.assertTrue(np.allclose(model.inference_layers()[1].W.get(),
+                                    .5 * model.top_layer.W.get()))
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_training_pass(self):
+        X, Y = make_classification_data(N=100)
+        model = NeuralNet(n_in=20, n_out=3, layers=[10])
+        with Profiler() as profiler:
+            model.training_pass(gpuarray.to_gpu(X), gpuarray.to_gpu(Y))
+        model.training_pass(gpuarray.to_gpu(X), gpuarray.to_gpu(Y))
+
+        stats = profiler.stats
+        self.assertEqual(stats['HiddenLayer.feed_forward'][0], 1)
+        self.assertEqual(stats['SoftmaxLayer.backprop'][0], 1)
+        self.assertEqual(stats['HiddenLayer.feed_forward'][2],
+                         100 * 10 * 4)
+        self.assertGreater(stats['linalg.dot'][0], 0)
+        self.assertTrue('HiddenLayer.backprop' in profiler.report())
+
+    def test_sgd(self):
+        X, Y = make_classification_data(N=300)
+        data = MiniBatchDataProvider(X, Y, 100)
+        model = NeuralNet(n_in=20, n_out=3, layers=[10])
+        progress_monitor = ProgressMonitor('test', self.tmp_dir,
+                                           make_subdir=False)
+        SGD(model, SimpleSGDUpdate, data, data,
+            progress_monitor=progress_monitor,
+            profiler=Profiler()).run(2, validation_interval=1)
+
+        with open(os.path.join(self.tmp_dir, 'profile.json')) as f:
+            summary = dict((entry['name'], entry) for entry in json.load(f))
+        self.assertEqual(summary['data']['calls'], 2 * 4)
+        self.assertEqual(summary['validation']['calls'], 2)
+        self.assertEqual(summary['HiddenLayer.backprop']['calls'], 2 * 3)
+
+    def test_legacy_progress_monitor(self):
+        # A progress monitor that only implements the original interface
+        class Monitor(object):
+            model = None
+
+            def start_training(self):
+                self.reports = []
+
+            def report(self, epoch, *args, **kwargs):
+                self.reports.append(epoch)
+
+            def finish_training(self):
+                pass
+
+        X, Y = make_classification_data(N=200)
+        data = MiniBatchDataProvider(X, Y, 100)
+        model = NeuralNet(n_in=20, n_out=3, layers=[10])
+        progress_monitor = Monitor()
+        SGD(model, SimpleSGDUpdate, data, data,
+            progress_monitor=progress_monitor).run(2, validation_interval=1)
+        self.assertEqual(progress_monitor.reports, [1, 2])
+
+        profiler = Profiler()
+        SGD(model, SimpleSGDUpdate, data, data,
+            progress_monitor=Monitor(),
+            profiler=profiler).run(1, validation_interval=1)
+        self.assertEqual(profiler.stats['data'][0], 3)
+
+
+    def test_trace(self):
+        X, Y = make_classification_data(N=300)
+        data = PrefetchingDataProvider(X, Y, 100)
+        model = NeuralNet(n_in=20, n_out=3, layers=[10])
+        progress_monitor = ProgressMonitor('test', self.tmp_dir,
+                                           save_interval=1,
+                                           make_subdir=False)
+        SGD(model, SimpleSGDUpdate, data, data,
+            progress_monitor=progress_monitor,
+            profiler=Tracer()).run(2, validation_interval=1)
+        data.stop()
+
+        with open(os.path.join(self.tmp_dir, 'trace.json')) as f:
+            events = json.load(f)['traceEvents']
+        spans = [e for e in events if e['ph'] == 'X']
+        names = set(e['name'] for e in spans)
+        for name in ('data', 'forward', 'backward', 'update', 'validation',
+                     'prefetch', 'checkpoint_write', 'linalg.dot',
+                     'HiddenLayer.backprop'):
+            self.assertTrue(name in names, name)
+        self.assertTrue(all(e['dur'] >= 0 for e in spans))
+
+        # The background threads get their own tracks
+        tid = dict((e['name'], e['tid']) for e in spans)
+        self.assertNotEqual(tid['checkpoint_write'], tid['forward'])
+        self.assertNotEqual(tid['prefetch'], tid['forward'])
+        self.assertEqual(set(e['tid'] for e in events if e['ph'] == 'M'),
+                         set(e['tid'] for e in spans))
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_jsonl(self):
+        X, Y = make_classification_data(N=250)
+        data = MiniBatchDataProvider(X, Y, 100)
+        model = NeuralNet(n_in=20, n_out=3, layers=[10])
+        progress_monitor = ProgressMonitor('test', self.tmp_dir,
+                                           make_subdir=False,
+                                           metrics_format='jsonl')
+        SGD(model, SimpleSGDUpdate, data, data,
+            progress_monitor=progress_monitor).run(3)
+
+        with open(os.path.join(self.tmp_dir, 'metrics.jsonl')) as f:
+            metrics = [json.loads(line) for line in f]
+        self.assertEqual([m['epoch'] for m in metrics], [1, 2, 3])
+        self.assertEqual(metrics, progress_monitor.epoch_metrics)
+        for m in metrics:
+            self.assertEqual(m['examples'], 250)
+            self.assertEqual(m['batches'], 3)
+            self.assertGreater(m['examples_per_second'], 0)
+            self.assertLessEqual(m['step_latency_p50_seconds'],
+                                 m['step_latency_p99_seconds'])
+            self.assertTrue('memory_pool_active_blocks' in m)
+
+    def test_prometheus(self):
+        X, Y = make_classification_data(N=200)
+        data = MiniBatchDataProvider(X, Y, 100)
+        model = NeuralNet(n_in=20, n_out=3, layers=[10])
+        path = os.path.join(self.tmp_dir, 'metrics.prom')
+        progress_monitor = SimpleProgressMonitor(
+            metrics_path=path, metrics_format='prometheus')
+        SGD(model, SimpleSGDUpdate, data,
+            progress_monitor=progress_monitor).run(2)
+
+        lines = open(path).read().splitlines()
+        self.assertTrue('hebel_epoch 2' in lines)
+        self.assertTrue('hebel_examples 200' in lines)
+        self.assertEqual(len([l for l in lines if l.startswith(
+            'hebel_step_latency_seconds{quantile=')]), 3)
+        self.assertEqual(os.listdir(self.tmp_dir), ['metrics.prom'])
+
+
+class TestStartup(unittest.TestCase):
+    def test_lazy_cuda(self):
+        from benchmark_startup import measure
+        result = measure(backend='cpu')
+        self.assertEqual(result['cuda_modules'], [])
+
+
+class TestKernelCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_compile_cached(self):
+        from hebel.pycuda_ops.compiler import compile_cached
+        compiled = []
+
+        def compile(source, options=None, arch=None, no_extern_c=False):
+            compiled.append(source)
+            return 'binary for %s on %s' % (source, arch)
+
+        for _ in range(2):
+            for source in ('kernel a', 'kernel b'):
+                self.assertEqual(
+                    compile_cached(source, 'sm_35', compile,
+                                   cache_dir=self.cache_dir),
+                    'binary for %s on sm_35' % source)
+        self.assertEqual(compiled, ['kernel a', 'kernel b'])
+
+        compile_cached('kernel a', 'sm_50', compile, cache_dir=self.cache_dir)
+        compile_cached('kernel a', 'sm_50', compile, options=['-O2'],
+                       cache_dir=self.cache_dir)
+        self.assertEqual(len(compiled), 4)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)),
+                         ['sm_35', 'sm_50'])
+
+    def test_prepare_format(self):
+        from hebel.pycuda_ops.elementwise import _prepare_format
+        self.assertEqual(_prepare_format(
+            'float *mat, const double *x, char *mask, float p, '
+            'unsigned int n'), 'PPPfII')
+
+
+class _TestCrossValidation(CrossValidation):
+    def make_data_provider(self, idx, batch_size):
+        X, Y = self.data
+        return MiniBatchDataProvider(X[idx], Y[idx], batch_size or 100)
+
+    def make_model(self):
+        return NeuralNet(n_in=20, n_out=3, layers=[10])
+
+    def make_progress_monitor(self, fold):
+        return SimpleProgressMonitor()
+
+    def get_stats(self, dp_train, dp_test, model):
+        return {'n_test': dp_test.N, 'pid': os.getpid()}
+
+
+class TestCrossValidation(unittest.TestCase):
+    def _run(self, **kwargs):
+        config = {'n_folds': 3, 'n_data': 250, 'validation_share': .2,
+                  'numpy_seed': 1, 'epochs': 2, 'yaml_config': None,
+                  'parameter_updater': SimpleSGDUpdate,
+                  'learning_rate_fct': constant_scheduler,
+                  'learning_rate_params': {'value': .1}}
+        X, Y = make_classification_data(N=250)
+        cv = _TestCrossValidation(config, (X, Y))
+        cv.run(**kwargs)
+        return cv
+
+    def test_parallel(self):
+        sequential = self._run()
+        parallel = self._run(n_workers=2)
+
+        for cv in (sequential, parallel):
+            self.assertEqual([s['n_test'] for s in cv.fold_stats],
+                             [84, 84, 82])
+            self.assertEqual(cv.predictions.shape, (250, 3))
+            self.assertEqual(len(cv.train_error['training_error']), 3)
+        self.assertTrue(all(s['pid'] != os.getpid()
+                            for s in parallel.fold_stats))
+        self.assertEqual(parallel.models_cv, [])
+        for fold_idx in parallel.fold_idx:
+            self.assertEqual(len(fold_idx['train_idx']) +
+                             len(fold_idx['validate_idx']) +
+                             len(fold_idx['test_idx']), 250)
+
+    def test_devices_with_initialized_parent(self):
+        # This process is initialized on the CPU, so GPU workers
+        # forked from it couldn't switch to the GPU
+        self.assertRaises(RuntimeError, self._run, devices=[0])
+
+
+class TestSweep(unittest.TestCase):
+    def test_search_spaces(self):
+        trials = grid_search({'a': [1, 2, 3], 'b.c': ['x', 'y']})
+        self.assertEqual(len(trials), 6)
+        self.assertEqual(trials[0], {'a': 1, 'b.c': 'x'})
+
+        space = {'a': [1, 2], 'lr': {'log_uniform': [.01, 1.]},
+                 'n': {'randint': [10, 20]}}
+        trials = random_search(space, 50, random_seed=1)
+        self.assertEqual(trials, random_search(space, 50, random_seed=1))
+        self.assertTrue(all(t['a'] in (1, 2) and .01 <= t['lr'] <= 1. and
+                            10 <= t['n'] <= 20 for t in trials))
+        self.assertRaises(ValueError, random_search,
+                          {'a': {'normal': [0, 1]}}, 1)
+
+    def test_median_stopping_rule(self):
+        history = {0: [(5, .1), (10, .05)], 1: [(5, .2), (10, .1)],
+                   2: [(5, .3)]}
+        monitor = SimpleProgressMonitor()
+        rule = MedianStoppingRule(history, 3, min_trials=2)
+
+        monitor.validation_error = [(5, .15)]
+        self.assertFalse(rule(5, monitor))       # Median is .2
+        monitor.validation_error.append((10, .3))
+        self.assertTrue(rule(10, monitor))       # Median is .075
+        self.assertEqual(history[3], monitor.validation_error)
+
+        rule = MedianStoppingRule(history, 4, grace_epochs=20, min_trials=2)
+        self.assertFalse(rule(10, monitor))
+
+    def test_median_stopping_rule_intervals(self):
+        # The other trials validate at different intervals
+        history = {0: [(10, .1), (20, .05)], 1: [(2, .2), (4, .1)],
+                   2: [(3, .3), (6, .2)], 3: [(1, .4), (5, .3), (9, .2)]}
+        monitor = SimpleProgressMonitor()
+        rule = MedianStoppingRule(history, 4, min_trials=2)
+
+        monitor.validation_error = [(5, .25)]
+        self.assertFalse(rule(5, monitor))       # Median of .3 and .3
+        monitor.validation_error = [(5, .35)]
+        self.assertTrue(rule(5, monitor))
+
+    def test_devices_with_initialized_parent(self):
+        self.assertRaises(RuntimeError, run_sweep, '', [{}], devices=[0])
+
+    def test_stop_condition(self):
+        X, Y = make_classification_data(N=200)
+        data = MiniBatchDataProvider(X, Y, 100)
+        model = NeuralNet(n_in=20, n_out=3, layers=[10])
+        optimizer = SGD(model, SimpleSGDUpdate, data, data,
+                        stop_condition=lambda epoch, monitor: epoch >= 4)
+        optimizer.run(20, validation_interval=2)
+        self.assertEqual(optimizer.epoch, 4)
+        self.assertEqual(len(optimizer.progress_monitor.validation_error), 2)
+
+    def test_write_results(self):
+        results = [
+            {'trial': 0, 'status': 'ok', 'best_validation_error': .2,
+             'overrides': {'a': 1}},
+            {'trial': 1, 'status': 'failed', 'overrides': {'a': 2}},
+            {'trial': 2, 'status': 'ok', 'best_validation_error': .1,
+             'stopped_early': True, 'overrides': {'a': 3}}]
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'results.tsv')
+            write_results(results, path)
+            rows = [line.split('\t') for line in open(path).read().splitlines()]
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(rows[0][:3], ['trial', 'status',
+                                       'best_validation_error'])
+        self.assertEqual(rows[0][-1], 'a')
+        self.assertEqual([row[0] for row in rows[1:]], ['2', '0', '1'])
+        self.assertEqual(rows[1][-1], '3')
+
+
+class TestNeuralNetRegressionCPU(unittest.TestCase):
+    def test_neural_net_regression(self):
+        N = 2000
+        D = 10
+        P = 5
+
+        W_true = 10 * np.random.rand(D, P) - 5
+        b_true = 100 * np.random.rand(P) - 50
+
+        X = np.random.randn(N, D)
+        Y = np.dot(X, W_true) + b_true[np.newaxis, :] + np.random.randn(N, P)
+
+        W_lstsq = np.linalg.lstsq(np.c_[np.ones((N, 1)), X], Y, rcond=-1)[0]
+        W_lstsq = W_lstsq[1:]
+
+        data_provider = BatchDataProvider(gpuarray.to_gpu(X.astype(np.float32)),
+                                          gpuarray.to_gpu(Y.astype(np.float32)))
+
+        model = NeuralNetRegression([], n_in=D, n_out=P)
+        optimizer = SGD(model, SimpleSGDUpdate,
+                        data_provider, data_provider,
+                        learning_rate_schedule=constant_scheduler(1.),
+                        early_stopping=True, verbose=False)
+        optimizer.run(200)
+
+        self.assertLess(np.abs(W_lstsq - model.top_layer.W.get()).max(),
+                        1e-3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -40,7 +40,7 @@ setup( name='Hebel',
        ],
        test_suite='nose.collector',
        tests_require=['nose'],
-       scripts=['train_model.py'],
+       scripts=['train_model.py', 'sweep_model.py'],
        include_package_data=True,
        zip_safe=False
 )
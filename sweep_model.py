@@ -0,0 +1,68 @@
+
+# Copyright (C) 2013  Hannes Bretschneider
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import yaml
+from hebel.sweep import grid_search, random_search, run_sweep
+
+description = """ Run a hyperparameter sweep over a yaml configuration
+file. The sweep is described by a second yaml file, e.g.:
+
+    search: random          # or grid
+    n_trials: 20            # only for random search
+    random_seed: 1
+    parameters:
+      run_conf.iterations: [20, 50]
+      optimizer.model.layers.0.dropout: [yes, no]
+      optimizer.learning_rate_schedule.init_value: {log_uniform: [.1, 10.]}
+
+E.g.:
+
+python sweep_model.py examples/mnist_neural_net_shallow.yml sweep.yml --devices 0 1
+
+"""
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description=description,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('config_file')
+    parser.add_argument('sweep_file')
+    parser.add_argument('--devices', type=int, nargs='+',
+                        help='GPUs to run the trials on, one trial per GPU')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of trials to run in parallel on the '
+                        'CPU, if no devices are given')
+    parser.add_argument('--results', default='sweep_results.tsv',
+                        help='Where to write the table of results')
+    parser.add_argument('--no-early-termination', action='store_true')
+    parser.add_argument('--grace-epochs', type=int, default=0)
+    args = parser.parse_args()
+
+    yaml_src = ''.join(open(args.config_file).readlines())
+    sweep = yaml.safe_load(open(args.sweep_file))
+
+    if sweep.get('search', 'grid') == 'grid':
+        trials = grid_search(sweep['parameters'])
+    else:
+        trials = random_search(sweep['parameters'], sweep['n_trials'],
+                               sweep.get('random_seed'))
+
+    run_sweep(yaml_src, trials, n_workers=args.workers, devices=args.devices,
+              early_termination=not args.no_early_termination,
+              grace_epochs=args.grace_epochs, results_path=args.results)